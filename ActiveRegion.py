@@ -1,11 +1,16 @@
 import numpy as np
-import sunpy.map
-from PIL import Image
-import cv2
 import Database as db
 import ObjectPreparation as prep
+from ContourBatch import ContourBatch
+import RegionStatistics as stats
 
 
+# Ways of choosing active region of a track which is shown in the synthesis:
+# 'maximum' - active region with the highest intensity
+# 'average' - active region with intensity closest to the average intensity of the track
+SYNTHESIS_POLICIES = ('maximum', 'average')
+DEFAULT_POLICY = 'maximum'
+
 # Function reconstructs active region using chain code,
 # convert pixel coordinate to Carrington coordinate system,
 # make synthesis of observation and returns carrington coordinates as well
@@ -18,57 +23,115 @@ import ObjectPreparation as prep
 # ar_id - id of active regions
 # date - date of observation of active regions
 def get_shapes(chains, startx, starty, filename, track_id, ar_id, date):
-    filename = prep.decode_filename(filename)
-    date = prep.decode_date(date)
+    batch = ContourBatch.from_chains(chains, startx, starty, filename, track_id, ar_id, date)
+    carrington_synthesis, pixel_synthesis = get_shapes_from_batch(batch)
+
+    return carrington_synthesis, pixel_synthesis.to_lists()
+
+
+# Does the same as get_shapes, but takes contours of all active regions
+# as ContourBatch and returns pixel coordinates of the synthesis as ContourBatch
+# observatory, instrument - source of the objects, stored with new objects
+# policy - one of SYNTHESIS_POLICIES
+def get_shapes_from_batch(batch, observatory=None, instrument=None, policy=DEFAULT_POLICY):
+    all_coords_carr, all_rows, all_track, all_intensities = get_objects_from_batch(batch, observatory, instrument)
+
+    # objects are merged with their position in the batch,
+    # so synthesis returns positions of chosen active regions
+    mer = merge_id_with_object(all_coords_carr, all_rows, all_track, all_intensities)
+    carrington_synthesis, synthesis_rows = make_ar_synthesis(mer, policy)
+
+    return carrington_synthesis, batch.take(synthesis_rows)
+
+
+# Returns objects of the batch which can be shown on the map: lists of
+# Carrington coordinates, positions in the batch, track_ids and intensities.
+# Stored objects are loaded, new objects are reconstructed and stored.
+# Steps of reconstruction can be done before (e.g. by stages of Pipeline):
+# stored - result of find_stored_objects
+# converted - result of prep.convert_batch_to_carrington for new objects
+# intensities - result of calculate_batch_intensities for new objects
+def get_objects_from_batch(batch, observatory=None, instrument=None, stored=None, converted=None, intensities=None):
     all_track = []
     all_intensities = []
     all_coords_carr = []
-    all_contours_pix = []
-    counter = 0
-    # Loop goes through array of chain code
-    # and calculates coordinate of each of the pixel of the contour
-    for c in chains:
-        xpos = startx[counter]  # Starting position of contour
-        ypos = starty[counter]
-        t_id = track_id[counter]    # tracking data
-        a_id = ar_id[counter]      # unique id
-        file = filename[counter]   # filename
-        ar_date = date[counter]    # date of observation
-
-        # Check if exists in database
-        result = db.load_ar_from_database(a_id)
-        if not result == ([], [], [], []):
-            # check if object go through the end of map and finish at the beginning
-            broken = (max(result[2][0][0]) - min(result[2][0][0])) > 358
-            if not broken:
-                all_track += result[0]
-                all_intensities += result[1]
-                all_coords_carr += result[2]
-                all_contours_pix.append(result[3])
-        else:
-            # Calculate ar contour in pixel, carrington longitude and latitude
-            ar, lon, lat = prep.get_shape(chain=c, xpos=xpos, ypos=ypos, file=file)
-            all_contours_pix.append(ar)
-            ar_inten = calculate_ar_intensity(ar, file)
-            db.add_ar_to_database(a_id, ar_date, t_id, ar_inten, [lon, lat], ar)
-
-            broken = max(lon) - min(lon) > 358  # check if object go through the end of map and finish at the beginning
-            if not broken:
-                all_track.append(str(t_id))
-                all_intensities.append(ar_inten)
-                all_coords_carr.append([lon, lat])
-
-        counter += 1
-
-    mer = merge_id_with_object(all_coords_carr, all_contours_pix, all_track, all_intensities)
-    carrington_synthesis, pixel_synthesis = make_ar_synthesis(mer)
-
-    return carrington_synthesis, pixel_synthesis
+    all_rows = []   # position of each object in the batch
+
+    if stored is None:
+        stored = find_stored_objects(batch)
+    results, missing, content_hashes = stored
+    if converted is None:
+        converted = prep.convert_batch_to_carrington(batch, missing)
+    if intensities is None:
+        # Intensities of all missing objects from the same FITS file are calculated together
+        intensities = calculate_batch_intensities(batch, missing)
+
+    # Loop goes through contours of all objects,
+    # new objects are written to the database by a background thread
+    with db.write_behind():
+        for i in range(len(batch)):
+            t_id = batch.track_id[i]    # tracking data
+            a_id = batch.feature_id[i]  # unique id
+            ar_date = batch.date[i]    # date of observation
+
+            result = results.get(str(a_id))
+            if result is not None:
+                # check if object go through the end of map and finish at the beginning
+                broken = (max(result[2][0][0]) - min(result[2][0][0])) > 358
+                if not broken:
+                    all_track += result[0]
+                    all_intensities += result[1]
+                    all_coords_carr += result[2]
+                    all_rows += [i] * len(result[0])
+            else:
+                # ar carrington longitude and latitude
+                lon, lat = converted[i]
+                ar_inten = intensities[i]
+                db.add_ar_to_database(a_id, ar_date, t_id, ar_inten, [lon, lat], batch.contour(i), observatory,
+                                      instrument, content_hashes[i])
+
+                broken = max(lon) - min(lon) > 358  # check if object go through the end of map and finish at the beginning
+                if not broken:
+                    all_track.append(str(t_id))
+                    all_intensities.append(ar_inten)
+                    all_coords_carr.append([lon, lat])
+                    all_rows.append(i)
+
+    return all_coords_carr, all_rows, all_track, all_intensities
+
+
+# Checks which objects of the batch exist in database (one query for all objects),
+# objects stored from other data are reconstructed again.
+# Returns dictionary str(ar_id) -> stored object, positions of missing
+# objects in the batch and content hashes of all objects
+def find_stored_objects(batch):
+    content_hashes = batch.get_content_hashes()
+    results, missing_ids = db.load_ars_from_database(batch.feature_id, content_hashes)
+    missing_ids = set(missing_ids)
+    missing = [i for i, a_id in enumerate(batch.feature_id) if a_id in missing_ids]
+
+    return results, missing, content_hashes
+
+
+# Makes synthesis of active regions stored in the database observed between
+# start_date and end_date (no download and no conversion to Carrington).
+# Returns Carrington and pixel coordinates of the synthesis
+def make_ar_synthesis_from_database(start_date, end_date, observatory=None, instrument=None, policy=DEFAULT_POLICY):
+    ids, track_ids, intensities, carr, pix = db.load_ars_in_range(start_date, end_date, observatory, instrument)
+
+    # objects which go through the end of map and finish at the beginning are skipped
+    kept = [i for i in range(len(ids)) if len(carr[i][0]) > 0 and carr[i][0].max() - carr[i][0].min() <= 358]
+    if len(kept) == 0:
+        return [], []
+
+    mer = merge_id_with_object([carr[i] for i in kept], [pix[i] for i in kept], [track_ids[i] for i in kept],
+                               [intensities[i] for i in kept])
+    return make_ar_synthesis(mer, policy)
 
 
 # Creates dictionary where key is track_id of active region
 # and values are tuple of ar's intensity, carrington coordinates and
-# pixel coordinates
+# pixel coordinates (or position of ar in ContourBatch)
 def merge_id_with_object(carr_coords, pix_coords,  track_id, ar_intensity):
     ar_with_id = {}
     ar_with_id[track_id[0]] = [(ar_intensity[0], carr_coords[0], pix_coords[0])]
@@ -83,39 +146,58 @@ def merge_id_with_object(carr_coords, pix_coords,  track_id, ar_intensity):
 
 
 # Finds pixel coordinates of pixels inside the ar contour
-# Ar contour is drawn using pixel coordinate system
-# AR is filled with black colour
-# Function checks then which pixels are black and reveal indexes of these pixels
-def get_contour_pixels_indexes(contour):
-    contour = np.array(contour)
-    im = Image.new('RGB', (4096, 4096), (0, 0, 0))  # create blank image
-    cv_image = np.array(im)  # convert PIL image to opencv image
-    cv2.fillPoly(cv_image, pts=[contour], color=(255, 255, 255))  # draw active region
-    indexes = np.where(cv_image == 255)  # get all indexes of active region pixels
+# Ar contour is drawn using pixel coordinate system, only in the
+# bounding box of the contour
+# shape - shape of the image (rows, columns)
+# Returns (rows, columns) indexes of pixels inside the contour
+def get_contour_pixels_indexes(contour, shape=(4096, 4096)):
+    mask, (row, column) = stats.get_contour_mask(contour, shape)
+    rows, columns = np.nonzero(mask)
+
+    return rows + row, columns + column
 
-    return indexes
+
+# Sums values of image pixels inside the contour
+# data - 2D array with image pixels
+def sum_contour_intensity(contour, data):
+    mask, (row, column) = stats.get_contour_mask(contour, data.shape)
+    window = data[row:row + mask.shape[0], column:column + mask.shape[1]]
+
+    return float(window[mask].sum(dtype=np.float64))
 
 
 # coord - coordinates of contour of ar
 # filename - FITS file associated with that ar
 def calculate_ar_intensity(coord, filename):
-    filename = "images//" + filename
-    coord = get_contour_pixels_indexes(coord)  # find all pixels inside the contour
-    pixels_number = len(coord)
-    intensity = 0.0
-    map = sunpy.map.Map(filename)
-    # calculate intensity
-    for x in range(0, pixels_number):
-        intensity = intensity + map.data[coord[0][x]][coord[1][x]]
+    map = prep.load_map(filename)
+
+    return sum_contour_intensity(coord, map.data)
 
-    return intensity
+
+# Calculates intensities of active regions at given positions of the batch.
+# Active regions are grouped by FITS file and all regions from one
+# file are calculated together (stats.calculate_region_statistics).
+# Returns dictionary where key is position in the batch and value is intensity
+def calculate_batch_intensities(batch, rows):
+    intensities = {}
+    rows = np.asarray(rows, dtype=np.int64)
+    for file_index in np.unique(batch.file_index[rows]):
+        file_rows = rows[batch.file_index[rows] == file_index]
+        map = prep.load_map(batch.filenames[file_index])
+        statistics = stats.calculate_region_statistics([batch.contour(i) for i in file_rows], map.data)
+        for i, intensity in zip(file_rows, statistics['sum']):
+            intensities[int(i)] = float(intensity)
+
+    return intensities
 
 
 # Function takes dictionary with AR coords and their track_id
 # Goes through dictionary, calculates the intensity of each AR
-# makes synthesis by calculating the average of the same AR and by
-# choosing the closest AR to the average
-def make_ar_synthesis(ar_with_id):
+# makes synthesis by choosing one AR of each track (policy - one of SYNTHESIS_POLICIES)
+def make_ar_synthesis(ar_with_id, policy=DEFAULT_POLICY):
+    if policy not in SYNTHESIS_POLICIES:
+        raise ValueError("unknown synthesis policy " + str(policy))
+
     all_contours_carr = []
     all_contours_pix = []
     for id, coords in ar_with_id.items():
@@ -131,7 +213,8 @@ def make_ar_synthesis(ar_with_id):
         # to the average value
         closest_to_average = min(regions, key=lambda x: abs(x - average))
         maximum = max(regions)
-        synthesis, pixel_coord = ar_intensity_with_cords[maximum]
+        chosen = maximum if policy == 'maximum' else closest_to_average
+        synthesis, pixel_coord = ar_intensity_with_cords[chosen]
 
         all_contours_carr.append(synthesis)
         all_contours_pix.append(pixel_coord)
@@ -157,10 +240,8 @@ if __name__ == '__main__':
 
     ar_data = DataAccess('2003-10-21T00:00:00', '2003-10-24T00:00:00', 'AR', 'SOHO', 'MDI')
 
-    ar_chain_encoded = prep.decode_and_split(ar_data.get_chain_code())
+    ar_batch = ContourBatch.from_data_access(ar_data, 'AR')
 
-    ar_carr_synthesis, ar_pix_synthesis = get_shapes(ar_chain_encoded, ar_data.get_pixel_start_x(),
-                                                     ar_data.get_pixel_start_y(), ar_data.get_filename(),
-                                               ar_data.get_noaa_number(), ar_data.get_ar_id(), ar_data.get_date())
+    ar_carr_synthesis, ar_pix_synthesis = get_shapes_from_batch(ar_batch)
 
     prep.display_object(ar_carr_synthesis, [])
\ No newline at end of file
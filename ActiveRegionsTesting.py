@@ -50,6 +50,7 @@ def test_active_regions(ar_id, grav_long, grav_lat):
     print("successes = ", success)
     print("fail = ", fail)
     print("ignored = ", ignored)
+    print("database cache:", db.get_cache_stats())
 
 
 # Active regions position testing
@@ -0,0 +1,109 @@
+import asyncio
+import aiohttp
+import DataAccess as da
+
+
+# Maximum number of open connections to HFC shared by all queries
+CONNECTIONS = 8
+
+
+# Downloads one HFC query, failed requests are repeated
+# with growing delay between attempts
+async def download(session, start_date, end_date, feature, observatory, instrument, columns=None):
+    url = da.build_url(start_date, end_date, feature, observatory, instrument, columns)
+    timeout = aiohttp.ClientTimeout(total=da.TIMEOUT)
+
+    for attempt in range(da.RETRIES):
+        try:
+            async with session.get(url, timeout=timeout) as response:
+                response.raise_for_status()
+                xml = await response.read()
+            break
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            # errors of the request (HTTP status below 500) are not repeated
+            client_error = isinstance(error, aiohttp.ClientResponseError) and error.status < 500
+            if attempt == da.RETRIES - 1 or client_error:
+                raise
+            await asyncio.sleep(da.RETRY_DELAY * 2 ** attempt)
+
+    # parsing takes time, it is done in a thread so other downloads can go on
+    return await asyncio.get_running_loop().run_in_executor(None, da.parse_votable, xml, columns)
+
+
+# Returns result of one query (or tile) from the response cache or downloads it
+async def fetch(session, start_date, end_date, feature, observatory, instrument, use_cache=True, columns=None):
+    key = da.get_cache_key(start_date, end_date, feature, observatory, instrument, columns)
+    array = da.response_cache.get(key) if use_cache else None
+
+    if array is None:
+        array = await download(session, start_date, end_date, feature, observatory, instrument, columns)
+        if use_cache:
+            da.response_cache.put(key, array)
+
+    return array
+
+
+# Returns DataAccess object with result of the query. Long windows are
+# split into tiles the same way as in DataAccess and tiles are downloaded
+# at the same time. Only columns used by the getters are downloaded,
+# unless all_columns is True
+async def fetch_feature(session, start_date, end_date, feature, observatory, instrument, use_cache=True,
+                        tile_size=da.TILE_SIZE, all_columns=False):
+    tiles = da.split_into_tiles(start_date, end_date, tile_size)
+    columns = None if all_columns else da.COLUMNS.get(feature)
+    arrays = await asyncio.gather(*[fetch(session, tile[0], tile[1], feature, observatory, instrument, use_cache,
+                                          columns) for tile in tiles])
+
+    if len(tiles) == 1:
+        return da.DataAccess.from_array(arrays[0])
+
+    return da.DataAccess.from_array(da.merge_tiles(arrays, feature, start_date, end_date))
+
+
+# Runs all queries at the same time using one connection pool.
+# queries - dictionary where value is tuple
+# (start_date, end_date, feature, observatory, instrument)
+# Returns dictionary with the same keys and DataAccess objects as values
+async def fetch_features(queries, use_cache=True):
+    connector = aiohttp.TCPConnector(limit=CONNECTIONS)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        results = await asyncio.gather(*[fetch_feature(session, *query, use_cache=use_cache)
+                                         for query in queries.values()])
+
+    return dict(zip(queries.keys(), results))
+
+
+# Blocking version of fetch_features, for code which does not use asyncio
+def get_features(queries, use_cache=True):
+    return asyncio.run(fetch_features(queries, use_cache))
+
+
+# Returns DataAccess objects with active regions, sunspots and filaments
+# from the same time window, all three queries are sent at the same time.
+# Instruments are (observatory, instrument) tuples, feature with None
+# instrument is not downloaded
+def get_ar_sp_fil(start_date, end_date, ar_instrument, sp_instrument, fil_instrument=None, use_cache=True):
+    queries = {}
+    for feature, instrument in (('AR', ar_instrument), ('SP', sp_instrument), ('FIL', fil_instrument)):
+        if instrument is not None:
+            queries[feature] = (start_date, end_date, feature, instrument[0], instrument[1])
+
+    return get_features(queries, use_cache)
+
+
+if __name__ == '__main__':
+    # Compares sequential DataAccess queries with concurrent ones
+    import time
+
+    start = time.perf_counter()
+    ar = da.DataAccess('2003-10-21T00:00:00', '2003-10-24T00:00:00', 'AR', 'SOHO', 'MDI', use_cache=False)
+    sp = da.DataAccess('2003-10-21T00:00:00', '2003-10-24T00:00:00', 'SP', 'SOHO', 'MDI', use_cache=False)
+    print("sequential: {0:.2f} s".format(time.perf_counter() - start))
+
+    start = time.perf_counter()
+    features = get_ar_sp_fil('2003-10-21T00:00:00', '2003-10-24T00:00:00', ('SOHO', 'MDI'), ('SOHO', 'MDI'),
+                             use_cache=False)
+    print("concurrent: {0:.2f} s".format(time.perf_counter() - start))
+
+    print('get_ar_id() TEST', features['AR'].get_ar_id())
+    print('get_sp_id() TEST', features['SP'].get_sp_id())
@@ -0,0 +1,129 @@
+import numpy as np
+
+
+# Chain code directions, position of the row is the direction digit
+# and the row holds the change of x and y coordinate of the pixel
+# 0 left, 1 left-down, 2 down, 3 right-down,
+# 4 right, 5 right-up, 6 up, 7 left-up
+DIRECTIONS = np.array([[-1, 0], [-1, -1], [0, -1], [1, -1],
+                       [1, 0], [1, 1], [0, 1], [-1, 1]], dtype=np.int32)
+
+# Lookup table indexed by any byte value, digits which are not
+# directions do not move the pixel (the same as the old if/elif loop)
+_STEPS = np.zeros((256, 2), dtype=np.int32)
+_STEPS[:len(DIRECTIONS)] = DIRECTIONS
+
+
+# Converts chain code to array of direction digits.
+# chain - raw CC value from DataAccess (bytes or str) or
+# already split chain code (list or array of digits)
+def chain_to_digits(chain):
+    if isinstance(chain, str):
+        chain = chain.encode("ascii")
+
+    if isinstance(chain, bytes):
+        return np.frombuffer(chain, dtype=np.uint8) - np.uint8(ord("0"))
+
+    return np.asarray(chain).astype(np.uint8)
+
+
+# Takes chain code and position of the first pixel and
+# returns int32 array (N,2) with x, y coordinates of each pixel
+# of the contour. The first pixel is not included, the same way
+# as in the old loop implementation
+def decode_chain(chain, xpos, ypos):
+    steps = _STEPS[chain_to_digits(chain)]
+    contour = np.cumsum(steps, axis=0, dtype=np.int32)
+    contour += np.array([xpos, ypos], dtype=np.int32)
+
+    return contour
+
+
+# Decodes list of chain codes with their start positions
+# Returns list of contour arrays
+def decode_chains(chains, startx, starty):
+    return [decode_chain(c, x, y) for c, x, y in zip(chains, startx, starty)]
+
+
+# Decodes all chain codes of a query into one flat array.
+# Returns int32 array (N,2) with contours of all objects one after
+# another and offsets array, contour of object i is
+# coords[offsets[i]:offsets[i + 1]]
+def decode_chains_flat(chains, startx, starty):
+    digits = [chain_to_digits(c) for c in chains]
+    lengths = np.array([len(d) for d in digits], dtype=np.int64)
+    offsets = np.zeros(len(digits) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    if offsets[-1] == 0:
+        return np.zeros((0, 2), dtype=np.int32), offsets
+
+    # one cumulative sum over all objects, then position of every object
+    # is moved from the end of the previous object to its own start pixel
+    steps = _STEPS[np.concatenate(digits)]
+    coords = np.zeros((offsets[-1] + 1, 2), dtype=np.int64)
+    np.cumsum(steps, axis=0, out=coords[1:])
+    start = np.column_stack([startx, starty]).astype(np.int64) - coords[offsets[:-1]]
+    coords = coords[1:] + np.repeat(start, lengths, axis=0)
+
+    return coords.astype(np.int32), offsets
+
+
+if __name__ == '__main__':
+    # Decode benchmark, compares the numpy decoder with the old if/elif loop
+    import time
+
+    # Old implementation copied from ObjectPreparation.get_shape
+    def decode_chain_loop(chain, xpos, ypos):
+        obj = []
+        for d in chain:
+            if d == 0:
+                xpos -= 1
+            elif d == 1:
+                xpos -= 1
+                ypos -= 1
+            elif d == 2:
+                ypos -= 1
+            elif d == 3:
+                ypos -= 1
+                xpos += 1
+            elif d == 4:
+                xpos += 1
+            elif d == 5:
+                ypos += 1
+                xpos += 1
+            elif d == 6:
+                ypos += 1
+            elif d == 7:
+                ypos += 1
+                xpos -= 1
+
+            obj.append([xpos, ypos])
+
+        return obj
+
+    rng = np.random.default_rng(0)
+    objects = 200
+    length = 2000
+    raw_chains = ["".join(map(str, rng.integers(0, 8, length))).encode("ascii") for _ in range(objects)]
+    startx = rng.integers(500, 3500, objects)
+    starty = rng.integers(500, 3500, objects)
+
+    start = time.perf_counter()
+    old = []
+    for c, x, y in zip(raw_chains, startx, starty):
+        digits = list(map(int, str(c.decode("utf-8"))))
+        old.append(decode_chain_loop(digits, int(x), int(y)))
+    old_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    new = decode_chains(raw_chains, startx, starty)
+    new_time = time.perf_counter() - start
+
+    for o, n in zip(old, new):
+        assert np.array_equal(np.array(o), n)
+
+    print("objects:", objects, "chain length:", length)
+    print("if/elif loop: {0:.4f} s".format(old_time))
+    print("numpy decoder: {0:.4f} s".format(new_time))
+    print("speedup: {0:.1f}x".format(old_time / new_time))
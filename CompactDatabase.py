@@ -0,0 +1,100 @@
+import os
+import sys
+import sqlite3
+import Database as db
+import Schema
+
+
+# Compacts database file:
+#   - only the latest copy of objects stored several times is kept
+#     (databases made before objects were unique by id can not be migrated
+#     to the current schema before that)
+#   - rows of spatial indexes without stored object are removed
+#   - overlapping and adjacent coverage windows of an instrument are joined
+#   - free pages are returned to the file system (VACUUM)
+# Returns dictionary with numbers of removed rows and sizes of the file (bytes)
+def compact_database(path=db.DATABASE_FILE):
+    size_before = get_size(path)
+    connection = sqlite3.connect(path)
+    with connection:
+        removed_objects = remove_repeated_objects(connection)
+    Schema.migrate(connection)
+
+    with connection:
+        removed_index_rows = 0
+        for table, id_column, index in db.FEATURE_TABLES.values():
+            removed_index_rows += connection.execute(
+                'DELETE FROM {2} WHERE CAST(id AS TEXT) NOT IN (SELECT {1} FROM {0})'.format(table, id_column, index)
+            ).rowcount
+        removed_windows = compact_coverage(connection)
+
+    connection.execute('ANALYZE')
+    connection.execute('VACUUM')
+    connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    connection.close()
+
+    return {'removed_objects': removed_objects, 'removed_index_rows': removed_index_rows,
+            'removed_windows': removed_windows, 'size_before': size_before, 'size_after': get_size(path)}
+
+
+# Joins coverage windows of each instrument, returns number of removed windows
+def compact_coverage(connection):
+    windows = {}
+    for feature, observatory, instrument, start_date, end_date in connection.execute(
+            'SELECT * FROM coverage ORDER BY feature, observatory, instrument, start_date'):
+        windows.setdefault((feature, observatory, instrument), []).append((start_date, end_date))
+
+    rows = []
+    for source, source_windows in windows.items():
+        rows += [source + window for window in merge_windows(source_windows)]
+
+    removed = sum(len(w) for w in windows.values()) - len(rows)
+    if removed > 0:
+        connection.execute('DELETE FROM coverage')
+        connection.executemany('INSERT INTO coverage VALUES(?,?,?,?,?)', rows)
+
+    return removed
+
+
+# Joins overlapping and adjacent windows (start_date, end_date) sorted by start_date
+def merge_windows(windows):
+    merged = []
+    for start_date, end_date in windows:
+        if merged and start_date <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end_date))
+        else:
+            merged.append((start_date, end_date))
+
+    return merged
+
+
+# Keeps only the latest copy of objects stored several times,
+# returns number of removed rows (tables which do not exist yet have no objects)
+def remove_repeated_objects(connection):
+    removed = 0
+    for table, id_column, index in db.FEATURE_TABLES.values():
+        try:
+            if Schema.count_repeated(connection, table, id_column) > 0:
+                removed += connection.execute(
+                    'DELETE FROM {0} WHERE rowid NOT IN (SELECT MAX(rowid) FROM {0} GROUP BY {1})'
+                    .format(table, id_column)).rowcount
+        except sqlite3.OperationalError:
+            pass
+
+    return removed
+
+
+# Returns size of the database file with its write-ahead log
+def get_size(path):
+    return sum(os.path.getsize(p) for p in [path, path + '-wal'] if os.path.exists(p))
+
+
+# Removes repeated objects and unused rows from the database
+# python CompactDatabase.py [database file]
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else db.DATABASE_FILE
+    result = compact_database(path)
+    print("removed objects:", result['removed_objects'])
+    print("removed index rows:", result['removed_index_rows'])
+    print("removed coverage windows:", result['removed_windows'])
+    print("size: {0:.1f} MB -> {1:.1f} MB".format(result['size_before'] / 1e6, result['size_after'] / 1e6))
@@ -0,0 +1,137 @@
+import hashlib
+import numpy as np
+import ChainCode as cc
+import ObjectPreparation as prep
+
+
+# Methods of DataAccess which return feature id and track id
+# for each type of feature. Sunspots are not tracked.
+FEATURE_COLUMNS = {
+    'AR': ('get_ar_id', 'get_noaa_number'),
+    'SP': ('get_sp_id', None),
+    'FIL': ('get_fil_id', 'get_track_id'),
+}
+
+
+# Holds pixel contours of all objects returned by one query.
+# Coordinates of all contours are stored in one contiguous (N,2) array,
+# contour of object i is coords[offsets[i]:offsets[i + 1]].
+# Information about objects is stored in parallel arrays:
+# feature_id - id of object (ID_AR, ID_SUNSPOT or ID_FIL)
+# track_id - tracking data of object
+# start - (n,2) array with chain code start pixel of each object
+# file_index - position of object FITS filename in filenames list
+# date - date of observation of object
+class ContourBatch:
+    def __init__(self, coords, offsets, feature_id, track_id, start, file_index, filenames, date):
+        self.coords = coords
+        self.offsets = offsets
+        self.feature_id = feature_id
+        self.track_id = track_id
+        self.start = start
+        self.file_index = file_index
+        self.filenames = filenames
+        self.date = date
+
+    # Creates batch from the same arguments which get_shapes functions take
+    # chains - raw chain codes or arrays of direction digits
+    # dtype - type of stored coordinates, np.int16 is enough for 4096x4096 images
+    @classmethod
+    def from_chains(cls, chains, startx, starty, filename, track_id, feature_id, date, dtype=np.int32):
+        coords, offsets = cc.decode_chains_flat(chains, startx, starty)
+        filenames, file_index = np.unique(prep.decode_filename(filename), return_inverse=True)
+        start = np.column_stack([np.asarray(startx), np.asarray(starty)]).astype(dtype)
+
+        return cls(coords.astype(dtype, copy=False), offsets, np.asarray(feature_id), np.asarray(track_id),
+                   start, file_index.astype(np.int32), filenames.tolist(), np.array(prep.decode_date(date)))
+
+    # Creates batch from result of DataAccess query
+    # feature - 'AR', 'SP' or 'FIL'
+    @classmethod
+    def from_data_access(cls, data, feature, dtype=np.int32):
+        id_getter, track_getter = FEATURE_COLUMNS[feature]
+        feature_id = getattr(data, id_getter)()
+        if track_getter is None:
+            track_id = np.full(len(feature_id), -1)
+        else:
+            track_id = getattr(data, track_getter)()
+
+        return cls.from_chains(data.get_chain_code(), data.get_pixel_start_x(), data.get_pixel_start_y(),
+                               data.get_filename(), track_id, feature_id, data.get_date(), dtype=dtype)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    # Returns contour of object i, it is a view into coords (no copy)
+    def contour(self, i):
+        return self.coords[self.offsets[i]:self.offsets[i + 1]]
+
+    # Returns FITS filename of object i
+    def get_filename(self, i):
+        return self.filenames[self.file_index[i]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.contour(i)
+
+    # Returns hash of the data object i is made from: contour (decoded chain code),
+    # start pixel and FITS filename. Database stores it with the object,
+    # so changed objects are found without comparing coordinates.
+    def get_content_hash(self, i):
+        content = hashlib.sha1(np.ascontiguousarray(self.contour(i), dtype=np.int32).tobytes())
+        content.update(np.ascontiguousarray(self.start[i], dtype=np.int32).tobytes())
+        content.update(self.get_filename(i).encode('utf-8'))
+        return content.hexdigest()
+
+    # Returns list of content hashes of all objects
+    def get_content_hashes(self):
+        return [self.get_content_hash(i) for i in range(len(self))]
+
+    # Returns new batch with objects at given positions
+    def take(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        lengths = self.offsets[indices + 1] - self.offsets[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        if len(indices) > 0:
+            coords = np.concatenate([self.contour(i) for i in indices])
+        else:
+            coords = self.coords[:0]
+
+        return ContourBatch(coords, offsets, self.feature_id[indices], self.track_id[indices],
+                            self.start[indices], self.file_index[indices], self.filenames, self.date[indices])
+
+    # Returns contours in the old format - list of lists of [x, y]
+    def to_lists(self):
+        return [contour.tolist() for contour in self]
+
+    # Returns number of bytes used by contour coordinates and offsets
+    def nbytes(self):
+        return self.coords.nbytes + self.offsets.nbytes
+
+
+if __name__ == '__main__':
+    # Compares memory used by batch and by list of lists of [x, y]
+    import sys
+
+    rng = np.random.default_rng(0)
+    objects = 500
+    chains = ["".join(map(str, rng.integers(0, 8, 1000))) for _ in range(objects)]
+    startx = rng.integers(500, 3500, objects)
+    starty = rng.integers(500, 3500, objects)
+    filename = ["image" + str(x % 10) + ".fits" for x in range(objects)]
+    date = ["2003-10-24T00:00:00"] * objects
+
+    batch = ContourBatch.from_chains(chains, startx, starty, filename, np.arange(objects), np.arange(objects),
+                                     date, dtype=np.int16)
+    lists = cc.decode_chains(chains, startx, starty)
+    lists = [contour.tolist() for contour in lists]
+
+    for contour, old in zip(batch, lists):
+        assert contour.tolist() == old
+
+    list_bytes = sum(sys.getsizeof(c) + sum(sys.getsizeof(p) + 2 * 28 for p in c) for c in lists)
+    print("points:", len(batch.coords))
+    print("list of lists: {0:.1f} MB".format(list_bytes / 1e6))
+    print("contour batch: {0:.1f} MB".format(batch.nbytes() / 1e6))
@@ -0,0 +1,139 @@
+import json
+import zlib
+import struct
+import numpy as np
+
+
+# Binary format of contours stored in the database.
+# Header: format version, kind of coordinates, flags, number of points,
+# then all values of the first axis followed by all values of the second axis
+#   - Carrington coordinates [lon, lat] are stored as float32
+#   - pixel coordinates [[x, y], ...] are stored as int16
+# DELTA - differences between neighbouring points are stored (for float32
+# the differences of their bit patterns, so the codec stays lossless),
+# neighbouring points of a contour are close, so differences compress well
+# COMPRESS - values are compressed with zlib
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<BBBI')
+
+CARRINGTON = 1
+PIXELS = 2
+
+DELTA = 1
+COMPRESS = 2
+
+# Flags used by Database
+DEFAULT_FLAGS = DELTA | COMPRESS
+
+# Number of contours in a list and number of bytes of each encoded contour
+LIST_LENGTH = struct.Struct('<I')
+
+# Types of stored values and their integer views used by delta encoding
+KIND_TYPES = {CARRINGTON: (np.dtype('<f4'), np.dtype('<u4')),
+              PIXELS: (np.dtype('<i2'), np.dtype('<u2'))}
+
+
+# Encodes Carrington coordinates [lon, lat] to bytes
+def encode_carrington(coords, flags=DEFAULT_FLAGS):
+    values = np.asarray(coords, dtype=np.float32).reshape(2, -1)
+    return encode(values, CARRINGTON, flags)
+
+
+# Decodes Carrington coordinates, returns array with shape (2, N): [lon, lat]
+# Coordinates stored as JSON text (before binary format) are decoded too
+def decode_carrington(value):
+    if isinstance(value, str):
+        return np.array(json.loads(value), dtype=np.float32).reshape(2, -1)
+    return decode(value, CARRINGTON)
+
+
+# Encodes pixel coordinates [[x, y], ...] to bytes
+def encode_pixels(contour, flags=DEFAULT_FLAGS):
+    contour = np.asarray(contour).reshape(-1, 2)
+    if len(contour) > 0 and (contour.min() < -32768 or contour.max() > 32767):
+        raise ValueError("pixel coordinates do not fit in int16")
+    return encode(contour.T.astype(np.int16), PIXELS, flags)
+
+
+# Decodes pixel coordinates, returns int32 array with shape (N, 2): [[x, y], ...]
+# Coordinates stored as JSON text (before binary format) are decoded too
+def decode_pixels(value):
+    if isinstance(value, str):
+        return np.array(json.loads(value), dtype=np.int32).reshape(-1, 2)
+    return decode(value, PIXELS).T.astype(np.int32)
+
+
+# Encodes list of contours in Carrington coordinates (e.g. synthesis) to bytes
+def encode_carrington_list(contours, flags=DEFAULT_FLAGS):
+    parts = [LIST_LENGTH.pack(len(contours))]
+    for contour in contours:
+        blob = encode_carrington(contour, flags)
+        parts += [LIST_LENGTH.pack(len(blob)), blob]
+
+    return b''.join(parts)
+
+
+# Decodes list of contours, returns list of arrays with shape (2, N)
+def decode_carrington_list(value):
+    contours = []
+    (number,) = LIST_LENGTH.unpack_from(value)
+    position = LIST_LENGTH.size
+    for _ in range(number):
+        (length,) = LIST_LENGTH.unpack_from(value, position)
+        position += LIST_LENGTH.size
+        contours.append(decode_carrington(value[position:position + length]))
+        position += length
+
+    return contours
+
+
+# Encodes array with shape (2, N)
+def encode(values, kind, flags):
+    value_type, integer_type = KIND_TYPES[kind]
+    values = np.ascontiguousarray(values, dtype=value_type)
+    if flags & DELTA:
+        # differences of integer views wrap around, so the decoding is exact
+        integers = values.view(integer_type)
+        values = np.diff(integers, axis=1, prepend=integer_type.type(0))
+
+    data = values.tobytes()
+    if flags & COMPRESS:
+        data = zlib.compress(data)
+
+    return HEADER.pack(FORMAT_VERSION, kind, flags, values.shape[1]) + data
+
+
+# Decodes bytes made by encode, returns array with shape (2, N)
+def decode(value, kind):
+    version, stored_kind, flags, points = HEADER.unpack_from(value)
+    if version != FORMAT_VERSION or stored_kind != kind:
+        raise ValueError("unknown coordinate format {0}/{1}".format(version, stored_kind))
+
+    data = value[HEADER.size:]
+    if flags & COMPRESS:
+        data = zlib.decompress(data)
+
+    value_type, integer_type = KIND_TYPES[kind]
+    if flags & DELTA:
+        integers = np.frombuffer(data, dtype=integer_type).reshape(2, points)
+        return np.cumsum(integers, axis=1, dtype=integer_type).view(value_type)
+
+    return np.frombuffer(data, dtype=value_type).reshape(2, points)
+
+
+if __name__ == '__main__':
+    # CoordinateCodec testing
+    rng = np.random.default_rng(0)
+    lon = np.cumsum(rng.uniform(-0.05, 0.05, 500)) + 120
+    lat = np.cumsum(rng.uniform(-0.05, 0.05, 500)) - 20
+    pixels = np.cumsum(rng.integers(-1, 2, size=(500, 2)), axis=0) + 2048
+
+    for flags in [0, DELTA, COMPRESS, DELTA | COMPRESS]:
+        carr_blob = encode_carrington([lon, lat], flags)
+        pix_blob = encode_pixels(pixels, flags)
+        carr = decode_carrington(carr_blob)
+        pix = decode_pixels(pix_blob)
+        print("flags", flags, "carrington bytes", len(carr_blob), "pixel bytes", len(pix_blob),
+              "exact", np.array_equal(carr, np.float32([lon, lat])) and np.array_equal(pix, pixels))
+
+    print("json bytes", len(json.dumps([lon.tolist(), lat.tolist()])), len(json.dumps(pixels.tolist())))
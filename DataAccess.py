@@ -1,86 +1,477 @@
+import io
+import re
+import time
+import urllib.error
 import urllib.request
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
+from datetime import datetime, timedelta
+import numpy as np
 from astropy.io.votable import parse_single_table
+from ResponseCache import ResponseCache
+
+
+HFC_URL = 'http://voparis-helio.obspm.fr/helio-hfc/HelioQueryService'
+
+# Cache of parsed query results shared by all DataAccess objects
+response_cache = ResponseCache()
+
+# Long queries are split into tiles of TILE_SIZE,
+# at most TILE_WORKERS tiles are downloaded at the same time
+TILE_SIZE = timedelta(days=1)
+TILE_WORKERS = 4
+
+# Download of a query is attempted at most RETRIES times in total, first repeat
+# is after RETRY_DELAY seconds, every next one waits twice as long.
+# Client errors (HTTP status below 500) are not repeated
+RETRIES = 3
+RETRY_DELAY = 1.0
+TIMEOUT = 120
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# Column with unique id of each type of feature
+ID_COLUMNS = {'AR': 'ID_AR', 'SP': 'ID_SUNSPOT', 'FIL': 'ID_FIL'}
+
+# Columns used by the getters, only these columns are parsed
+# (HQI views have over a hundred columns)
+COMMON_COLUMNS = ['CC', 'CC_X_PIX', 'CC_Y_PIX', 'FILENAME', 'DATE_OBS', 'TRACK_ID',
+                  'FEAT_CARR_LONG_DEG', 'FEAT_CARR_LAT_DEG']
+COLUMNS = {'AR': COMMON_COLUMNS + ['ID_AR', 'NOAA_NUMBER'],
+           'SP': COMMON_COLUMNS + ['ID_SUNSPOT'],
+           'FIL': COMMON_COLUMNS + ['ID_FIL']}
+
+# If True, list of columns is also sent to HFC (SELECT parameter),
+# so the service does not send the other columns at all.
+# Off by default: support of SELECT by the HQI views was not verified,
+# columns are always dropped while the response is parsed
+SELECT_COLUMNS = False
+
+# Size of the part of the response read to find names of the columns
+HEADER_CHUNK = 64 * 1024
+
+
+# Returns True if download failed because of the error should be repeated
+# (network errors and server errors, not errors of the request)
+def is_retried(error):
+    return not (isinstance(error, urllib.error.HTTPError) and error.code < 500)
+
+
+# Returns result of function, failed calls (OSError) are repeated
+# with growing delay between attempts
+def retry(function):
+    for attempt in range(RETRIES):
+        try:
+            return function()
+        except OSError as error:
+            if attempt == RETRIES - 1 or not is_retried(error):
+                raise
+            time.sleep(RETRY_DELAY * 2 ** attempt)
+
+
+# Returns url of HFC query
+# columns - list of columns to download, None means all columns
+def build_url(start_date, end_date, feature, observatory, instrument, columns=None):
+    url = HFC_URL + '?FROM=VIEW_' + feature + '_HQI,&STARTTIME=' + start_date + \
+          '&ENDTIME=' + end_date + '&WHERE=OBSERVAT,' + observatory + ';INSTRUME,' + instrument
+    if columns is not None and SELECT_COLUMNS:
+        url += '&SELECT=' + ','.join(columns)
+
+    return url
+
+
+# Parses VOTable returned by HFC and returns it as numpy record array
+# source - bytes with VOTable or binary stream (e.g. HTTP response)
+# columns - list of columns to parse, None means all columns,
+# columns which are not in the VOTable are skipped
+def parse_votable(source, columns=None):
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+
+    if columns is not None:
+        # names of columns are read from the beginning of the stream,
+        # then the whole stream is given to the parser
+        header, fields = read_header(source)
+        columns = [c for c in columns if c in fields]
+        source = io.BufferedReader(ChainedStream(header, source))
+
+    # Astropy table, simplify VOTable reading
+    # VOTable is parsed straight from the stream, so the whole
+    # response is never stored in memory (or in output file)
+    # (read function is given to the parser, otherwise astropy copies
+    # streams which can not seek into memory)
+    table = parse_single_table(source.read, columns=columns)
+
+    return table.array
+
+
+# Reads VOTable from the stream until the beginning of table data.
+# Returns read bytes and names of all columns (FIELD elements)
+def read_header(stream):
+    header = b''
+    while b'<DATA' not in header and b'</TABLE' not in header:
+        chunk = stream.read(HEADER_CHUNK)
+        if not chunk:
+            break
+        header += chunk
+
+    return header, [name.decode('utf-8') for name in re.findall(rb'<FIELD[^>]*\sname="([^"]*)"', header)]
+
+
+# Stream which returns given bytes first and then the rest of other stream
+class ChainedStream(io.RawIOBase):
+    def __init__(self, head, stream):
+        self.head = memoryview(head)
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if len(self.head) > 0:
+            size = min(len(buffer), len(self.head))
+            buffer[:size] = self.head[:size]
+            self.head = self.head[size:]
+            return size
+
+        data = self.stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+# Returns key of the query in the response cache
+def get_cache_key(start_date, end_date, feature, observatory, instrument, columns=None):
+    columns = 'ALL' if columns is None else ','.join(columns)
+    return feature, observatory, instrument, start_date, end_date, columns
+
+
+# Splits time window into tiles, returns list of (start, end) strings.
+# Tiles are aligned to multiples of tile_size counted from midnight 1970-01-01,
+# so overlapping windows are made of the same tiles, which are then
+# taken from the response cache. Window shorter than one tile is not split.
+def split_into_tiles(start_date, end_date, tile_size):
+    start = datetime.strptime(start_date, DATE_FORMAT)
+    end = datetime.strptime(end_date, DATE_FORMAT)
+    if tile_size is None or end - start <= tile_size:
+        return [(start_date, end_date)]
+
+    epoch = datetime(1970, 1, 1)
+    tile_start = epoch + ((start - epoch) // tile_size) * tile_size
+    tiles = []
+    while tile_start < end:
+        tile_end = tile_start + tile_size
+        tiles.append((tile_start.strftime(DATE_FORMAT), tile_end.strftime(DATE_FORMAT)))
+        tile_start = tile_end
+
+    return tiles
+
+
+# Joins results of all tiles into one array, keeps only objects observed
+# between start_date and end_date and removes objects which were
+# returned by more than one tile
+def merge_tiles(arrays, feature, start_date, end_date):
+    array = filter_window(np.ma.concatenate(arrays), start_date, end_date)
+    if len(array) == 0:
+        return array
+
+    ids = np.asarray(array[ID_COLUMNS[feature]])
+    unique, first = np.unique(ids, return_index=True)
+
+    return array[np.sort(first)]
+
+
+# Returns only objects observed between start_date and end_date
+def filter_window(array, start_date, end_date):
+    if len(array) == 0:
+        return array
+
+    dates = np.array([d.decode('utf-8') if type(d) is bytes else str(d) for d in array['DATE_OBS']])
+    dates = np.array([d[:len(start_date)] for d in dates])
+
+    return array[(dates >= start_date) & (dates <= end_date)]
+
+
+# Serializations of VOTable data which are parsed by astropy
+# (iter_votable streams only TABLEDATA)
+BINARY_SERIALIZATIONS = ('BINARY', 'BINARY2', 'FITS')
+
+
+# Parses VOTable from the stream and yields numpy record arrays with at most
+# batch_size rows. TABLEDATA rows are yielded while the stream is still being
+# read and parsed rows are removed from the XML tree, so memory does not grow
+# with the size of the response. Other serializations (BINARY, BINARY2, FITS)
+# are parsed whole by astropy (parse_votable) and then yielded in batches.
+# columns - list of columns to keep, None means all columns
+def iter_votable(stream, batch_size, columns=None):
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    header = []     # chunks read before the table data
+    fields = []
+    positions = []
+    tabledata = None
+    row = []
+    rows = []
+
+    while True:
+        chunk = stream.read(HEADER_CHUNK)
+        if chunk:
+            parser.feed(chunk)
+            if header is not None:
+                header.append(chunk)
+        else:
+            parser.close()
+
+        for event, element in parser.read_events():
+            tag = element.tag.rsplit('}', 1)[-1]  # remove namespace
+            if event == 'start':
+                if tag in BINARY_SERIALIZATIONS:
+                    # astropy can not skip columns of binary data, they are removed after parsing
+                    array = parse_votable(io.BufferedReader(ChainedStream(b''.join(header), stream)))
+                    if columns is not None:
+                        array = array[[c for c in columns if c in array.dtype.names]]
+                    for start in range(0, len(array), batch_size):
+                        yield array[start:start + batch_size]
+                    return
+                elif tag == 'FIELD':
+                    fields.append([element.get('name'), element.get('datatype'), None])
+                elif tag == 'TABLEDATA':
+                    # all fields are known, only selected columns are kept from now
+                    tabledata = element
+                    header = None
+                    positions = [i for i, field in enumerate(fields) if columns is None or field[0] in columns]
+                    fields = [fields[i] for i in positions]
+            elif tag == 'VALUES' and len(fields) > 0:
+                fields[-1][2] = element.get('null')  # value used for empty cells
+            elif tag == 'TD':
+                row.append(element.text)
+            elif tag == 'TR':
+                rows.append([row[i] if i < len(row) else None for i in positions])
+                row = []
+                tabledata.remove(element)
+                if len(rows) == batch_size:
+                    yield rows_to_array(fields, rows)
+                    rows = []
+
+        if not chunk:
+            break
+
+    if len(rows) > 0:
+        yield rows_to_array(fields, rows)
+
+
+# Numpy types of VOTable datatypes, other datatypes are kept as strings
+# (the same types as astropy gives)
+VOTABLE_TYPES = {'boolean': bool, 'unsignedByte': np.uint8, 'short': np.int16, 'int': np.int32,
+                 'long': np.int64, 'float': np.float32, 'double': np.float64}
+
+
+# Converts rows (lists of TD texts) to numpy masked record array,
+# fields - list of [name, datatype, null value] of the columns,
+# empty numeric cells and cells with the null value are masked
+def rows_to_array(fields, rows):
+    dtype = [(field[0], VOTABLE_TYPES.get(field[1], object)) for field in fields]
+    array = np.ma.zeros(len(rows), dtype=dtype)
+
+    for i, (name, column_type) in enumerate(dtype):
+        null = fields[i][2]
+        values = [r[i] for r in rows]
+        if column_type is object:
+            mask = np.array([v is not None and v == null for v in values], dtype=bool)
+            column = np.array(['' if v is None else v for v in values], dtype=object)
+        else:
+            mask = np.array([v is None or v.strip() == '' or v == null for v in values], dtype=bool)
+            if column_type is bool:
+                column = np.array([not m and v.strip().lower() in ('true', 't', '1') for v, m in zip(values, mask)])
+            elif np.issubdtype(column_type, np.integer):
+                column = np.array([0 if m else int(v) for v, m in zip(values, mask)], dtype=column_type)
+            else:
+                column = np.array([0 if m else float(v) for v, m in zip(values, mask)], dtype=column_type)
+        array[name] = np.ma.array(column, mask=mask)
+
+    return array
 
 
 class DataAccess:
-    def __init__(self, start_date, end_date, feature, observatory, instrument):
-        url = 'http://voparis-helio.obspm.fr/helio-hfc/HelioQueryService?FROM=VIEW_' + feature + '_HQI,&STARTTIME=' + start_date + \
-              '&ENDTIME=' + end_date + '&WHERE=OBSERVAT,' + observatory + ';INSTRUME,' + instrument
+    # use_cache - if True, result of the query is taken from the response cache
+    # (and stored there after download)
+    # tile_size - long queries are split into tiles of this length which are
+    # downloaded in parallel, None means no splitting
+    # workers - maximum number of tiles downloaded at the same time
+    # all_columns - if False, only columns used by the getters are downloaded
+    # lazy - if True, nothing is downloaded until the data is used,
+    # iter_batches() can then read the result batch by batch
+    def __init__(self, start_date, end_date, feature, observatory, instrument, use_cache=True,
+                 tile_size=TILE_SIZE, workers=TILE_WORKERS, all_columns=False, lazy=False):
+        self.query = (start_date, end_date, feature, observatory, instrument)
+        self.use_cache = use_cache
+        self.tile_size = tile_size
+        self.workers = workers
+        self.columns = None if all_columns else COLUMNS.get(feature)
+        self._array = None
+
+        if not lazy:
+            self._array = self.load()
+
+    # Result of the query as numpy record array,
+    # lazy object downloads it on first use
+    @property
+    def array(self):
+        if self._array is None:
+            self._array = self.load()
+        return self._array
+
+    @array.setter
+    def array(self, array):
+        self._array = array
+
+    # Downloads the whole result of the query,
+    # tiles of long windows are downloaded in parallel
+    def load(self):
+        start_date, end_date, feature, observatory, instrument = self.query
+        tiles = split_into_tiles(start_date, end_date, self.tile_size)
+
+        if len(tiles) == 1:
+            return self.fetch(start_date, end_date, feature, observatory, instrument, self.use_cache, self.columns)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            arrays = list(pool.map(lambda tile: self.fetch(tile[0], tile[1], feature, observatory,
+                                                           instrument, self.use_cache, self.columns), tiles))
+        return merge_tiles(arrays, feature, start_date, end_date)
+
+    # Yields DataAccess objects with at most batch_size rows of the result,
+    # every batch has the same getters as DataAccess.
+    # If the result is not loaded yet, it is parsed while it is downloaded
+    # (tile after tile for long windows), so only one batch is held in memory.
+    # Streamed results are not stored in the response cache.
+    def iter_batches(self, batch_size):
+        if self._array is not None:
+            for start in range(0, len(self._array), batch_size):
+                yield DataAccess.from_array(self._array[start:start + batch_size])
+            return
+
+        start_date, end_date, feature, observatory, instrument = self.query
+        tiles = split_into_tiles(start_date, end_date, self.tile_size)
+        # objects are returned again only by the next tile, so only
+        # ids of the previous tile are kept
+        previous = set()
+        for tile_start, tile_end in tiles:
+            current = set()
+            for array in self.stream(tile_start, tile_end, feature, observatory, instrument, batch_size):
+                if len(tiles) > 1:
+                    array = filter_window(array, start_date, end_date)
+                    ids = np.asarray(array[ID_COLUMNS[feature]]).tolist()
+                    array = array[np.array([i not in previous and i not in current for i in ids], dtype=bool)]
+                    current.update(ids)
+                if len(array) > 0:
+                    yield DataAccess.from_array(array)
+            previous = current
+
+    # Yields record arrays with at most batch_size rows of one query (or tile),
+    # the query is taken from the response cache if it is there
+    def stream(self, start_date, end_date, feature, observatory, instrument, batch_size):
+        key = get_cache_key(start_date, end_date, feature, observatory, instrument, self.columns)
+        array = response_cache.get(key) if self.use_cache else None
+        if array is not None:
+            for start in range(0, len(array), batch_size):
+                yield array[start:start + batch_size]
+            return
+
+        # only opening of the response is repeated, rows which were
+        # already yielded can not be taken back
+        url = build_url(start_date, end_date, feature, observatory, instrument, self.columns)
+        with retry(lambda: urllib.request.urlopen(url, timeout=TIMEOUT)) as f:
+            for array in iter_votable(f, batch_size, self.columns):
+                yield array
+
+    # Returns result of the query from the response cache or downloads it
+    def fetch(self, start_date, end_date, feature, observatory, instrument, use_cache=True, columns=None):
+        key = get_cache_key(start_date, end_date, feature, observatory, instrument, columns)
+        array = response_cache.get(key) if use_cache else None
+
+        if array is None:
+            array = self.download(start_date, end_date, feature, observatory, instrument, columns)
+            if use_cache:
+                response_cache.put(key, array)
+
+        return array
+
+    # Creates DataAccess object from already downloaded (or cached) record array
+    @classmethod
+    def from_array(cls, array):
+        data = cls.__new__(cls)
+        data._array = array
+        return data
 
-        # url = 'http://voparis-helio.obspm.fr/helio-hfc/HelioQueryService?FROM=VIEW_' + feature + '_HQI,&STARTTIME=' + start_date + \
-        #            '&ENDTIME=' + end_date + '&WHERE=OBSERVAT,SOHO;INSTRUME,MDI'
-        # make url request
-        f = urllib.request.urlopen(url)
-        # decode
-        xmlString = f.read().decode('utf-8')
+    # Downloads result of HFC query and returns it as numpy record array
+    def download(self, start_date, end_date, feature, observatory, instrument, columns=None):
+        url = build_url(start_date, end_date, feature, observatory, instrument, columns)
 
-        # Save VOTable result to file
-        with open("output.xml", "w") as f:
-            f.write(xmlString)
+        # make url request, failed requests are repeated
+        def request():
+            with urllib.request.urlopen(url, timeout=TIMEOUT) as f:
+                return parse_votable(f, columns)
 
-        # Astropy table, simplify VOTable reading
-        self.table = parse_single_table("output.xml")
+        return retry(request)
 
     # Returns the chain codes of objects
     def get_chain_code(self):
-        data1 = self.table.array['CC']
+        data1 = self.array['CC']
         return data1
 
     # Returns X pixel coordinates from where chain starts to draw
     def get_pixel_start_x(self):
-        chain_start_x = self.table.array['CC_X_PIX']
+        chain_start_x = self.array['CC_X_PIX']
         return chain_start_x
 
     # Returns Y pixel coordinates from where chain starts to draw
     def get_pixel_start_y(self):
-        chain_start_y = self.table.array['CC_Y_PIX']
+        chain_start_y = self.array['CC_Y_PIX']
         return chain_start_y
 
     # Returns track_id of objects
     def get_track_id(self):
-        id = self.table.array['TRACK_ID']
+        id = self.array['TRACK_ID']
         return id
 
     # Returns NOAA numbers of objects
     def get_noaa_number(self):
-        noaa = self.table.array['NOAA_NUMBER']
+        noaa = self.array['NOAA_NUMBER']
         return noaa
 
     # Returns file names of original FITS images
     # From where objects were taken
     def get_filename(self):
-        filename = self.table.array['FILENAME']
+        filename = self.array['FILENAME']
         return filename
 
     # Returns observation dates of objects
     def get_date(self):
-        date = self.table.array['DATE_OBS']
+        date = self.array['DATE_OBS']
         return date
 
     # Returns active regions id
     def get_ar_id(self):
-        id = self.table.array['ID_AR']
+        id = self.array['ID_AR']
         return id
 
     # Returns sunspots id
     def get_sp_id(self):
-        id = self.table.array['ID_SUNSPOT']
+        id = self.array['ID_SUNSPOT']
         return id
 
     # Returns filaments id
     def get_fil_id(self):
-        id = self.table.array['ID_FIL']
+        id = self.array['ID_FIL']
         return id
 
     # Returns longitude of gravity center of an object
     def get_grav_center_long(self):
-        center = self.table.array['FEAT_CARR_LONG_DEG']
+        center = self.array['FEAT_CARR_LONG_DEG']
         return center
 
     # Returns latitude of gravity center of an object
     def get_grav_center_lat(self):
-        center = self.table.array['FEAT_CARR_LAT_DEG']
+        center = self.array['FEAT_CARR_LAT_DEG']
         return center
 
 
@@ -0,0 +1,63 @@
+import io
+import re
+import time
+import tracemalloc
+from astropy.io.votable import parse_single_table
+import DataAccess as da
+
+
+# Old way of reading the response: the whole response is read into
+# a string, saved to output file and all columns are parsed
+def parse_old(xml):
+    xmlString = xml.decode('utf-8')
+    table = parse_single_table(io.BytesIO(xmlString.encode('utf-8')))
+    return table.array
+
+
+# New way: only needed columns are parsed, straight from the stream
+def parse_new(xml):
+    return da.parse_votable(io.BytesIO(xml), da.COLUMNS['AR'])
+
+
+# Batches: rows are parsed in batches of 1000, only one batch is kept
+def parse_batches(xml):
+    rows = 0
+    for batch in da.iter_votable(io.BytesIO(xml), 1000, da.COLUMNS['AR']):
+        rows += len(batch)
+    return range(rows)
+
+
+# Returns VOTable with rows of the given VOTable repeated,
+# used to simulate response of a multi-week query
+def enlarge(xml, times):
+    rows = re.search(rb'<TR>.*</TR>', xml, re.DOTALL).group(0)
+    return xml.replace(rows, rows * times)
+
+
+# Returns parse time and peak memory of parse function
+def measure(parse, xml):
+    tracemalloc.start()
+    start = time.perf_counter()
+    array = parse(xml)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return elapsed, peak, len(array)
+
+
+# Parse time and memory benchmark on the VOTable stored in the repository
+if __name__ == '__main__':
+    with open('output.xml', 'rb') as f:
+        xml = f.read()
+
+    for times in [1, 100, 1000, 3000]:
+        data = enlarge(xml, times)
+        old_time, old_peak, rows = measure(parse_old, data)
+        new_time, new_peak, rows = measure(parse_new, data)
+        batch_time, batch_peak, rows = measure(parse_batches, data)
+
+        print("rows: {0}, response: {1:.1f} MB".format(rows, len(data) / 1e6))
+        print("  all columns:      {0:.3f} s, peak {1:.1f} MB".format(old_time, old_peak / 1e6))
+        print("  selected columns: {0:.3f} s, peak {1:.1f} MB".format(new_time, new_peak / 1e6))
+        print("  batches of 1000:  {0:.3f} s, peak {1:.1f} MB".format(batch_time, batch_peak / 1e6))
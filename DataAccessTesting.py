@@ -0,0 +1,209 @@
+import io
+import threading
+import urllib.error
+import tempfile
+from astropy.io.votable import parse
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import DataAccess as da
+import AsyncDataAccess
+from ResponseCache import ResponseCache
+
+
+# Local stand-in of the HFC HelioQueryService,
+# answers every query with the same VOTable file (or with error status)
+# and remembers the paths of all requests
+class VOTableHandler(BaseHTTPRequestHandler):
+    votable = b''
+    requests = []
+    status = 200
+
+    def do_GET(self):
+        VOTableHandler.requests.append(self.path)
+        if self.status != 200:
+            self.send_error(self.status)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(self.votable)))
+        self.end_headers()
+        self.wfile.write(self.votable)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Starts the stand-in server in a background thread
+# and points DataAccess to it, uses empty response cache
+def start_server(votable_file):
+    with open(votable_file, 'rb') as f:
+        VOTableHandler.votable = f.read()
+    VOTableHandler.requests = []
+
+    server = HTTPServer(('127.0.0.1', 0), VOTableHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    da.HFC_URL = 'http://127.0.0.1:' + str(server.server_port) + '/helio-hfc/HelioQueryService'
+    da.response_cache = ResponseCache(tempfile.mkdtemp())
+
+    return server
+
+
+def check(name, condition):
+    if condition:
+        print("SUCCESS", name)
+    else:
+        print("FAIL", name)
+
+    return condition
+
+
+# Three day window is downloaded as three one day tiles, rows
+# returned by every tile are joined and duplicates removed
+def test_tiling():
+    data = da.DataAccess('2009-12-31T12:00:00', '2010-01-02T12:00:00', 'AR', 'SOHO', 'MDI')
+    ids = data.get_ar_id()
+
+    check("tiling: three tiles requested", len(VOTableHandler.requests) == 3)
+    check("tiling: duplicates removed", len(ids) == len(set(ids)) == 3)
+
+
+# Rows observed outside of the window are dropped even if they are in a tile
+def test_window_filter():
+    data = da.DataAccess('2010-01-01T01:00:00', '2010-01-03T00:00:00', 'AR', 'SOHO', 'MDI')
+    dates = data.get_date()
+
+    check("window filter: rows before start dropped", all(str(d) >= '2010-01-01T01:00:00' for d in dates))
+    check("window filter: rows inside kept", len(dates) == 2)
+
+
+# Tiles fetched by a previous query are taken from the cache
+def test_tile_reuse():
+    before = len(VOTableHandler.requests)
+    da.DataAccess('2010-01-01T06:00:00', '2010-01-04T00:00:00', 'AR', 'SOHO', 'MDI')
+
+    # 2010-01-01 and 2010-01-02 tiles were downloaded by the previous tests
+    check("tile reuse: only new tiles requested", len(VOTableHandler.requests) - before == 1)
+
+
+# Cached result which can not be unpickled is removed and downloaded again
+def test_damaged_cache():
+    query = ('2010-01-01T00:00:00', '2010-01-01T01:00:00', 'AR', 'SOHO', 'MDI')
+    da.DataAccess(*query)
+    path = da.response_cache.get_path(da.get_cache_key(*query, da.COLUMNS['AR']))
+    with open(path, 'wb') as f:
+        f.write(b'cmissing_module\nTable\n.')  # pickle of a class which can not be imported
+
+    before = len(VOTableHandler.requests)
+    data = da.DataAccess(*query)
+    check("damaged cache: downloaded again", len(VOTableHandler.requests) - before == 1 and len(data.get_ar_id()) > 0)
+    check("damaged cache: replaced", da.response_cache.get(da.get_cache_key(*query, da.COLUMNS['AR'])) is not None)
+
+
+# Short window is sent as one query, exactly as requested
+def test_short_window():
+    before = len(VOTableHandler.requests)
+    da.DataAccess('2010-01-01T00:00:00', '2010-01-01T02:00:00', 'AR', 'SOHO', 'MDI')
+
+    check("short window: one request", len(VOTableHandler.requests) - before == 1)
+    check("short window: not aligned", 'STARTTIME=2010-01-01T00:00:00&ENDTIME=2010-01-01T02:00:00'
+          in VOTableHandler.requests[-1])
+
+
+# Asyncio fetcher sends all queries and returns DataAccess objects,
+# every tile returns the same objects, they are used once
+def test_async_fetch():
+    before = len(VOTableHandler.requests)
+    features = AsyncDataAccess.get_features({
+        'MDI': ('2010-01-01T00:00:00', '2010-01-01T03:00:00', 'AR', 'SOHO', 'MDI'),
+        'EIT': ('2010-01-01T00:00:00', '2010-01-01T03:00:00', 'AR', 'SOHO', 'EIT'),
+        'LONG': ('2009-12-31T12:00:00', '2010-01-02T12:00:00', 'AR', 'SOHO', 'EIT'),
+        'OUTSIDE': ('2010-01-05T00:00:00', '2010-01-07T00:00:00', 'AR', 'SOHO', 'EIT')})
+    tile = da.parse_votable(VOTableHandler.votable, da.COLUMNS['AR'])
+    ids = list(features['LONG'].get_ar_id())
+
+    check("async fetch: all queries requested", len(VOTableHandler.requests) - before == 7)
+    check("async fetch: same accessors", list(features['MDI'].get_ar_id()) == list(features['EIT'].get_ar_id()))
+    check("async fetch: tiles merged", len(tile) > 0 and len(ids) == len(set(ids)) == len(tile))
+    check("async fetch: repeated objects removed", ids == list(tile['ID_AR']))
+    check("async fetch: objects outside of window removed", len(features['OUTSIDE'].get_ar_id()) == 0)
+
+
+# Batches are parsed from the response while it is downloaded and
+# give the same rows as the whole query
+def test_iter_batches():
+    whole = da.DataAccess('2009-12-31T12:00:00', '2010-01-02T12:00:00', 'AR', 'SOHO', 'MDI')
+    data = da.DataAccess('2009-12-31T12:00:00', '2010-01-02T12:00:00', 'AR', 'SOHO', 'MDI',
+                         use_cache=False, lazy=True)
+    before = len(VOTableHandler.requests)
+    batches = list(data.iter_batches(2))
+    ids = [i for batch in batches for i in batch.get_ar_id()]
+    chains = [c for batch in batches for c in batch.get_chain_code()]
+
+    check("iter batches: tiles streamed", len(VOTableHandler.requests) - before == 3)
+    check("iter batches: batch size", all(len(batch.get_ar_id()) <= 2 for batch in batches))
+    check("iter batches: same rows", ids == list(whole.get_ar_id()) and chains == list(whole.get_chain_code()))
+    check("iter batches: lazy object not loaded", data._array is None)
+
+
+# VOTable with binary data gives the same rows as TABLEDATA
+def test_binary_votable():
+    expected = da.parse_votable(VOTableHandler.votable, da.COLUMNS['AR'])
+    for serialization in ['binary', 'binary2']:
+        votable = parse(io.BytesIO(VOTableHandler.votable))
+        binary = io.BytesIO()
+        votable.to_xml(binary, tabledata_format=serialization)
+        batches = list(da.iter_votable(io.BytesIO(binary.getvalue()), 2, da.COLUMNS['AR']))
+        ids = [i for batch in batches for i in batch['ID_AR']]
+        chains = [c for batch in batches for c in batch['CC']]
+
+        check("binary votable: {0} rows".format(serialization), len(ids) == len(expected) > 0 and
+              ids == list(expected['ID_AR']) and chains == list(expected['CC']))
+        check("binary votable: {0} batch size".format(serialization), all(len(batch) <= 2 for batch in batches))
+
+
+# Server errors are repeated RETRIES times in total, errors of the request are not repeated
+# (both for downloaded and streamed queries)
+def test_retries():
+    delay = da.RETRY_DELAY
+    da.RETRY_DELAY = 0.01
+    try:
+        for status, attempts in [(404, 1), (503, da.RETRIES)]:
+            VOTableHandler.status = status
+            before = len(VOTableHandler.requests)
+            try:
+                da.DataAccess('2010-01-01T00:00:00', '2010-01-01T02:00:00', 'AR', 'SOHO', 'MDI', use_cache=False)
+                check("retries: error {0} raised".format(status), False)
+            except urllib.error.HTTPError as error:
+                check("retries: error {0} raised".format(status), error.code == status)
+            check("retries: error {0} attempts".format(status), len(VOTableHandler.requests) - before == attempts)
+
+            # streamed query is opened the same way
+            before = len(VOTableHandler.requests)
+            data = da.DataAccess('2010-01-01T00:00:00', '2010-01-01T02:00:00', 'AR', 'SOHO', 'MDI',
+                                 use_cache=False, lazy=True)
+            try:
+                list(data.iter_batches(2))
+                check("retries: streamed error {0} raised".format(status), False)
+            except urllib.error.HTTPError:
+                check("retries: streamed error {0} raised".format(status), True)
+            check("retries: streamed error {0} attempts".format(status),
+                  len(VOTableHandler.requests) - before == attempts)
+    finally:
+        VOTableHandler.status = 200
+        da.RETRY_DELAY = delay
+
+
+# DataAccess testing against local HTTP stand-in
+if __name__ == '__main__':
+    server = start_server('output.xml')
+    try:
+        test_tiling()
+        test_window_filter()
+        test_tile_reuse()
+        test_short_window()
+        test_damaged_cache()
+        test_async_fetch()
+        test_iter_batches()
+        test_binary_votable()
+        test_retries()
+    finally:
+        server.shutdown()
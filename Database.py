@@ -1,49 +1,419 @@
 import sqlite3
-import json
+import time
+import queue
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
 import numpy as np
+import Schema
+import CoordinateCodec as codec
+from LRUCache import LRUCache
+
+
+DATABASE_FILE = 'map.db'
+
+# Queued inserts are written when there are BATCH_SIZE of them
+# (or when the batch ends)
+BATCH_SIZE = 500
+
+# Settings of every connection: write-ahead log lets readers work while
+# objects are written, NORMAL synchronous mode does not fsync on every commit
+# (WAL is still safe after a crash of the application)
+PRAGMAS = [('journal_mode', 'WAL'),
+           ('synchronous', 'NORMAL'),
+           ('temp_store', 'MEMORY'),
+           ('cache_size', -64000),  # 64 MB
+           ('busy_timeout', 5000)]  # ms
+
+# Maximum number of decoded objects kept in memory by load_* functions
+OBJECT_CACHE_SIZE = 4096
+
+# Background writer (write_behind) writes queued inserts at least
+# this often (s) and keeps at most WRITE_QUEUE_SIZE inserts in its queue
+FLUSH_INTERVAL = 1.0
+WRITE_QUEUE_SIZE = 10000
+
+
+# Keeps one open connection to the database for each thread.
+# Schema of the database is created (or migrated) on the first connection.
+# Inserts are queued and written with executemany in one transaction,
+# either at once (outside of batch) or when the batch is full or finished:
+#   with connections.batch():
+#       add_ar_to_database(...)
+#       ...
+# Decoded objects are kept in the cache (key is (feature, id)),
+# key of an insert is removed from the cache when the insert is written.
+class ConnectionManager:
+    def __init__(self, path=DATABASE_FILE, batch_size=BATCH_SIZE, cache_size=OBJECT_CACHE_SIZE,
+                 flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.cache = LRUCache(cache_size)
+        self._local = threading.local()
+        self._writer = None     # BackgroundWriter of write_behind blocks
+        self._writer_depth = 0  # number of open write_behind blocks
+        self._writer_lock = threading.Lock()
+
+    # Opens new connection with PRAGMAS and migrated schema
+    def connect(self):
+        connection = sqlite3.connect(self.path)
+        for name, value in PRAGMAS:
+            connection.execute('PRAGMA {0} = {1}'.format(name, value))
+        Schema.ensure_schema(connection, self.path)
+        return connection
+
+    # Returns connection of the current thread, opens it on first use
+    def get_connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self.connect()
+            self._local.connection = connection
+            self._local.pending = {}    # sql -> list of parameters
+            self._local.pending_rows = 0
+            self._local.pending_keys = []   # cache keys of queued inserts
+            self._local.depth = 0       # number of open batches
+            self._local.writer_depth = 0    # number of open write_behind blocks of the thread
+            self._local.writer_batch_depth = 0  # number of batches open when the thread's block started
+
+        return connection
+
+    # Runs query and returns the cursor.
+    # Queued inserts of the current batch are not visible yet.
+    def execute(self, sql, parameters=()):
+        return self.get_connection().execute(sql, parameters)
+
+    # Queues insert, it is written at once outside of batch
+    # (inside of write_behind block of the thread it is passed to the background writer)
+    # key - cache key of the inserted object (None if it is not cached)
+    def insert(self, sql, parameters, key=None):
+        if self._uses_writer():
+            # open block of the thread keeps the writer open
+            with self._writer_lock:
+                self._writer.insert(sql, parameters, key)
+            return
+
+        self._local.pending.setdefault(sql, []).append(parameters)
+        self._local.pending_rows += 1
+        if key is not None:
+            self._local.pending_keys.append(key)
+
+        if self._local.depth == 0 or self._local.pending_rows >= self.batch_size:
+            self.flush()
+
+    # Writes all queued inserts of the current thread in one transaction
+    # and waits for inserts the thread queued in the background writer
+    def flush(self):
+        if getattr(self._local, 'writer_depth', 0) > 0:
+            self._writer.flush()
+        self._write_pending()
+
+    # Returns True if inserts of the current thread go to the background writer:
+    # the thread has open write_behind block and no batch was started inside of it
+    def _uses_writer(self):
+        self.get_connection()
+        return self._local.writer_depth > 0 and self._local.depth == self._local.writer_batch_depth
+
+    # Writes queued inserts of the current thread in one transaction
+    def _write_pending(self):
+        if getattr(self._local, 'pending_rows', 0) == 0:
+            return
+
+        connection = self.get_connection()
+        with connection:
+            for sql, parameters in self._local.pending.items():
+                connection.executemany(sql, parameters)
+        for key in self._local.pending_keys:
+            self.cache.invalidate(key)
+        self.discard()
+
+    # Drops queued inserts of the current thread without writing them
+    def discard(self):
+        self._local.pending = {}
+        self._local.pending_rows = 0
+        self._local.pending_keys = []
+
+    # Inserts inside of the batch are written together, batches can be nested,
+    # queued inserts are written when the outermost batch ends.
+    # If the outermost batch ends with an error, queued inserts are dropped
+    # (inserts already written because the batch was full stay written)
+    @contextmanager
+    def batch(self):
+        self.get_connection()
+        self._local.depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                self.discard()
+            raise
+
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            self.flush()
+
+    # Inserts inside of the block are written by a background thread,
+    # so callers do not wait for the database. Threads share one writer:
+    # inserts of each thread inside of its own block go to the writer, inserts
+    # of other threads and of batches started inside of the block are written
+    # as usual. Blocks can be nested, also in other threads, all inserts are
+    # written (and errors of writes are raised) when the outermost block ends.
+    @contextmanager
+    def write_behind(self):
+        self.get_connection()
+        if self._local.writer_depth == 0:
+            self._write_pending()  # inserts queued before the outermost block of the thread are written first
+            self._local.writer_batch_depth = self._local.depth
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = BackgroundWriter(self, self.batch_size, self.flush_interval)
+            self._writer_depth += 1
+        self._local.writer_depth += 1
+        try:
+            yield self
+        finally:
+            self._local.writer_depth -= 1
+            with self._writer_lock:
+                self._writer_depth -= 1
+                writer = None
+                if self._writer_depth == 0:
+                    writer, self._writer = self._writer, None
+            if writer is not None:
+                writer.close()
+
+    # Writes queued inserts and closes connection of the current thread
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            self.flush()
+            connection.close()
+            self._local.connection = None
+
+
+# Marks put in the queue of BackgroundWriter
+FLUSH = object()
+CLOSE = object()
+
+
+# Thread which writes inserts of the ConnectionManager with its own connection.
+# Callers put inserts in a bounded queue (and wait only if it is full),
+# queued inserts are written in one transaction when there are batch_size
+# of them, when the oldest one waits flush_interval seconds, on flush()
+# or on close(). Error of a write is raised by the next insert, flush or
+# close, inserts queued after the error are not written.
+class BackgroundWriter:
+    def __init__(self, manager, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, queue_size=WRITE_QUEUE_SIZE):
+        self.manager = manager
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.error = None
+        self._queue = queue.Queue(queue_size)
+        self._thread = threading.Thread(target=self._run, name='database-writer', daemon=True)
+        self._thread.start()
+
+    # Queues insert, key - cache key of the inserted object
+    def insert(self, sql, parameters, key=None):
+        self._raise_error()
+        self._queue.put((sql, parameters, key))
+
+    # Waits until all queued inserts are written
+    def flush(self):
+        if self._thread.is_alive():
+            self._queue.put(FLUSH)
+            self._queue.join()
+        self._raise_error()
+
+    # Writes queued inserts and stops the thread
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(CLOSE)
+            self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        pending = {}    # sql -> list of parameters
+        keys = []
+        rows = 0
+        taken = 0       # items taken from the queue which are not done yet
+        deadline = None     # time when the oldest pending insert has to be written
+        connection = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+                taken += 1
+            except queue.Empty:
+                item = FLUSH
+
+            if item is not FLUSH and item is not CLOSE and self.error is None:
+                sql, parameters, key = item
+                pending.setdefault(sql, []).append(parameters)
+                rows += 1
+                if key is not None:
+                    keys.append(key)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            if item is FLUSH or item is CLOSE or rows >= self.batch_size or self.error is not None:
+                if rows > 0:
+                    try:
+                        if connection is None:
+                            connection = self.manager.connect()
+                        with connection:
+                            for sql, parameters in pending.items():
+                                connection.executemany(sql, parameters)
+                        for key in keys:
+                            self.manager.cache.invalidate(key)
+                    except Exception as error:
+                        self.error = error
+                pending = {}
+                keys = []
+                rows = 0
+                deadline = None
+                for _ in range(taken):
+                    self._queue.task_done()
+                taken = 0
+
+            if item is CLOSE:
+                break
+
+        if connection is not None:
+            connection.close()
+
+
+# Connections used by all functions of this module
+connections = ConnectionManager()
+
+
+# Uses other database file (e.g. for testing)
+def set_database(path):
+    global connections
+    connections.close()
+    connections = ConnectionManager(path)
+
+
+# Inserts inside of the with block are written in one transaction
+def batch():
+    return connections.batch()
+
+
+# Inserts inside of the with block are written by a background thread,
+# all of them are written when the block ends
+def write_behind():
+    return connections.write_behind()
+
+
+# Returns dictionary with statistics of the object cache (hits, misses, hit_rate, ...)
+def get_cache_stats():
+    return connections.cache.get_stats()
+
+
+# Changes maximum number of objects in the cache (0 turns the cache off)
+def set_cache_size(size):
+    connections.cache.resize(size)
+
+
+# Removes all objects from the cache and resets its statistics
+def clear_cache():
+    connections.cache.clear()
+
+
+# Returns cached object and its content hash, None if it is not cached
+# (the cache is not used if it has size 0)
+def get_cached(feature, feature_id):
+    if connections.cache.size <= 0:
+        return None
+    return connections.cache.get((feature, str(feature_id)))
+
+
+# Returns generation of the cached object, it is read before the object
+# is loaded and passed to put_cached
+def get_generation(feature, feature_id):
+    return connections.cache.get_generation((feature, str(feature_id)))
+
+
+# Stores loaded object and its content hash in the cache. Coordinate arrays
+# are made read-only, so a caller can not change the cached object.
+# generation - get_generation before the object was loaded, object written
+# (and invalidated) by another thread in the meantime is not cached
+def put_cached(feature, feature_id, result, content_hash=None, generation=None):
+    if connections.cache.size <= 0:
+        return
+    for values in result:
+        for value in values:
+            if isinstance(value, np.ndarray):
+                value.flags.writeable = False
+    connections.cache.put((feature, str(feature_id)), (result, content_hash), generation)
+
+
+# Returns True if stored object with stored_hash was made from data
+# with content_hash (objects stored without hash and queries without hash
+# always match)
+def is_same_content(stored_hash, content_hash):
+    return stored_hash is None or content_hash is None or stored_hash == content_hash
 
 
-# Adds active region to database
-def add_ar_to_database(ar_id, date, track_id, ar_intensity, carr_coords, pix_coords):
-    conn = sqlite3.connect('map.db')
-    curs = conn.cursor()
-
+# Adds active region to database, stored object with the same id is replaced
+# unless it has the same content hash (inside of batch() the insert is queued
+# and written with the batch)
+# observatory, instrument - source of the object (used by load_*_in_range)
+# content_hash - hash of the data the object was made from (ContourBatch.get_content_hash)
+def add_ar_to_database(ar_id, date, track_id, ar_intensity, carr_coords, pix_coords, observatory=None,
+                       instrument=None, content_hash=None):
     ar_id = str(ar_id)
     date = str(date)
     track_id = str(track_id)
 
-    carr_js = json.dumps(carr_coords)
-    pix_js = json.dumps(pix_coords, cls=Encoder)
-    curs.execute('''INSERT INTO ar_test2(ar_id, date, track_id,
-     ar_intensity, coordinates, pixel_coordinates) VALUES(?,?,?,?,?,?)''', (ar_id, date, track_id, ar_intensity, carr_js, pix_js, ))
-
-    conn.commit()
-    conn.close()
+    carr_blob = codec.encode_carrington(carr_coords)
+    pix_blob = codec.encode_pixels(pix_coords)
+    connections.insert(get_upsert_sql('ar_test2', 'ar_id', ['date', 'track_id', 'ar_intensity', 'coordinates',
+                                                            'pixel_coordinates']),
+                       (ar_id, date, track_id, ar_intensity, carr_blob, pix_blob, observatory, instrument,
+                        content_hash, ), ('AR', ar_id))
+    add_to_index('ar_rtree', ar_id, date, carr_coords)
 
 
-def add_sunspot_to_database(sp_id, date, carr_coords, pix_coords):
-    conn = sqlite3.connect('map.db')
-    curs = conn.cursor()
-
+def add_sunspot_to_database(sp_id, date, carr_coords, pix_coords, observatory=None, instrument=None,
+                            content_hash=None):
     sp_id = str(sp_id)
     date = str(date)
 
-    carr_js = json.dumps(carr_coords)
-    pix_js = json.dumps(pix_coords, cls=Encoder)
-    curs.execute('''INSERT INTO sunspots(sp_id, date, carrington_coordinates, pixel_coordinates) VALUES(?,?,?,?)''',
-                 (sp_id, date, carr_js, pix_js, ))
+    carr_blob = codec.encode_carrington(carr_coords)
+    pix_blob = codec.encode_pixels(pix_coords)
+    connections.insert(get_upsert_sql('sunspots', 'sp_id', ['date', 'carrington_coordinates', 'pixel_coordinates']),
+                       (sp_id, date, carr_blob, pix_blob, observatory, instrument, content_hash, ), ('SP', sp_id))
+    add_to_index('sp_rtree', sp_id, date, carr_coords)
+
 
-    conn.commit()
-    conn.close()
+# Returns insert of object which replaces stored object with the same id,
+# stored object is not written again if it has the same content hash
+# (parameters: id, columns, observatory, instrument, content_hash)
+def get_upsert_sql(table, id_column, columns):
+    columns = columns + ['observatory', 'instrument', 'content_hash']
+    return '''INSERT INTO {0}({1}, {2}) VALUES(?, {3}) ON CONFLICT({1}) DO UPDATE SET {4}
+        WHERE excluded.content_hash IS NULL OR content_hash IS NOT excluded.content_hash'''.format(
+        table, id_column, ', '.join(columns), ', '.join('?' * len(columns)),
+        ', '.join('{0} = excluded.{0}'.format(c) for c in columns))
 
 
+# Retrieves active region from the database, coordinates are
+# numpy arrays: Carrington [lon, lat] and pixel [[x, y], ...]
+# Found objects are cached, cached arrays are read-only
 def load_ar_from_database(ar_id):
-    conn = sqlite3.connect('map.db')
-    curs = conn.cursor()
-    sql = 'SELECT track_id, ar_intensity, coordinates, pixel_coordinates FROM ar_test2 WHERE ar_id = ?'
+    cached = get_cached('AR', ar_id)
+    if cached is not None:
+        return cached[0]
+    generation = get_generation('AR', ar_id)
+
+    sql = 'SELECT track_id, ar_intensity, coordinates, pixel_coordinates, content_hash FROM ar_test2 WHERE ar_id = ?'
     id = str(ar_id)
 
-    c = curs.execute(sql, (id,)).fetchall()
+    c = connections.execute(sql, (id,)).fetchall()
 
     track_id = []
     ar_intensity = []
@@ -53,62 +423,69 @@ def load_ar_from_database(ar_id):
     for result in c:
         track_id.append(result[0])
         ar_intensity.append(result[1])
-        decoded_carr_coords.append(json.loads(result[2]))
-        decoded_pix_coords.append(json.loads(result[3]))
-
-    conn.close()
+        decoded_carr_coords.append(codec.decode_carrington(result[2]))
+        decoded_pix_coords.append(codec.decode_pixels(result[3]))
 
-    return track_id, ar_intensity, decoded_carr_coords, decoded_pix_coords
+    result = (track_id, ar_intensity, decoded_carr_coords, decoded_pix_coords)
+    if len(c) > 0:
+        put_cached('AR', id, result, c[0][4], generation)
+    return result
 
 
+# Retrieves sunspot from the database (coordinates as in load_ar_from_database)
 def load_sp_from_database(ar_id):
-    conn = sqlite3.connect('map.db')
-    curs = conn.cursor()
-    sql = 'SELECT carrington_coordinates, pixel_coordinates FROM sunspots WHERE sp_id = ?'
+    cached = get_cached('SP', ar_id)
+    if cached is not None:
+        return cached[0]
+    generation = get_generation('SP', ar_id)
+
+    sql = 'SELECT carrington_coordinates, pixel_coordinates, content_hash FROM sunspots WHERE sp_id = ?'
     id = str(ar_id)
 
-    c = curs.execute(sql, (id,)).fetchall()
+    c = connections.execute(sql, (id,)).fetchall()
 
     decoded_carr_coords = []
     decoded_pix_coords = []
 
     for result in c:
-        decoded_carr_coords.append(json.loads(result[0]))
-        decoded_pix_coords.append(json.loads(result[1]))
+        decoded_carr_coords.append(codec.decode_carrington(result[0]))
+        decoded_pix_coords.append(codec.decode_pixels(result[1]))
 
-    conn.close()
-
-    return decoded_carr_coords, decoded_pix_coords
+    result = (decoded_carr_coords, decoded_pix_coords)
+    if len(c) > 0:
+        put_cached('SP', id, result, c[0][2], generation)
+    return result
 
 
 # Adds active region to database
-def add_fl_to_database(fl_id, date, track_id, carr_coords, pix_coords):
-    conn = sqlite3.connect('map.db')
-    curs = conn.cursor()
-
+def add_fl_to_database(fl_id, date, track_id, carr_coords, pix_coords, observatory=None, instrument=None,
+                       content_hash=None):
     fl_id = str(fl_id)
     date = str(date)
     track_id = str(track_id)
 
-    # encode coordinates to json
-    carr_js = json.dumps(carr_coords)
-    pix_js = json.dumps(pix_coords, cls=Encoder)
-    curs.execute('''INSERT INTO filaments(fl_id, date, track_id, carrington_coordinates, 
-        pixel_coordinates) VALUES(?,?,?,?,?)''', (fl_id, date, track_id, carr_js, pix_js,))
-
-    conn.commit()
-    conn.close()
+    # encode coordinates to binary format
+    carr_blob = codec.encode_carrington(carr_coords)
+    pix_blob = codec.encode_pixels(pix_coords)
+    connections.insert(get_upsert_sql('filaments', 'fl_id', ['date', 'track_id', 'carrington_coordinates',
+                                                             'pixel_coordinates']),
+                       (fl_id, date, track_id, carr_blob, pix_blob, observatory, instrument, content_hash,),
+                       ('FIL', fl_id))
+    add_to_index('fl_rtree', fl_id, date, carr_coords)
 
 
 # Retrieves filaments data from the database
 def load_fl_from_database(fl_id):
-    conn = sqlite3.connect('map.db')
-    curs = conn.cursor()
-    sql = 'SELECT track_id, date, carrington_coordinates  FROM filaments WHERE fl_id = ?'
+    cached = get_cached('FIL', fl_id)
+    if cached is not None:
+        return cached[0]
+    generation = get_generation('FIL', fl_id)
+
+    sql = 'SELECT track_id, date, carrington_coordinates, content_hash FROM filaments WHERE fl_id = ?'
     id = str(fl_id)
 
     # execute sql query
-    c = curs.execute(sql, (id,)).fetchall()
+    c = connections.execute(sql, (id,)).fetchall()
 
     track_id = []
     date = []
@@ -119,23 +496,305 @@ def load_fl_from_database(fl_id):
         track_id.append(result[0])
         date.append(result[1])
         # decode the coordinates
-        decoded_carr_coords.append(json.loads(result[2]))
+        decoded_carr_coords.append(codec.decode_carrington(result[2]))
+
+    result = (track_id, date, decoded_carr_coords)
+    if len(c) > 0:
+        put_cached('FIL', id, result, c[0][3], generation)
+    return result
+
+
+# Retrieves many active regions with one query for each LOOKUP_CHUNK ids
+# (only objects which are not cached are queried).
+# content_hashes - hashes of the data of the objects (in the order of ar_ids),
+# stored object with other hash was made from other data and is returned as missing
+# Returns dictionary str(ar_id) -> the same tuple as load_ar_from_database
+# and list of ids which are not in the database (in the order of ar_ids)
+def load_ars_from_database(ar_ids, content_hashes=None):
+    sql = '''SELECT ar_id, track_id, ar_intensity, coordinates, pixel_coordinates, content_hash
+        FROM ar_test2 WHERE ar_id IN ({0})'''
+    hits, queried = get_all_cached('AR', ar_ids)
+    for row in select_by_ids(sql, queried):
+        hits[row[0]] = (([row[1]], [row[2]], [codec.decode_carrington(row[3])], [codec.decode_pixels(row[4])]), row[5])
+        put_cached('AR', row[0], *hits[row[0]], generation=queried[row[0]])
+
+    return split_hits(hits, ar_ids, content_hashes)
+
+
+# Retrieves many sunspots, works as load_ars_from_database
+def load_sps_from_database(sp_ids, content_hashes=None):
+    sql = 'SELECT sp_id, carrington_coordinates, pixel_coordinates, content_hash FROM sunspots WHERE sp_id IN ({0})'
+    hits, queried = get_all_cached('SP', sp_ids)
+    for row in select_by_ids(sql, queried):
+        hits[row[0]] = (([codec.decode_carrington(row[1])], [codec.decode_pixels(row[2])]), row[3])
+        put_cached('SP', row[0], *hits[row[0]], generation=queried[row[0]])
+
+    return split_hits(hits, sp_ids, content_hashes)
+
+
+# Retrieves many filaments, works as load_ars_from_database
+def load_fls_from_database(fl_ids, content_hashes=None):
+    sql = 'SELECT fl_id, track_id, date, carrington_coordinates, content_hash FROM filaments WHERE fl_id IN ({0})'
+    hits, queried = get_all_cached('FIL', fl_ids)
+    for row in select_by_ids(sql, queried):
+        hits[row[0]] = (([row[1]], [row[2]], [codec.decode_carrington(row[3])]), row[4])
+        put_cached('FIL', row[0], *hits[row[0]], generation=queried[row[0]])
+
+    return split_hits(hits, fl_ids, content_hashes)
+
+
+# Returns dictionary str(id) -> (cached object, content hash) and dictionary
+# str(id) -> generation (get_generation) of ids which are not in the cache
+def get_all_cached(feature, ids):
+    hits = {}
+    queried = {}
+    for feature_id in dict.fromkeys(str(i) for i in ids):
+        cached = get_cached(feature, feature_id)
+        if cached is not None:
+            hits[feature_id] = cached
+        else:
+            queried[feature_id] = get_generation(feature, feature_id)
 
-    conn.close()
+    return hits, queried
 
-    return track_id, date, decoded_carr_coords
 
+# Returns result of bulk loaders: dictionary str(id) -> object with objects
+# which have the same content and list of ids which are not stored or changed
+def split_hits(stored, ids, content_hashes=None):
+    if content_hashes is None:
+        content_hashes = [None] * len(ids)
 
-class Encoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, np.integer):
-            return int(obj)
-        elif isinstance(obj, np.floating):
-            return float(obj)
-        elif isinstance(obj, np.ndarray):
-            return obj.tolist()
+    hits = {}
+    missing = []
+    for feature_id, content_hash in zip(ids, content_hashes):
+        result = stored.get(str(feature_id))
+        if result is not None and is_same_content(result[1], content_hash):
+            hits[str(feature_id)] = result[0]
         else:
-            return super(Encoder, self).default(obj)
+            missing.append(feature_id)
+
+    return hits, missing
+
+
+# Number of ids in one IN (...) query
+# (SQLite allows at most 999 parameters in older versions)
+LOOKUP_CHUNK = 500
+
+
+# Runs query with IN ({0}) for all ids, LOOKUP_CHUNK ids at once,
+# yields rows of all queries
+def select_by_ids(sql, ids):
+    ids = list(dict.fromkeys(str(i) for i in ids))  # unique, in the same order
+    for start in range(0, len(ids), LOOKUP_CHUNK):
+        chunk = ids[start:start + LOOKUP_CHUNK]
+        yield from connections.execute(sql.format(','.join('?' * len(chunk))), chunk)
+
+
+# Adds bounding box and time of the object to the spatial index
+def add_to_index(index, feature_id, date, carr_coords):
+    row = Schema.get_index_row(feature_id, date, carr_coords)
+    if row is not None:
+        connections.insert('INSERT OR REPLACE INTO {0} VALUES(?,?,?,?,?,?,?)'.format(index), row)
+
+
+# Tables of each type of feature: table, id column and spatial index
+FEATURE_TABLES = {'AR': ('ar_test2', 'ar_id', 'ar_rtree'),
+                  'SP': ('sunspots', 'sp_id', 'sp_rtree'),
+                  'FIL': ('filaments', 'fl_id', 'fl_rtree')}
+
+# Bulk loaders of each type of feature
+BULK_LOADERS = {'AR': load_ars_from_database, 'SP': load_sps_from_database, 'FIL': load_fls_from_database}
+
+# Spatial index keeps 32-bit floats, so queried box is made
+# bigger by INDEX_TOLERANCE degrees (days for time)
+INDEX_TOLERANCE = 0.01
+
+
+# Returns ids of objects which Carrington bounding box intersects the box
+# (or is inside of the box if inside is True) and which were observed
+# between start_date and end_date (None means no limit), ordered by date.
+# feature - 'AR', 'SP' or 'FIL'
+# observatory, instrument - only objects from this source, None means all
+def find_in_box(feature, min_lon, max_lon, min_lat, max_lat, start_date=None, end_date=None, inside=False,
+                observatory=None, instrument=None):
+    table, id_column, index = FEATURE_TABLES[feature]
+    if inside:
+        conditions = ['r.min_lon >= ?', 'r.max_lon <= ?', 'r.min_lat >= ?', 'r.max_lat <= ?']
+    else:
+        conditions = ['r.max_lon >= ?', 'r.min_lon <= ?', 'r.max_lat >= ?', 'r.min_lat <= ?']
+    parameters = [min_lon - INDEX_TOLERANCE, max_lon + INDEX_TOLERANCE,
+                  min_lat - INDEX_TOLERANCE, max_lat + INDEX_TOLERANCE]
+
+    # time is checked in the index first, then exactly on the date of the object
+    if start_date is not None:
+        conditions += ['r.max_time >= ?', 'substr(f.date, 1, 19) >= ?']
+        parameters += [Schema.to_index_time(start_date) - INDEX_TOLERANCE, str(start_date)[:19]]
+    if end_date is not None:
+        conditions += ['r.min_time <= ?', 'substr(f.date, 1, 19) <= ?']
+        parameters += [Schema.to_index_time(end_date) + INDEX_TOLERANCE, str(end_date)[:19]]
+    conditions, parameters = add_source_conditions(conditions, parameters, observatory, instrument, 'f.')
+
+    sql = 'SELECT f.{1} FROM {2} r JOIN {0} f ON f.{1} = CAST(r.id AS TEXT) WHERE {3} ORDER BY f.date'.format(
+        table, id_column, index, ' AND '.join(conditions))
+
+    return [row[0] for row in connections.execute(sql, parameters)]
+
+
+# Returns objects found by find_in_box, in the format of the bulk loaders
+# (dictionary str(id) -> tuple of load_*_from_database)
+def load_in_box(feature, min_lon, max_lon, min_lat, max_lat, start_date=None, end_date=None, inside=False,
+                observatory=None, instrument=None):
+    ids = find_in_box(feature, min_lon, max_lon, min_lat, max_lat, start_date, end_date, inside, observatory,
+                      instrument)
+    return BULK_LOADERS[feature](ids)[0]
+
+
+# Adds conditions on observatory and instrument (if they are given)
+def add_source_conditions(conditions, parameters, observatory, instrument, prefix=''):
+    if observatory is not None:
+        conditions = conditions + [prefix + 'observatory = ?']
+        parameters = parameters + [observatory]
+    if instrument is not None:
+        conditions = conditions + [prefix + 'instrument = ?']
+        parameters = parameters + [instrument]
+
+    return conditions, parameters
+
+
+# Runs query of objects observed between start_date and end_date
+# (and from the given observatory and instrument), ordered by date
+def select_in_range(columns, table, start_date, end_date, observatory=None, instrument=None):
+    conditions, parameters = add_source_conditions(['substr(date, 1, 19) BETWEEN ? AND ?'],
+                                                   [str(start_date)[:19], str(end_date)[:19]],
+                                                   observatory, instrument)
+    sql = 'SELECT {0} FROM {1} WHERE {2} ORDER BY date'.format(columns, table, ' AND '.join(conditions))
+
+    return connections.execute(sql, parameters)
+
+
+# Retrieves all active regions observed between start_date and end_date.
+# Returns lists of ids, track_ids, intensities, Carrington and pixel coordinates
+def load_ars_in_range(start_date, end_date, observatory=None, instrument=None):
+    rows = select_in_range('ar_id, track_id, ar_intensity, coordinates, pixel_coordinates', 'ar_test2',
+                           start_date, end_date, observatory, instrument).fetchall()
+
+    return ([r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows],
+            [codec.decode_carrington(r[3]) for r in rows], [codec.decode_pixels(r[4]) for r in rows])
+
+
+# Retrieves all sunspots observed between start_date and end_date.
+# Returns lists of ids, Carrington and pixel coordinates
+def load_sps_in_range(start_date, end_date, observatory=None, instrument=None):
+    rows = select_in_range('sp_id, carrington_coordinates, pixel_coordinates', 'sunspots',
+                           start_date, end_date, observatory, instrument).fetchall()
+
+    return [r[0] for r in rows], [codec.decode_carrington(r[1]) for r in rows], [codec.decode_pixels(r[2]) for r in rows]
+
+
+# Retrieves all filaments observed between start_date and end_date.
+# Returns lists of ids, track_ids, dates and Carrington coordinates
+def load_fls_in_range(start_date, end_date, observatory=None, instrument=None):
+    rows = select_in_range('fl_id, track_id, date, carrington_coordinates', 'filaments',
+                           start_date, end_date, observatory, instrument).fetchall()
+
+    return [r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows], [codec.decode_carrington(r[3]) for r in rows]
+
+
+# Sets source of stored objects, objects stored without source
+# (or from other instrument) are then found by load_*_in_range
+def set_source(feature, ids, observatory, instrument):
+    connections.flush()
+    table, id_column, index = FEATURE_TABLES[feature]
+    ids = [str(i) for i in ids]
+    # rows which already have the source are not updated (and do not remove stored synthesis)
+    sql = '''UPDATE {0} SET observatory = ?, instrument = ?
+        WHERE {1} IN ({{0}}) AND (observatory IS NOT ? OR instrument IS NOT ?)'''.format(table, id_column)
+    with connections.get_connection() as connection:
+        for start in range(0, len(ids), LOOKUP_CHUNK):
+            chunk = ids[start:start + LOOKUP_CHUNK]
+            connection.execute(sql.format(','.join('?' * len(chunk))),
+                               [observatory, instrument] + chunk + [observatory, instrument])
+
+
+# Records that all objects of the instrument observed between
+# start_date and end_date are stored in the database
+def add_coverage(feature, observatory, instrument, start_date, end_date):
+    # objects observed in the future are not stored yet, window is recorded until now
+    end_date = min(str(end_date)[:19], get_current_date())
+    if end_date <= str(start_date)[:19]:
+        return
+
+    connections.flush()
+    with connections.get_connection() as connection:
+        connection.execute('INSERT INTO coverage VALUES(?,?,?,?,?)',
+                           (feature, observatory, instrument, str(start_date)[:19], str(end_date)[:19]))
+
+
+# Returns current date (UTC) in the format of stored dates
+def get_current_date():
+    return datetime.now(timezone.utc).replace(tzinfo=None).isoformat(timespec='seconds')
+
+
+# Returns True if all objects of the instrument observed between
+# start_date and end_date are stored in the database
+# (recorded windows together cover the whole window)
+def is_covered(feature, observatory, instrument, start_date, end_date):
+    start_date = str(start_date)[:19]
+    end_date = str(end_date)[:19]
+    windows = connections.execute('''SELECT start_date, end_date FROM coverage WHERE feature = ? AND observatory = ?
+        AND instrument = ? AND start_date <= ? AND end_date >= ? ORDER BY start_date''',
+                                  (feature, observatory, instrument, end_date, start_date)).fetchall()
+
+    covered = start_date  # window is covered until this date
+    for window_start, window_end in windows:
+        if window_start > covered:
+            return False
+        covered = max(covered, window_end)
+        if covered >= end_date:
+            return True
+
+    return False
+
+
+# Version of the synthesis code (make_ar_synthesis, make_sp_synthesis),
+# it has to be changed when the code makes other synthesis,
+# so synthesis stored by the old code is not used
+SYNTHESIS_VERSION = 1
+
+
+# Stores finished synthesis of the window. It is removed by the database
+# (Schema.add_synthesis_triggers) when an active region or a sunspot observed
+# in the window is added, changed or removed.
+# policy - how active regions of a track are chosen (ActiveRegion.SYNTHESIS_POLICIES)
+def add_synthesis(start_date, end_date, ar_observatory, ar_instrument, sp_observatory, sp_instrument, policy,
+                  ar_synthesis, sp_synthesis):
+    connections.flush()
+    key = get_synthesis_key(start_date, end_date, ar_observatory, ar_instrument, sp_observatory, sp_instrument,
+                            policy)
+    with connections.get_connection() as connection:
+        connection.execute('INSERT OR REPLACE INTO synthesis VALUES(?,?,?,?,?,?,?,?,?,?)',
+                           key + (codec.encode_carrington_list(ar_synthesis),
+                                  codec.encode_carrington_list(sp_synthesis)))
+
+
+# Returns stored synthesis of the window: Carrington coordinates
+# of active regions and sunspots, None if it is not stored
+def load_synthesis(start_date, end_date, ar_observatory, ar_instrument, sp_observatory, sp_instrument, policy):
+    key = get_synthesis_key(start_date, end_date, ar_observatory, ar_instrument, sp_observatory, sp_instrument,
+                            policy)
+    row = connections.execute('''SELECT ar_synthesis, sp_synthesis FROM synthesis WHERE start_date = ?
+        AND end_date = ? AND ar_observatory = ? AND ar_instrument = ? AND sp_observatory = ? AND sp_instrument = ?
+        AND policy = ? AND version = ?''', key).fetchone()
+    if row is None:
+        return None
+
+    return codec.decode_carrington_list(row[0]), codec.decode_carrington_list(row[1])
+
+
+# Returns key of stored synthesis
+def get_synthesis_key(start_date, end_date, ar_observatory, ar_instrument, sp_observatory, sp_instrument, policy):
+    return (str(start_date)[:19], str(end_date)[:19], ar_observatory, ar_instrument, sp_observatory, sp_instrument,
+            policy, SYNTHESIS_VERSION)
 
 
 if __name__ == '__main__':
@@ -156,19 +815,18 @@ if __name__ == '__main__':
 
     print("----------------------------------------------------------------")
 
-    add_ar_to_database(1, 2, 4, 3, [22], [33])
+    add_ar_to_database(1, 2, 4, 3, [[22], [23]], [[33, 34]])
     print("add_ar_to_database() TEST", load_ar_from_database(1))
-    add_sunspot_to_database(1, 2, [22], [33])
+    add_sunspot_to_database(1, 2, [[22], [23]], [[33, 34]])
     print("add_sp_to_database() TEST", load_sp_from_database(1))
-    add_fl_to_database(1, 2, 3, [22], [33])
+    add_fl_to_database(1, 2, 3, [[22], [23]], [[33, 34]])
     print("add_fil_to_database() TEST", load_fl_from_database(1))
 
     # Delete data created for testing
-    conn = sqlite3.connect('map.db')
-    curs = conn.cursor()
-    curs.execute('''DELETE from filaments WHERE fl_id=?''', ("1",))
-    curs.execute('''DELETE from sunspots WHERE sp_id=?''', ("1",))
-    curs.execute('''DELETE from ar_test2 WHERE ar_id=?''', ("1",))
-
-    conn.commit()
-    conn.close()
\ No newline at end of file
+    with connections.get_connection() as conn:
+        conn.execute('''DELETE from filaments WHERE fl_id=?''', ("1",))
+        conn.execute('''DELETE from sunspots WHERE sp_id=?''', ("1",))
+        conn.execute('''DELETE from ar_test2 WHERE ar_id=?''', ("1",))
+        for index in ['ar_rtree', 'sp_rtree', 'fl_rtree']:
+            conn.execute('DELETE FROM {0} WHERE id=?'.format(index), (1,))
+    clear_cache()
\ No newline at end of file
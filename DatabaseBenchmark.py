@@ -0,0 +1,128 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import numpy as np
+import Database as db
+from DatabaseTesting import create_database
+
+
+# JSON encoder of numpy values used by the old way of storing coordinates
+class Encoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, np.integer):
+            return int(obj)
+        elif isinstance(obj, np.floating):
+            return float(obj)
+        elif isinstance(obj, np.ndarray):
+            return obj.tolist()
+        else:
+            return super(Encoder, self).default(obj)
+
+
+# Old way of adding active region: new connection and commit for every object,
+# coordinates are stored as JSON
+def add_ar_old(path, ar_id, date, track_id, ar_intensity, carr_coords, pix_coords):
+    conn = sqlite3.connect(path)
+    curs = conn.cursor()
+    carr_js = json.dumps(carr_coords)
+    pix_js = json.dumps(pix_coords, cls=Encoder)
+    curs.execute('''INSERT INTO ar_test2(ar_id, date, track_id,
+     ar_intensity, coordinates, pixel_coordinates) VALUES(?,?,?,?,?,?)''',
+                 (str(ar_id), str(date), str(track_id), ar_intensity, carr_js, pix_js, ))
+    conn.commit()
+    conn.close()
+
+
+# Old way of loading active region, coordinates are decoded from JSON
+def load_ar_old(path, ar_id):
+    conn = sqlite3.connect(path)
+    sql = 'SELECT track_id, ar_intensity, coordinates, pixel_coordinates FROM ar_test2 WHERE ar_id = ?'
+    c = conn.execute(sql, (str(ar_id),)).fetchall()
+    conn.close()
+
+    return [r[0] for r in c], [r[1] for r in c], [json.loads(r[2]) for r in c], [json.loads(r[3]) for r in c]
+
+
+# Creates contours with the size of a typical active region,
+# neighbouring points of a contour are close to each other
+def create_contours(number, rng):
+    contours = []
+    for _ in range(number):
+        pixels = np.cumsum(rng.integers(-1, 2, size=(300, 2)), axis=0) + rng.integers(500, 3500, size=2)
+        lon = np.cumsum(rng.uniform(-0.05, 0.05, 300)) + rng.uniform(0, 360)
+        lat = np.cumsum(rng.uniform(-0.05, 0.05, 300)) + rng.uniform(-40, 40)
+        contours.append(([lon.tolist(), lat.tolist()], pixels))
+    return contours
+
+
+# Returns size of the database file (write-ahead log is moved to the file first)
+def get_size(path):
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    conn.close()
+    return os.path.getsize(path)
+
+
+# Time of writing and loading active regions and size of the database
+# python DatabaseBenchmark.py [number of active regions]
+if __name__ == '__main__':
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    contours = create_contours(number, np.random.default_rng(0))
+
+    old_path = create_database()
+    start = time.perf_counter()
+    for i, (carr, pix) in enumerate(contours):
+        add_ar_old(old_path, i, '2010-01-01', 1, 5.0, carr, pix)
+    old_write = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(number):
+        load_ar_old(old_path, i)
+    old_load = time.perf_counter() - start
+    db.connections.close()
+
+    new_path = create_database()
+    start = time.perf_counter()
+    with db.batch():
+        for i, (carr, pix) in enumerate(contours):
+            db.add_ar_to_database(i, '2010-01-01', 1, 5.0, carr, pix)
+    new_write = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(number):
+        db.load_ar_from_database(i)
+    new_load = time.perf_counter() - start
+
+    start = time.perf_counter()
+    db.load_ars_from_database(range(number))
+    bulk_load = time.perf_counter() - start
+
+    # objects are in the cache now (as in the second map build of a session)
+    start = time.perf_counter()
+    for i in range(number):
+        db.load_ar_from_database(i)
+    cached_load = time.perf_counter() - start
+    db.connections.close()
+
+    # caller only queues inserts, background thread writes them
+    create_database()
+    start = time.perf_counter()
+    with db.write_behind():
+        for i, (carr, pix) in enumerate(contours):
+            db.add_ar_to_database(i, '2010-01-01', 1, 5.0, carr, pix)
+        queued_write = time.perf_counter() - start
+    behind_write = time.perf_counter() - start
+    db.connections.close()
+
+    print("active regions:", number)
+    print("JSON, connection and commit per object: write {0:.3f} s, load {1:.3f} s, size {2:.1f} MB"
+          .format(old_write, old_load, get_size(old_path) / 1e6))
+    print("binary, one connection, batched (WAL):  write {0:.3f} s, load {1:.3f} s, size {2:.1f} MB"
+          .format(new_write, new_load, get_size(new_path) / 1e6))
+    print("binary, one query for all objects:      load {0:.3f} s".format(bulk_load))
+    print("binary, background writer:              caller {0:.3f} s, all written {1:.3f} s"
+          .format(queued_write, behind_write))
+    print("binary, loaded again from the cache:    load {0:.3f} s".format(cached_load))
+    print("speedup: write {0:.1f}x, load {1:.1f}x".format(old_write / new_write, old_load / new_load))
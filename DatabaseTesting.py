@@ -0,0 +1,500 @@
+import os
+import sqlite3
+import time
+import tempfile
+import threading
+import numpy as np
+import Database as db
+import Schema
+import CompactDatabase
+import Sunspot as sp
+import ActiveRegion as ar
+from ContourBatch import ContourBatch
+from LRUCache import LRUCache
+from DataAccessTesting import check
+
+
+# Uses new temporary database, tables are created by Database
+def create_database():
+    path = os.path.join(tempfile.mkdtemp(), 'map.db')
+    db.set_database(path)
+    db.connections.get_connection()
+
+    return path
+
+
+# Creates database the way it was made before the schema was versioned,
+# one active region is stored copies times, coordinates are stored as JSON
+def create_old_database(copies=1):
+    path = os.path.join(tempfile.mkdtemp(), 'map.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE ar_test2(ar_id, date, track_id, ar_intensity, coordinates, pixel_coordinates)')
+    conn.execute('CREATE TABLE sunspots(sp_id, date, carrington_coordinates, pixel_coordinates)')
+    conn.execute('CREATE TABLE filaments(fl_id, date, track_id, carrington_coordinates, pixel_coordinates)')
+    for intensity in range(1, copies + 1):
+        conn.execute('INSERT INTO ar_test2 VALUES(?,?,?,?,?,?)', ('7', '2010-01-01', '3', intensity,
+                                                                 '[[10.5, 11.5], [-3.25, -4.0]]', '[[1, 2], [3, 4]]'))
+    conn.commit()
+    conn.close()
+
+    return path
+
+
+# Returns number of active regions seen by other connection
+def count_ars(path):
+    conn = sqlite3.connect(path)
+    count = conn.execute('SELECT COUNT(*) FROM ar_test2').fetchone()[0]
+    conn.close()
+    return count
+
+
+# Inserts outside of batch are written at once
+def test_insert(path):
+    db.add_ar_to_database(1, '2010-01-01', 11, 5.0, [[1.0, 2.0], [3.0, 4.0]], [[1, 2], [3, 4]])
+
+    check("insert: written at once", count_ars(path) == 1)
+    result = db.load_ar_from_database(1)
+    check("insert: loaded", result[:2] == (['11'], [5.0]) and
+          np.array_equal(result[2][0], [[1.0, 2.0], [3.0, 4.0]]) and np.array_equal(result[3][0], [[1, 2], [3, 4]]))
+    check("insert: WAL mode", db.connections.execute('PRAGMA journal_mode').fetchone()[0] == 'wal')
+
+
+# Inserts inside of batch are written when the batch ends
+# or when there are batch_size of them
+def test_batch(path):
+    with db.batch():
+        for i in range(2, 12):
+            db.add_sunspot_to_database(i, '2010-01-01', [[1.0], [2.0]], [[1, 2]])
+            db.add_ar_to_database(i, '2010-01-01', 11, 5.0, [[1.0], [2.0]], [[1, 2]])
+        check("batch: not written inside", count_ars(path) == 1)
+    check("batch: written at the end", count_ars(path) == 11)
+
+    db.connections.batch_size = 4
+    with db.batch():
+        for i in range(12, 17):
+            db.add_fl_to_database(i, '2010-01-01', 3, [[1.0], [2.0]], [[1, 2]])
+            db.add_ar_to_database(i, '2010-01-01', 11, 5.0, [[1.0], [2.0]], [[1, 2]])
+        check("batch: full batch written", count_ars(path) >= 12)
+    db.connections.batch_size = db.BATCH_SIZE
+    check("batch: all written", count_ars(path) == 16)
+
+    # inserts of a batch which ends with an error are not written
+    try:
+        with db.batch():
+            with db.batch():
+                db.add_ar_to_database(17, '2010-01-01', 11, 5.0, [[1.0], [2.0]], [[1, 2]])
+            raise ValueError("batch")
+    except ValueError:
+        pass
+    check("batch: dropped after error", count_ars(path) == 16)
+    db.add_ar_to_database(18, '2010-01-01', 11, 5.0, [[1.0], [2.0]], [[1, 2]])
+    check("batch: next insert written alone", count_ars(path) == 17)
+
+
+# Objects are looked up together, stored objects are not reconstructed again
+def test_bulk_lookup():
+    create_database()
+    with db.batch():
+        for i in range(1000):
+            db.add_sunspot_to_database(i, '2010-01-01', [[float(i), i + 1.0], [2.0, 3.0]], [[i, 0], [i, 1]])
+    ids = np.arange(990, 1010)
+    hits, missing = db.load_sps_from_database(ids)
+
+    check("bulk lookup: hits", sorted(hits) == [str(i) for i in range(990, 1000)])
+    check("bulk lookup: misses in order", missing == list(range(1000, 1010)))
+    check("bulk lookup: same as single lookup", np.array_equal(hits['995'][0][0], db.load_sp_from_database(995)[0][0]))
+    check("bulk lookup: many chunks", len(db.load_sps_from_database(range(3 * db.LOOKUP_CHUNK))[0]) == 1000)
+
+    stored = ContourBatch.from_chains(['22', '66', '0'], [1, 1, 1], [1, 1, 1], ['a.fits'] * 3,
+                                      [-1] * 3, [5, 6, 7], ['2010-01-01'] * 3)
+    carr, pixels = sp.get_shapes_from_batch(stored)
+    check("bulk lookup: get_shapes uses stored objects", len(carr) == 3 and carr[1][0][0] == 6.0)
+
+
+# Loaded objects are cached until they are replaced
+def test_cache():
+    create_database()
+    db.add_ar_to_database(1, '2010-01-01', 11, 5.0, [[1.0, 2.0], [3.0, 4.0]], [[1, 2], [3, 4]])
+    first = db.load_ar_from_database(1)
+    second = db.load_ar_from_database(1)
+    hits = db.load_ars_from_database([1, 2])
+
+    check("cache: same object", second is first and hits[0]['1'] is first)
+    check("cache: missing objects not cached", hits[1] == [2] and ('AR', '2') not in db.connections.cache)
+    check("cache: statistics", db.get_cache_stats()['hits'] == 2)
+    check("cache: read-only arrays", not first[2][0].flags.writeable)
+
+    with db.batch():
+        db.add_ar_to_database(1, '2010-01-01', 12, 6.0, [[1.0, 2.0], [3.0, 4.0]], [[1, 2], [3, 4]])
+        check("cache: stored object until the insert is written", db.load_ar_from_database(1)[0] == ['11'])
+    check("cache: invalidated by insert", db.load_ar_from_database(1)[0] == ['12'])
+
+    # object written by another thread after it was read is not cached
+    for intensity, load in [(7.0, db.load_ar_from_database), (8.0, lambda i: db.load_ars_from_database([i]))]:
+        db.clear_cache()
+        write_while_reading(lambda: db.add_ar_to_database(1, '2010-01-01', 12, intensity, [[1.0, 2.0], [3.0, 4.0]],
+                                                          [[1, 2], [3, 4]]))
+        load(1)
+        check("cache: written while read not cached", ('AR', '1') not in db.connections.cache)
+        check("cache: written object loaded", db.load_ar_from_database(1)[1] == [intensity])
+
+    db.set_cache_size(0)
+    check("cache: turned off", db.load_ar_from_database(1) is not db.load_ar_from_database(1))
+    db.set_cache_size(db.OBJECT_CACHE_SIZE)
+
+
+# Value loaded before its key was invalidated is not stored,
+# only the latest invalidations are remembered
+def test_cache_generations():
+    cache = LRUCache(2)
+    generation = cache.get_generation('a')
+    cache.invalidate('b')
+    check("cache generations: other key invalidated", cache.put('a', 1, generation))
+    cache.invalidate('a')
+    check("cache generations: key invalidated", not cache.put('a', 2, generation) and cache.get('a') is None)
+
+    generation = cache.get_generation('a')
+    for key in range(100):
+        cache.invalidate(key)
+    check("cache generations: bounded", len(cache._invalidated) == 2)
+    check("cache generations: loaded before forgotten invalidations", not cache.put('a', 3, generation))
+    check("cache generations: loaded after invalidations", cache.put('a', 4, cache.get_generation('a')))
+
+    generation = cache.get_generation('a')
+    cache.clear()
+    check("cache generations: loaded before clear", not cache.put('a', 5, generation) and len(cache) == 0)
+
+
+# The next query returns rows read before write() is run in another thread
+def write_while_reading(write):
+    execute = db.connections.execute
+
+    def execute_and_write(sql, parameters=()):
+        db.connections.execute = execute
+        rows = ResultRows(execute(sql, parameters).fetchall())
+        writer = threading.Thread(target=write)
+        writer.start()
+        writer.join()
+        return rows
+
+    db.connections.execute = execute_and_write
+
+
+# Rows returned by write_while_reading, used as a cursor
+class ResultRows(list):
+    def fetchall(self):
+        return self
+
+
+# Adds active regions with ids from start to end - 1
+def add_ars(start, end):
+    for i in range(start, end):
+        db.add_ar_to_database(i, '2010-01-01', 11, 5.0, [[1.0], [2.0]], [[1, 2]])
+
+
+# Inserts active regions inside of write_behind block of the thread
+def add_ars_behind(start, end):
+    with db.write_behind():
+        add_ars(start, end)
+
+
+# Inserts inside of blocks of all threads are written by the background writer,
+# on time and at the end of the outermost block, errors reach the caller.
+# Threads without their own block write as usual.
+def test_write_behind(path):
+    db.connections.flush_interval = 0.05
+    with db.write_behind():
+        db.add_ar_to_database(1, '2010-01-01', 11, 5.0, [[1.0], [2.0]], [[1, 2]])
+        waited = 0
+        while count_ars(path) == 0 and waited < 100:
+            time.sleep(0.02)
+            waited += 1
+        check("write behind: written on time", count_ars(path) == 1)
+
+        db.load_ar_from_database(1)
+        db.add_ar_to_database(1, '2010-01-01', 12, 5.0, [[1.0], [2.0]], [[1, 2]])
+        threads = [threading.Thread(target=add_ars_behind, args=(start, start + 100)) for start in range(2, 402, 100)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    db.connections.flush_interval = db.FLUSH_INTERVAL
+
+    check("write behind: all written at the end", count_ars(path) == 401)
+    check("write behind: cache invalidated", db.load_ar_from_database(1)[0] == ['12'])
+
+    # nested block does not wait for inserts queued by the outer block,
+    # inserts of a batch queued before the outermost block are written first
+    db.connections.flush_interval = 60
+    with db.batch():
+        add_ars(402, 403)
+        with db.write_behind():
+            check("write behind: batch written first", count_ars(path) == 402)
+            add_ars(403, 404)
+            with db.write_behind():
+                check("write behind: nested block does not wait", count_ars(path) == 402)
+    db.connections.flush_interval = db.FLUSH_INTERVAL
+    check("write behind: nested block written at the end", count_ars(path) == 403)
+
+    # batch of other thread is dropped after error and its inserts are not queued in the writer
+    def add_ars_and_fail():
+        try:
+            with db.batch():
+                add_ars(404, 406)
+                raise ValueError("batch")
+        except ValueError:
+            pass
+        add_ars(406, 407)
+        written.append(count_ars(path))
+
+    written = []
+    db.connections.flush_interval = 60
+    with db.write_behind():
+        thread = threading.Thread(target=add_ars_and_fail)
+        thread.start()
+        thread.join()
+    db.connections.flush_interval = db.FLUSH_INTERVAL
+    check("write behind: other thread writes at once", written == [404])
+    check("write behind: batch of other thread dropped", count_ars(path) == 404)
+
+    try:
+        with db.write_behind():
+            db.connections.insert('INSERT INTO missing_table VALUES(?)', (1,))
+        check("write behind: error raised", False)
+    except sqlite3.OperationalError:
+        check("write behind: error raised", True)
+
+
+# Objects are found by their bounding boxes and dates
+def test_spatial_index():
+    create_database()
+    with db.batch():
+        db.add_ar_to_database(1, '2010-01-01T00:00:00', 1, 5.0, [[100.0, 110.0, 105.0], [10.0, 10.0, 20.0]], [])
+        # sunspots: inside of the active region, crossing its border, far away, inside but a year later
+        db.add_sunspot_to_database(2, '2010-01-01T00:00:00', [[104.0, 106.0, 105.0], [12.0, 12.0, 13.0]], [])
+        db.add_sunspot_to_database(3, '2010-01-01T06:00:00', [[108.0, 112.0, 110.0], [12.0, 12.0, 13.0]], [])
+        db.add_sunspot_to_database(4, '2010-01-01T00:00:00', [[200.0, 201.0, 200.5], [12.0, 12.0, 13.0]], [])
+        db.add_sunspot_to_database(5, '2011-01-01T00:00:00', [[104.0, 106.0, 105.0], [12.0, 12.0, 13.0]], [])
+
+    check("spatial index: intersecting", db.find_in_box('SP', 100, 110, 10, 20) == ['2', '3', '5'])
+    check("spatial index: inside", db.find_in_box('SP', 100, 110, 10, 20, inside=True) == ['2', '5'])
+    check("spatial index: time window", db.find_in_box('SP', 0, 360, -90, 90, '2010-01-01T00:00:00',
+                                                       '2010-01-01T05:59:59') == ['2', '4'])
+    check("spatial index: load", list(db.load_in_box('AR', 109, 120, 0, 11)) == ['1'])
+
+    ar = db.load_ar_from_database(1)[2]
+    candidates = sp.get_sunspot_candidates(ar, '2010-01-01T00:00:00', '2010-01-02T00:00:00')
+    check("spatial index: sunspot candidates", len(candidates) == 1 and candidates[0][0][0] == 104.0)
+    check("spatial index: sunspot synthesis", len(sp.make_sp_synthesis_from_database(
+        ar, '2010-01-01T00:00:00', '2010-01-02T00:00:00')) == 1)
+
+
+# Objects of a time window and instrument are loaded without their ids,
+# synthesis is made only from the database
+def test_time_range():
+    create_database()
+    with db.batch():
+        db.add_ar_to_database(1, '2010-01-01T00:00:00', 11, 5.0, [[100.0, 110.0, 105.0], [10.0, 10.0, 20.0]], [],
+                              'SOHO', 'MDI')
+        db.add_ar_to_database(2, '2010-01-01T06:00:00', 11, 7.0, [[101.0, 111.0, 106.0], [10.0, 10.0, 20.0]], [],
+                              'SOHO', 'MDI')
+        db.add_ar_to_database(3, '2010-01-01T06:00:00', 12, 1.0, [[10.0, 20.0, 15.0], [0.0, 0.0, 5.0]], [],
+                              'SOHO', 'EIT')
+        db.add_ar_to_database(4, '2010-01-03T00:00:00', 11, 9.0, [[102.0, 112.0, 107.0], [10.0, 10.0, 20.0]], [],
+                              'SOHO', 'MDI')
+        db.add_sunspot_to_database(5, '2010-01-01T00:00:00', [[104.0, 106.0, 105.0], [12.0, 12.0, 13.0]], [],
+                                   'SOHO', 'MDI')
+    ids, track_ids, intensities, carr, pix = db.load_ars_in_range('2010-01-01T00:00:00', '2010-01-02T00:00:00',
+                                                                  'SOHO', 'MDI')
+
+    check("time range: window and instrument", ids == ['1', '2'] and track_ids == ['11', '11'])
+    check("time range: all instruments", len(db.load_ars_in_range('2010-01-01T00:00:00', '2010-01-02T00:00:00')[0])
+          == 3)
+    carr_synthesis, pix_synthesis = ar.make_ar_synthesis_from_database('2010-01-01T00:00:00', '2010-01-02T00:00:00',
+                                                                       'SOHO', 'MDI')
+    check("time range: synthesis", len(carr_synthesis) == 1 and carr_synthesis[0][0][0] == 101.0)
+    check("time range: sunspot synthesis", len(sp.make_sp_synthesis_from_database(
+        carr_synthesis, '2010-01-01T00:00:00', '2010-01-02T00:00:00', 'SOHO', 'MDI')) == 1)
+
+    db.set_source('AR', [3], 'SOHO', 'MDI')
+    check("time range: source set", db.load_ars_in_range('2010-01-01T00:00:00', '2010-01-02T00:00:00',
+                                                          'SOHO', 'MDI')[0] == ['1', '2', '3'])
+
+
+# Windows which were stored together cover longer windows
+def test_coverage():
+    db.add_coverage('AR', 'SOHO', 'MDI', '2010-01-01T00:00:00', '2010-01-02T00:00:00')
+    db.add_coverage('AR', 'SOHO', 'MDI', '2010-01-01T12:00:00', '2010-01-04T00:00:00')
+    db.add_coverage('AR', 'SOHO', 'MDI', '2010-01-05T00:00:00', '2010-01-06T00:00:00')
+
+    check("coverage: inside one window", db.is_covered('AR', 'SOHO', 'MDI', '2010-01-01T01:00:00', '2010-01-01T02:00:00'))
+    check("coverage: joined windows", db.is_covered('AR', 'SOHO', 'MDI', '2010-01-01T00:00:00', '2010-01-04T00:00:00'))
+    check("coverage: gap", not db.is_covered('AR', 'SOHO', 'MDI', '2010-01-03T00:00:00', '2010-01-05T12:00:00'))
+    check("coverage: other instrument", not db.is_covered('AR', 'SOHO', 'EIT', '2010-01-01T01:00:00',
+                                                          '2010-01-01T02:00:00'))
+
+    # objects observed in the future are not stored yet
+    db.add_coverage('SP', 'SOHO', 'MDI', '2010-01-01T00:00:00', '2999-01-01T00:00:00')
+    db.add_coverage('SP', 'SOHO', 'MDI', '2998-01-01T00:00:00', '2999-01-01T00:00:00')
+    check("coverage: until now", db.is_covered('SP', 'SOHO', 'MDI', '2010-01-01T00:00:00', db.get_current_date()[:10]))
+    check("coverage: future not covered", not db.is_covered('SP', 'SOHO', 'MDI', '2010-01-01T00:00:00',
+                                                            '2999-01-01T00:00:00') and
+          not db.is_covered('SP', 'SOHO', 'MDI', '2998-01-01T00:00:00', '2998-01-02T00:00:00'))
+
+
+# Unchanged objects are not written again, changed objects are replaced
+def test_content_hash():
+    path = create_database()
+    batch = ContourBatch.from_chains(['22', '66'], [1, 1], [1, 1], ['a.fits'] * 2, [-1] * 2, [5, 6],
+                                     ['2010-01-01'] * 2)
+    changed = ContourBatch.from_chains(['22', '66'], [1, 2], [1, 1], ['a.fits'] * 2, [-1] * 2, [5, 6],
+                                       ['2010-01-01'] * 2)
+    hashes = batch.get_content_hashes()
+    for i in range(2):
+        db.add_sunspot_to_database(batch.feature_id[i], '2010-01-01', [[1.0], [2.0]], [[1, 2]], content_hash=hashes[i])
+
+    # the same object with other date is not written, so the date stays
+    db.add_sunspot_to_database(5, '2011-01-01', [[1.0], [2.0]], [[1, 2]], content_hash=hashes[0])
+    conn = sqlite3.connect(path)
+    stored = conn.execute('SELECT COUNT(*), MAX(date) FROM sunspots WHERE sp_id = ?', ('5',)).fetchone()
+    conn.close()
+    check("content hash: unchanged object not written", stored == (1, '2010-01-01'))
+
+    hits, missing = db.load_sps_from_database(changed.feature_id, changed.get_content_hashes())
+    check("content hash: changed object is missing", list(hits) == ['5'] and missing == [6])
+    check("content hash: unchanged batch hits", len(db.load_sps_from_database(batch.feature_id, hashes)[1]) == 0)
+    check("content hash: old objects hit", db.load_sps_from_database([5], [None])[1] == [])
+
+    db.add_sunspot_to_database(6, '2010-01-01', [[3.0], [4.0]], [[1, 2]], content_hash=changed.get_content_hash(1))
+    check("content hash: changed object replaced", db.load_sp_from_database(6)[0][0][0][0] == 3.0)
+
+
+# Compaction removes repeated objects, unused index rows and repeated coverage
+def test_compaction():
+    path = create_old_database()
+    db.set_database(path)
+    db.add_coverage('AR', 'SOHO', 'MDI', '2010-01-01T00:00:00', '2010-01-02T00:00:00')
+    db.add_coverage('AR', 'SOHO', 'MDI', '2010-01-01T12:00:00', '2010-01-03T00:00:00')
+    db.add_coverage('AR', 'SOHO', 'MDI', '2010-01-05T00:00:00', '2010-01-06T00:00:00')
+    db.connections.execute('INSERT INTO ar_rtree VALUES(99, 0, 1, 0, 1, 0, 1)')
+    db.connections.get_connection().commit()
+    db.connections.close()
+
+    result = CompactDatabase.compact_database(path)
+    check("compaction: index rows removed", result['removed_index_rows'] == 1)
+    check("compaction: windows joined", result['removed_windows'] == 1)
+    check("compaction: coverage kept", db.is_covered('AR', 'SOHO', 'MDI', '2010-01-01T00:00:00', '2010-01-03T00:00:00'))
+
+    # repeated objects of a database made before versioning are removed
+    old_path = create_old_database(copies=2)
+    result = CompactDatabase.compact_database(old_path)
+    conn = sqlite3.connect(old_path)
+    check("compaction: repeated objects removed", result['removed_objects'] == 1 and
+          conn.execute('SELECT COUNT(*) FROM ar_test2').fetchone()[0] == 1)
+    check("compaction: latest copy kept", conn.execute('SELECT ar_intensity FROM ar_test2').fetchone()[0] == 2.0)
+    check("compaction: migrated", Schema.get_version(conn) == Schema.SCHEMA_VERSION)
+    conn.close()
+
+
+# Stored synthesis is used until an object of its window changes
+def test_synthesis_cache():
+    create_database()
+    window = ('2010-01-01T00:00:00', '2010-01-02T00:00:00', 'SOHO', 'MDI', 'SOHO', 'MDI')
+    db.add_ar_to_database(1, '2010-01-01T06:00:00', 11, 5.0, [[1.0, 2.0], [3.0, 4.0]], [[1, 2], [3, 4]],
+                          content_hash='a')
+    db.add_synthesis(*window, 'maximum', [[[1.0, 2.0], [3.0, 4.0]]], [])
+    stored = db.load_synthesis(*window, 'maximum')
+
+    check("synthesis cache: stored", len(stored[0]) == 1 and np.array_equal(stored[0][0], [[1.0, 2.0], [3.0, 4.0]])
+          and stored[1] == [])
+    check("synthesis cache: other policy", db.load_synthesis(*window, 'average') is None)
+
+    db.add_ar_to_database(2, '2010-01-05T00:00:00', 12, 5.0, [[1.0], [2.0]], [[1, 2]])
+    db.add_ar_to_database(1, '2010-01-01T06:00:00', 11, 5.0, [[1.0, 2.0], [3.0, 4.0]], [[1, 2], [3, 4]],
+                          content_hash='a')
+    check("synthesis cache: kept after other window and unchanged objects",
+          db.load_synthesis(*window, 'maximum') is not None)
+
+    # map of the window sets source of its objects before storing the synthesis again
+    db.set_source('AR', [1], 'SOHO', 'MDI')
+    db.add_synthesis(*window, 'maximum', [[[1.0, 2.0], [3.0, 4.0]]], [])
+    db.set_source('AR', [1], 'SOHO', 'MDI')
+    db.add_ar_to_database(4, '2010-01-01T06:00:00', 11, 5.0, [[1.0], [2.0]], [[1, 2]], 'SOHO', 'EIT')
+    check("synthesis cache: kept after the same source and objects of other source",
+          db.load_synthesis(*window, 'maximum') is not None)
+
+    db.add_sunspot_to_database(3, '2010-01-01T12:00:00', [[1.0], [2.0]], [[1, 2]])
+    check("synthesis cache: removed after change in the window", db.load_synthesis(*window, 'maximum') is None)
+
+    db.add_synthesis(*window, 'maximum', [[[1.0, 2.0], [3.0, 4.0]]], [])
+    db.set_source('AR', [4], 'SOHO', 'MDI')
+    check("synthesis cache: removed after change of the source", db.load_synthesis(*window, 'maximum') is None)
+
+    mer = ar.merge_id_with_object([[1], [2], [3]], [0, 1, 2], ['7', '7', '7'], [1.0, 2.0, 9.0])
+    check("synthesis cache: policies", ar.make_ar_synthesis(mer, 'maximum')[1] == [2] and
+          ar.make_ar_synthesis(mer, 'average')[1] == [1])
+
+
+# Old database is migrated in place, migration can run again
+def test_migration():
+    # repeated objects are not removed by the migration
+    repeated_path = create_old_database(copies=2)
+    conn = sqlite3.connect(repeated_path)
+    try:
+        Schema.migrate(conn)
+        failed = False
+    except ValueError:
+        failed = True
+    check("migration: fails with repeated objects", failed and Schema.get_version(conn) == 0 and
+          conn.execute('SELECT COUNT(*) FROM ar_test2').fetchone()[0] == 2)
+    conn.close()
+
+    path = create_old_database()
+    db.set_database(path)
+    result = db.load_ar_from_database(7)
+    conn = sqlite3.connect(path)
+    plan = conn.execute('EXPLAIN QUERY PLAN SELECT * FROM ar_test2 WHERE ar_id = ?', ('7',)).fetchall()
+
+    check("migration: version", Schema.get_version(conn) == Schema.SCHEMA_VERSION)
+    check("migration: object kept", result[1] == [1.0])
+    check("migration: coordinates converted", conn.execute('SELECT typeof(coordinates) FROM ar_test2').fetchone()[0]
+          == 'blob' and np.array_equal(result[2][0], [[10.5, 11.5], [-3.25, -4.0]]) and
+          np.array_equal(result[3][0], [[1, 2], [3, 4]]))
+    check("migration: lookup uses index", 'ar_id_index' in str(plan))
+    check("migration: idempotent", Schema.migrate(conn) == Schema.SCHEMA_VERSION)
+    check("migration: spatial index filled", db.find_in_box('AR', 10, 12, -5, -3) == ['7'])
+
+    db.add_ar_to_database(7, '2010-01-01', 3, 5.0, [], [])
+    check("migration: object replaced", db.load_ar_from_database(7)[1] == [5.0])
+    conn.close()
+
+
+# Every thread has its own connection
+def test_threads():
+    connections = []
+    thread = threading.Thread(target=lambda: connections.append(db.connections.get_connection()))
+    thread.start()
+    thread.join()
+
+    check("threads: own connection", connections[0] is not db.connections.get_connection())
+    check("threads: same connection in one thread", db.connections.get_connection() is db.connections.get_connection())
+
+
+# Database testing on a temporary database
+if __name__ == '__main__':
+    path = create_database()
+    test_insert(path)
+    test_batch(path)
+    test_threads()
+    test_bulk_lookup()
+    test_cache()
+    test_cache_generations()
+    test_write_behind(create_database())
+    test_spatial_index()
+    test_time_range()
+    test_coverage()
+    test_migration()
+    test_content_hash()
+    test_compaction()
+    test_synthesis_cache()
+    db.connections.close()
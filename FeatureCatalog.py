@@ -0,0 +1,257 @@
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+import DataAccess as da
+
+
+# Default place of the local catalog of HFC features
+CATALOG_DIRECTORY = 'hfc_catalog'
+CATALOG_FORMAT_VERSION = 1
+
+# Length of DATE_OBS used in the time index (DataAccess.DATE_FORMAT)
+INDEX_DATE_LENGTH = 19
+
+
+# Local columnar catalog of HFC features, used without network.
+# Features are stored in directory
+#   catalog/feature/observatory_instrument/YYYY-MM-DD/
+# with one partition (directory) for each day of observation.
+# Every column of a partition is a separate .npy file, so a query reads
+# only the columns it needs and the files are memory mapped:
+#   - numeric columns are stored as they are (COLUMN.npy), masked values
+#     have their mask in COLUMN.mask.npy
+#   - string columns (CC, FILENAME, DATE_OBS) are stored as one uint8 array
+#     with bytes of all rows (COLUMN.bytes.npy) and offsets of the rows
+#     (COLUMN.offsets.npy), as chain codes have very different lengths
+#   - DATE_OBS.index.npy is sorted DATE_OBS of all rows (rows of the
+#     partition are sorted by DATE_OBS), only rows inside of the queried
+#     window are read from the partition
+class FeatureCatalog:
+    def __init__(self, directory=CATALOG_DIRECTORY):
+        self.directory = directory
+
+    # Returns directory of features of one instrument
+    def get_directory(self, feature, observatory, instrument):
+        return os.path.join(self.directory, feature, observatory + '_' + instrument)
+
+    # Returns sorted list of days which are stored for the instrument
+    def get_partitions(self, feature, observatory, instrument):
+        directory = self.get_directory(feature, observatory, instrument)
+        if not os.path.isdir(directory):
+            return []
+
+        return sorted(name for name in os.listdir(directory)
+                      if os.path.isfile(os.path.join(directory, name, 'columns.json')))
+
+    # Stores record array (e.g. DataAccess.array) in the catalog.
+    # Rows are split by the day of observation, rows of days which are
+    # already in the catalog are merged with the stored ones, stored rows
+    # with the same id as new rows are replaced.
+    # Returns number of stored rows.
+    def ingest(self, array, feature, observatory, instrument):
+        if len(array) == 0:
+            return 0
+
+        days = np.array([to_string(d)[:10] for d in array['DATE_OBS']])
+        for day in np.unique(days):
+            rows = array[days == day]
+            stored = self.read_partition(feature, observatory, instrument, day)
+            if stored is not None:
+                rows = merge_rows(stored, rows, da.ID_COLUMNS[feature])
+            self.write_partition(rows, feature, observatory, instrument, day)
+
+        return len(array)
+
+    # Downloads the query from HFC and stores it in the catalog,
+    # the response is read in batches, so long windows can be ingested
+    # without keeping the whole response in memory
+    def download(self, start_date, end_date, feature, observatory, instrument, batch_size=1000):
+        data = da.DataAccess(start_date, end_date, feature, observatory, instrument, use_cache=False, lazy=True)
+        rows = 0
+        for batch in data.iter_batches(batch_size):
+            rows += self.ingest(batch.array, feature, observatory, instrument)
+
+        return rows
+
+    # Returns rows observed between start_date and end_date as masked
+    # record array with the same columns as DataAccess.array.
+    # Only partitions of days inside of the window are opened.
+    # columns - list of columns to read, None means all stored columns
+    def read(self, start_date, end_date, feature, observatory, instrument, columns=None):
+        arrays = list(self.iter_partitions(start_date, end_date, feature, observatory, instrument, columns))
+        if len(arrays) == 0:
+            return self.read_empty(feature, observatory, instrument, columns)
+
+        return np.ma.concatenate(arrays)
+
+    # Yields rows observed between start_date and end_date,
+    # one array for each partition inside of the window
+    def iter_partitions(self, start_date, end_date, feature, observatory, instrument, columns=None):
+        for day in self.get_partitions(feature, observatory, instrument):
+            if start_date[:10] <= day <= end_date[:10]:
+                array = self.read_partition(feature, observatory, instrument, day, start_date, end_date, columns)
+                if len(array) > 0:
+                    yield array
+
+    # Returns empty array with columns of the instrument
+    def read_empty(self, feature, observatory, instrument, columns=None):
+        partitions = self.get_partitions(feature, observatory, instrument)
+        if len(partitions) == 0:
+            return np.ma.zeros(0, dtype=[(c, object) for c in (columns or da.COLUMNS[feature])])
+
+        return self.read_partition(feature, observatory, instrument, partitions[0], '', '', columns)
+
+    # Reads rows of one partition observed between start_date and end_date,
+    # None dates mean all rows. Returns None if there is no such partition.
+    def read_partition(self, feature, observatory, instrument, day, start_date=None, end_date=None, columns=None):
+        directory = os.path.join(self.get_directory(feature, observatory, instrument), day)
+        try:
+            with open(os.path.join(directory, 'columns.json')) as f:
+                description = json.load(f)
+        except OSError:
+            return None
+
+        # window is found in the sorted DATE_OBS index
+        index = np.load(os.path.join(directory, 'DATE_OBS.index.npy'), mmap_mode='r')
+        first = 0 if start_date is None else np.searchsorted(index, start_date[:INDEX_DATE_LENGTH].encode(), 'left')
+        last = len(index) if end_date is None else np.searchsorted(index, end_date[:INDEX_DATE_LENGTH].encode(),
+                                                                     'right')
+        last = max(first, last)
+
+        stored = [c for c in description['columns'] if columns is None or c['name'] in columns]
+        dtype = [(c['name'], object if c['kind'] == 'string' else np.dtype(c['dtype'])) for c in stored]
+        array = np.ma.zeros(last - first, dtype=dtype)
+        for c in stored:
+            array[c['name']] = read_column(directory, c, first, last)
+
+        return array
+
+    # Writes rows of one day as a new partition, replaces the old one
+    def write_partition(self, array, feature, observatory, instrument, day):
+        directory = self.get_directory(feature, observatory, instrument)
+        os.makedirs(directory, exist_ok=True)
+
+        dates = np.array([to_string(d)[:INDEX_DATE_LENGTH] for d in array['DATE_OBS']])
+        order = np.argsort(dates, kind='stable')
+        array = array[order]
+
+        # partition is written to a temporary directory first,
+        # so readers never see half written partition
+        temporary = tempfile.mkdtemp(dir=directory, suffix='.tmp')
+        try:
+            description = {'version': CATALOG_FORMAT_VERSION, 'rows': len(array),
+                           'columns': [write_column(temporary, name, array[name]) for name in array.dtype.names]}
+            np.save(os.path.join(temporary, 'DATE_OBS.index.npy'), dates[order].astype('S' + str(INDEX_DATE_LENGTH)))
+            with open(os.path.join(temporary, 'columns.json'), 'w') as f:
+                json.dump(description, f)
+
+            path = os.path.join(directory, day)
+            if os.path.isdir(path):
+                old = path + '.old'
+                os.replace(path, old)
+                os.replace(temporary, path)
+                shutil.rmtree(old)
+            else:
+                os.replace(temporary, path)
+        except BaseException:
+            shutil.rmtree(temporary, ignore_errors=True)
+            raise
+
+    # Removes all stored features
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+# DataAccess which answers queries from the local catalog, without network.
+# It has the same getters (and iter_batches) as DataAccess.
+class OfflineDataAccess(da.DataAccess):
+    def __init__(self, start_date, end_date, feature, observatory, instrument, catalog=None, all_columns=False):
+        self.query = (start_date, end_date, feature, observatory, instrument)
+        self.catalog = catalog if catalog is not None else FeatureCatalog()
+        self.columns = None if all_columns else da.COLUMNS.get(feature)
+        self._array = None
+
+    # Reads the whole result of the query from the catalog
+    def load(self):
+        return self.catalog.read(*self.query, columns=self.columns)
+
+    # Yields DataAccess objects with at most batch_size rows,
+    # partitions are read one after another
+    def iter_batches(self, batch_size):
+        if self._array is not None:
+            yield from da.DataAccess.iter_batches(self, batch_size)
+            return
+
+        for array in self.catalog.iter_partitions(*self.query, columns=self.columns):
+            for start in range(0, len(array), batch_size):
+                yield da.DataAccess.from_array(array[start:start + batch_size])
+
+
+# Returns str of VOTable value (astropy gives str or bytes)
+def to_string(value):
+    return value.decode('utf-8') if type(value) is bytes else str(value)
+
+
+# Joins stored and new rows of a partition, stored rows with the same id
+# as new rows are dropped. Only columns present in both are kept.
+def merge_rows(stored, rows, id_column):
+    names = [n for n in rows.dtype.names if n in stored.dtype.names]
+    new_ids = set(np.asarray(rows[id_column]).tolist())
+    kept = stored[np.array([i not in new_ids for i in np.asarray(stored[id_column]).tolist()], dtype=bool)]
+
+    merged = np.ma.zeros(len(kept) + len(rows), dtype=[(n, rows.dtype[n]) for n in names])
+    for n in names:
+        merged[n] = np.ma.concatenate([kept[n], rows[n]])
+
+    return merged
+
+
+# Writes one column to the partition directory, returns its description
+def write_column(directory, name, column):
+    path = os.path.join(directory, name)
+    if column.dtype == object or column.dtype.kind in 'SU':
+        encoded = [to_string(v).encode('utf-8') for v in np.ma.getdata(column)]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(v) for v in encoded])
+        np.save(path + '.bytes.npy', np.frombuffer(b''.join(encoded), dtype=np.uint8))
+        np.save(path + '.offsets.npy', offsets)
+        return {'name': name, 'kind': 'string'}
+
+    np.save(path + '.npy', np.ma.getdata(column))
+    masked = bool(np.ma.getmaskarray(column).any())
+    if masked:
+        np.save(path + '.mask.npy', np.ma.getmaskarray(column))
+
+    return {'name': name, 'kind': 'numeric', 'dtype': column.dtype.str, 'masked': masked}
+
+
+# Reads rows first..last-1 of one column through memory mapping
+def read_column(directory, description, first, last):
+    path = os.path.join(directory, description['name'])
+    if description['kind'] == 'string':
+        offsets = np.load(path + '.offsets.npy', mmap_mode='r')[first:last + 1]
+        if len(offsets) < 2:
+            return np.array([], dtype=object)
+        data = np.load(path + '.bytes.npy', mmap_mode='r')[offsets[0]:offsets[-1]].tobytes()
+        offsets = offsets - offsets[0]
+        return np.array([data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)],
+                        dtype=object)
+
+    values = np.array(np.load(path + '.npy', mmap_mode='r')[first:last])
+    if description['masked']:
+        return np.ma.array(values, mask=np.load(path + '.mask.npy', mmap_mode='r')[first:last])
+
+    return values
+
+
+if __name__ == '__main__':
+    # Downloads a few days of active regions and reads them back without network
+    catalog = FeatureCatalog()
+    print('stored rows:', catalog.download('2003-10-21T00:00:00', '2003-10-24T00:00:00', 'AR', 'SOHO', 'MDI'))
+    print('partitions:', catalog.get_partitions('AR', 'SOHO', 'MDI'))
+
+    ar = OfflineDataAccess('2003-10-22T00:00:00', '2003-10-22T12:00:00', 'AR', 'SOHO', 'MDI', catalog)
+    print('get_ar_id() TEST', ar.get_ar_id())
+    print('get_date() TEST', ar.get_date())
@@ -0,0 +1,72 @@
+import tempfile
+import numpy as np
+import DataAccess as da
+from FeatureCatalog import FeatureCatalog, OfflineDataAccess
+from DataAccessTesting import check
+
+
+# Returns rows of output.xml, copy of them is moved to the next day
+# with new ids, so the catalog has two partitions
+def create_rows():
+    array = da.parse_votable(open('output.xml', 'rb'), da.COLUMNS['AR'])
+    next_day = array.copy()
+    next_day['DATE_OBS'] = [d.replace('2010-01-01', '2010-01-02') for d in array['DATE_OBS']]
+    next_day['ID_AR'] = array['ID_AR'] + 1000000
+
+    return array, np.ma.concatenate([array, next_day])
+
+
+# Stored rows are read back the same, masked values stay masked
+def test_round_trip(catalog, array, rows):
+    catalog.ingest(rows, 'AR', 'SOHO', 'MDI')
+    stored = catalog.read('2010-01-01T00:00:00', '2010-01-01T23:59:59', 'AR', 'SOHO', 'MDI')
+
+    check("round trip: partitions", catalog.get_partitions('AR', 'SOHO', 'MDI') == ['2010-01-01', '2010-01-02'])
+    check("round trip: same columns", stored.dtype == array.dtype)
+    check("round trip: same values", all(list(stored[n]) == list(array[n]) for n in array.dtype.names
+                                         if n != 'TRACK_ID'))
+    check("round trip: masks kept", (np.ma.getmaskarray(stored['TRACK_ID']) ==
+                                     np.ma.getmaskarray(array['TRACK_ID'])).all())
+
+
+# Only rows inside of the window are returned, across partitions
+def test_window(catalog, array):
+    dates = [str(d) for d in array['DATE_OBS']]
+    stored = catalog.read(dates[1], '2010-01-02' + dates[0][10:], 'AR', 'SOHO', 'MDI', ['ID_AR', 'DATE_OBS'])
+
+    check("window: rows inside", list(stored['ID_AR']) == list(array['ID_AR'][1:]) + [array['ID_AR'][0] + 1000000])
+    check("window: selected columns", set(stored.dtype.names) == {'ID_AR', 'DATE_OBS'})
+    check("window: empty", len(catalog.read('2011-01-01T00:00:00', '2011-01-02T00:00:00', 'AR', 'SOHO', 'MDI')) == 0)
+
+
+# Ingesting the same rows again replaces them
+def test_reingest(catalog, array):
+    changed = array.copy()
+    changed['NOAA_NUMBER'] = 12345
+    catalog.ingest(changed, 'AR', 'SOHO', 'MDI')
+    stored = catalog.read('2010-01-01T00:00:00', '2010-01-01T23:59:59', 'AR', 'SOHO', 'MDI')
+
+    check("reingest: no duplicates", len(stored) == len(array))
+    check("reingest: rows replaced", all(n == 12345 for n in stored['NOAA_NUMBER']))
+
+
+# Offline DataAccess has the same getters as DataAccess
+def test_offline_data_access(catalog, array):
+    data = OfflineDataAccess('2010-01-01T00:00:00', '2010-01-02T23:59:59', 'AR', 'SOHO', 'MDI', catalog)
+    batches = list(data.iter_batches(4))  # one batch from each partition
+
+    check("offline: getters", list(data.get_chain_code()[:len(array)]) == list(array['CC']))
+    check("offline: batches", [len(b.get_ar_id()) for b in batches] == [3, 3])
+
+
+# FeatureCatalog testing on the VOTable stored in the repository
+if __name__ == '__main__':
+    catalog = FeatureCatalog(tempfile.mkdtemp())
+    array, rows = create_rows()
+    try:
+        test_round_trip(catalog, array, rows)
+        test_window(catalog, array)
+        test_reingest(catalog, array)
+        test_offline_data_access(catalog, array)
+    finally:
+        catalog.clear()
@@ -1,5 +1,7 @@
 import Database as db
 import ObjectPreparation as prep
+import ChainCode as cc
+from ContourBatch import ContourBatch
 import sunpy
 from functools import reduce
 from PIL import Image
@@ -14,67 +16,80 @@ import matplotlib.pyplot as plt
 # starty - y coordinate of chain code start position in pixels
 # return - array with coordinates of the contour of the object
 def get_shapes(chains, startx, starty, filename, track_id, fl_id, date):
+    batch = ContourBatch.from_chains(chains, startx, starty, filename, track_id, fl_id, date)
+    mer, pixel_contours = get_shapes_from_batch(batch)
+
+    return mer
+
+
+# Does the same as get_shapes, but takes contours of all filaments as ContourBatch.
+# Returns dictionary of filaments merged by track_id and ContourBatch with
+# contours of filaments which were merged
+# observatory, instrument - source of the objects, stored with new objects
+def get_shapes_from_batch(batch, observatory=None, instrument=None):
     print("get_shapes() START")
-    filename = prep.encode_filename(filename)
-    date = prep.encode_date(date)
     all_track = []
-    all_coords_carr = []
-    all_contours_pix = []
     all_dates = []
-    all_chains = []
+    all_contours = []
     all_start_pos = []
-    counter = 0
-    print("STARTX,", startx, "STARTY", starty)
-    # Loop goes through array of chain code
-    # and calculates coordinate of each of the pixel of the contour
-    for c in chains:
-        xpos = startx[counter]  # Starting position of contour
-        ypos = starty[counter]
-        t_id = track_id[counter]
-        f_id = fl_id[counter]
-
-        print("ID", f_id)
-        file = filename[counter]
-        fl_date = date[counter]
-
-        # Check if exists in database
-        result = db.load_fl_from_database(f_id)
-        if not result == ([], [], []):
-            print("RESULT NOT NULL")
-            # check if object go through the end of map and finish at the beginning
-            #broken = (max(result[1][0][0]) - min(result[1][0][0])) > 358
-            broken = False
-            if not broken:
-                all_track += result[0]
-                all_dates += result[1]
-                all_chains += result[2]
-                all_start_pos.append([xpos,ypos])
-                # all_coords_carr += result[1]
-                # all_contours_pix.append(result[2])
-        else:
-            print("RESULT NULL")
-            # Calculate ar contour in pixel, carrington longitude and latitude
-            pix, lon, lat = prep.get_shape(coords=c, xpos=xpos, ypos=ypos, file=file)
-            all_contours_pix.append(pix)
-            db.add_fl_to_database(f_id, fl_date, t_id, [lon, lat], pix)
-
-            broken = max(lon) - min(lon) > 358  # check if object go through the end of map and finish at the beginning
-            if not broken:
-                all_track.append(str(t_id))
-                all_coords_carr.append([lon, lat])
-
-        counter += 1
-
-    #print("!!!!", len(all_coords_carr), len(all_contours_pix))
-    mer = merge_id_with_object(all_dates, all_chains, all_start_pos, all_track)
-    #carrington_synthesis, pixel_synthesis = make_synthesis(mer)
+    all_rows = []   # position of each object in the batch
+    # Check which objects exist in database (one query for all objects),
+    # objects stored from other data are reconstructed again
+    content_hashes = batch.get_content_hashes()
+    results = db.load_fls_from_database(batch.feature_id, content_hashes)[0]
+
+    # Loop goes through contours of all objects,
+    # new objects are written to the database by a background thread
+    with db.write_behind():
+        for i in range(len(batch)):
+            contour = batch.contour(i)
+            start_pos = batch.start[i]  # Starting position of contour
+            t_id = batch.track_id[i]
+            f_id = batch.feature_id[i]
+
+            print("ID", f_id)
+            file = batch.get_filename(i)
+            fl_date = batch.date[i]
+
+            result = results.get(str(f_id))
+            copies = 0  # number of merged objects with this contour
+            if result is not None:
+                print("RESULT NOT NULL")
+                # check if object go through the end of map and finish at the beginning
+                #broken = (max(result[2][0][0]) - min(result[2][0][0])) > 358
+                broken = False
+                if not broken:
+                    all_track += result[0]
+                    all_dates += result[1]
+                    copies = len(result[0])
+            else:
+                print("RESULT NULL")
+                # Calculate filament carrington longitude and latitude
+                lon, lat = prep.convert_contour_to_carrington(contour[:, 0], contour[:, 1], file)
+                lon = lon.tolist()
+                lat = lat.tolist()
+                db.add_fl_to_database(f_id, fl_date, t_id, [lon, lat], contour, observatory, instrument,
+                                      content_hashes[i])
 
-    return mer
+                broken = max(lon) - min(lon) > 358  # check if object go through the end of map and finish at the beginning
+                if not broken:
+                    all_track.append(str(t_id))
+                    all_dates.append(fl_date)
+                    copies = 1
+
+            # pixel contour is the same for object from database and calculated one
+            all_contours += [contour] * copies
+            all_start_pos += [start_pos] * copies
+            all_rows += [i] * copies
+
+    mer = merge_id_with_object(all_dates, all_contours, all_start_pos, all_track)
+
+    return mer, batch.take(all_rows)
 
 
 # Creates dictionary where key is track_id of filament
-# and values are tuple of carrington coordinates and
-# pixel coordinates
+# and values are tuple of date, pixel contour and
+# start position of the contour
 def merge_id_with_object(dates, chains, start_pos, track_id):
     print("merge_id_with_ar START")
     fl_with_id = {}
@@ -94,7 +109,7 @@ def make_synthesis(merged_objects):
     for id, chain_a_date in merged_objects.items():
         date_with_chain_pos = []
         chain_lenghts = []
-        # creates new list with dates, chain code and starting position only
+        # creates new list with dates, contour and starting position only
         # also, calculates filaments length
         for single_chain_date_pos in chain_a_date:
             date_with_chain_pos.append([single_chain_date_pos[0], single_chain_date_pos[1], single_chain_date_pos[2]])
@@ -102,9 +117,9 @@ def make_synthesis(merged_objects):
 
         biggest = chain_lenghts.index(max(chain_lenghts))  # return position of the biggest filament
 
-        # reconstruct the biggest filament in the pixel coordinate system
-        bigg_fil = get_shape(date_with_chain_pos[biggest][1], date_with_chain_pos[biggest][2][0],
-                             date_with_chain_pos[biggest][2][1])
+        # the biggest filament in the pixel coordinate system
+        bigg_fil = date_with_chain_pos[biggest][1]
+        bigg_start = date_with_chain_pos[biggest][2]
 
         # there start_pos of the biggest filament need to be used!
         small_fil = []
@@ -112,8 +127,8 @@ def make_synthesis(merged_objects):
         # reconstruct the rest of the filaments
         for x in range(0,len(date_with_chain_pos)):
             if not x == biggest:
-                smaller = get_shape(date_with_chain_pos[x][1], date_with_chain_pos[biggest][2][0],
-                          date_with_chain_pos[biggest][2][1])
+                # move contour, so it starts at the start position of the biggest one
+                smaller = date_with_chain_pos[x][1] - date_with_chain_pos[x][2] + bigg_start
 
                 smaller = np.array([smaller], dtype=np.int32)
                 # find the smallest x and y
@@ -188,58 +203,17 @@ def make_synthesis(merged_objects):
 
 
 
+# Reconstructs filament in the pixel coordinate system
 def get_shape(coords, xpos, ypos):
-
-    lon = []
-    lat = []
-    ar = []
-    print(xpos)
-    for d in coords:
-        if d == 0:
-            xpos -= 1
-        elif d == 1:
-            xpos -= 1
-            ypos -= 1
-        elif d == 2:
-            ypos -= 1
-        elif d == 3:
-            ypos -= 1
-            xpos += 1
-        elif d == 4:
-            xpos += 1
-        elif d == 5:
-            ypos += 1
-            xpos += 1
-        elif d == 6:
-            ypos += 1
-        elif d == 7:
-            ypos += 1
-            xpos -= 1
-
-        ar.append([xpos, ypos])
-
-    print("AR", ar)
-
-    return ar
-
-
-
-
-
-
-
-
+    return cc.decode_chain(coords, xpos, ypos)
 
 
 if __name__ == '__main__':
     from DataAccess import DataAccess
 
-    data = DataAccess('2003-09-27T00:00:00', '2003-09-29T00:00:00', 'FIL')
-
-    chain_encoded = prep.encode_and_split(data.get_chain_code())
+    data = DataAccess('2003-09-27T00:00:00', '2003-09-29T00:00:00', 'FIL', 'MEUDON', 'SPECTROHELIOGRAPH')
 
-    mer = get_shapes(chain_encoded, data.get_pixel_start_x(), data.get_pixel_start_y(),
-                                     data.get_filename(), data.get_track_id(), data.get_fil_id(), data.get_date())
+    mer, pixel_contours = get_shapes_from_batch(ContourBatch.from_data_access(data, 'FIL'))
 
     make_synthesis(mer)
 
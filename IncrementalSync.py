@@ -0,0 +1,153 @@
+import os
+import sys
+import json
+import tempfile
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import DataAccess as da
+from FeatureCatalog import FeatureCatalog, OfflineDataAccess, to_string, INDEX_DATE_LENGTH
+from ContourBatch import ContourBatch
+import ActiveRegion as ar
+import Sunspot as sp
+import Filament as fil
+
+
+# Name of the file (in the catalog directory) with high-water marks
+SYNC_STATE_FILE = 'sync_state.json'
+
+# Objects of a track are looked for this long before the first new row
+# (active region crosses the visible disk in about two weeks)
+TRACK_LOOKBACK = timedelta(days=14)
+
+# Columns used as track id of each type of feature
+# (the same columns as ContourBatch uses), sunspots are not tracked
+TRACK_COLUMNS = {'AR': 'NOAA_NUMBER', 'SP': None, 'FIL': 'TRACK_ID'}
+
+# Functions which reconstruct objects of each type of feature
+SHAPE_FUNCTIONS = {'AR': ar.get_shapes_from_batch, 'SP': sp.get_shapes_from_batch, 'FIL': fil.get_shapes_from_batch}
+
+
+# Incremental ingest of HFC features.
+# For each (feature, observatory, instrument) the latest DATE_OBS which was
+# stored in the local catalog (high-water mark) is remembered, each run
+# downloads only rows observed after it. New rows are stored in the catalog
+# and only tracks which got new rows are reconstructed again.
+class IncrementalSync:
+    def __init__(self, catalog=None, batch_size=1000):
+        self.catalog = catalog if catalog is not None else FeatureCatalog()
+        self.batch_size = batch_size
+        self.state_file = os.path.join(self.catalog.directory, SYNC_STATE_FILE)
+
+    # Returns dictionary with high-water marks of all instruments
+    def load_state(self):
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    # Returns high-water mark of the instrument or None if it was never synchronised
+    def get_high_water_mark(self, feature, observatory, instrument):
+        return self.load_state().get(get_state_key(feature, observatory, instrument))
+
+    # Stores high-water mark of the instrument, the state file is
+    # replaced at once, so interrupted run does not damage it
+    def set_high_water_mark(self, feature, observatory, instrument, date):
+        state = self.load_state()
+        state[get_state_key(feature, observatory, instrument)] = date
+
+        os.makedirs(self.catalog.directory, exist_ok=True)
+        descriptor, temporary = tempfile.mkstemp(dir=self.catalog.directory, suffix='.tmp')
+        with os.fdopen(descriptor, 'w') as f:
+            json.dump(state, f, indent=1)
+        os.replace(temporary, self.state_file)
+
+    # Downloads rows observed after the high-water mark (or after start_date
+    # on the first run) until end_date and stores them in the catalog.
+    # High-water mark is not moved, rows are stored again by the next run
+    # if it is not moved (stored rows are replaced, see FeatureCatalog.ingest).
+    # Returns record array with new rows and the latest DATE_OBS of them
+    # (None if there are no new rows).
+    def fetch_new_rows(self, feature, observatory, instrument, start_date=None, end_date=None):
+        mark = self.get_high_water_mark(feature, observatory, instrument)
+        if mark is None and start_date is None:
+            raise ValueError("start_date is needed for the first synchronisation of "
+                             + get_state_key(feature, observatory, instrument))
+        if end_date is None:
+            end_date = datetime.now(timezone.utc).strftime(da.DATE_FORMAT)
+        start = mark if mark is not None else start_date
+
+        # query start is inclusive, rows observed exactly at the mark were already stored
+        data = da.DataAccess(start, end_date, feature, observatory, instrument, use_cache=False, lazy=True)
+        new_rows = []
+        for batch in data.iter_batches(self.batch_size):
+            array = batch.array
+            if mark is not None:
+                dates = np.array([to_string(d)[:len(mark)] for d in array['DATE_OBS']])
+                array = array[dates > mark]
+            if len(array) > 0:
+                self.catalog.ingest(array, feature, observatory, instrument)
+                new_rows.append(array)
+
+        if len(new_rows) == 0:
+            return self.catalog.read_empty(feature, observatory, instrument), None
+
+        new_rows = np.ma.concatenate(new_rows)
+        latest = max(to_string(d)[:INDEX_DATE_LENGTH] for d in new_rows['DATE_OBS'])
+
+        return new_rows, latest
+
+    # Returns rows from the catalog which have to be reconstructed because
+    # of new rows: new rows and all rows of tracks which got new rows
+    def get_affected_rows(self, new_rows, feature, observatory, instrument):
+        track_column = TRACK_COLUMNS[feature]
+        if track_column is None:
+            return new_rows
+
+        dates = [to_string(d)[:INDEX_DATE_LENGTH] for d in new_rows['DATE_OBS']]
+        first, last = min(dates), max(dates)
+        start = (datetime.strptime(first, da.DATE_FORMAT) - TRACK_LOOKBACK).strftime(da.DATE_FORMAT)
+        stored = OfflineDataAccess(start, last, feature, observatory, instrument, self.catalog).array
+
+        tracks = set(new_rows[track_column].compressed().tolist())
+        ids = set(np.asarray(new_rows[da.ID_COLUMNS[feature]]).tolist())
+        affected = [(not masked and t in tracks) or i in ids for t, masked, i in
+                    zip(np.ma.getdata(stored[track_column]).tolist(),
+                        np.ma.getmaskarray(stored[track_column]).tolist(),
+                        np.asarray(stored[da.ID_COLUMNS[feature]]).tolist())]
+
+        return stored[np.array(affected, dtype=bool)]
+
+    # Synchronises one instrument: downloads new rows, stores them
+    # and reconstructs affected tracks. High-water mark is moved only after
+    # the tracks are reconstructed, so failed run is repeated by the next one.
+    # Returns result of get_shapes_from_batch of the feature
+    # (synthesis of affected tracks) or None if there are no new rows.
+    def sync(self, feature, observatory, instrument, start_date=None, end_date=None):
+        new_rows, latest = self.fetch_new_rows(feature, observatory, instrument, start_date, end_date)
+        if len(new_rows) == 0:
+            return None
+
+        rows = self.get_affected_rows(new_rows, feature, observatory, instrument)
+        batch = ContourBatch.from_data_access(da.DataAccess.from_array(rows), feature)
+        result = SHAPE_FUNCTIONS[feature](batch)
+        self.set_high_water_mark(feature, observatory, instrument, latest)
+
+        return result
+
+
+# Returns key of the instrument in the sync state
+def get_state_key(feature, observatory, instrument):
+    return feature + '/' + observatory + '/' + instrument
+
+
+# Nightly synchronisation
+# python IncrementalSync.py feature observatory instrument [start date of the first run]
+if __name__ == '__main__':
+    feature, observatory, instrument = sys.argv[1:4]
+    start_date = sys.argv[4] if len(sys.argv) > 4 else None
+
+    synchronisation = IncrementalSync()
+    result = synchronisation.sync(feature, observatory, instrument, start_date)
+    print('high-water mark:', synchronisation.get_high_water_mark(feature, observatory, instrument))
+    print('reconstructed objects:', 0 if result is None else len(result[1]))
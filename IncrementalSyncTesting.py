@@ -0,0 +1,84 @@
+import tempfile
+import DataAccess as da
+import IncrementalSync as sync
+from FeatureCatalog import FeatureCatalog
+from IncrementalSync import IncrementalSync
+from DataAccessTesting import VOTableHandler, start_server, check
+
+
+# Reconstruction of tracks which fails
+def fail_reconstruction(batch):
+    raise ValueError("reconstruction")
+
+
+# First run downloads the whole window, the high-water mark
+# is set only after the tracks are reconstructed
+def test_first_run(synchronisation):
+    new_rows, latest = synchronisation.fetch_new_rows('AR', 'SOHO', 'MDI', '2010-01-01T00:00:00',
+                                                      '2010-01-01T12:00:00')
+
+    check("first run: all rows new", len(new_rows) == 3)
+    check("first run: rows stored", len(synchronisation.catalog.read('2010-01-01T00:00:00', '2010-01-01T12:00:00',
+                                                                      'AR', 'SOHO', 'MDI')) == 3)
+    check("first run: latest row", latest == max(str(d) for d in new_rows['DATE_OBS'])[:19])
+    check("first run: mark not set by download", synchronisation.get_high_water_mark('AR', 'SOHO', 'MDI') is None)
+
+    shape_function = sync.SHAPE_FUNCTIONS['AR']
+    try:
+        sync.SHAPE_FUNCTIONS['AR'] = fail_reconstruction
+        try:
+            synchronisation.sync('AR', 'SOHO', 'MDI', '2010-01-01T00:00:00', '2010-01-01T12:00:00')
+        except ValueError:
+            pass
+        check("first run: mark not set after failed reconstruction",
+              synchronisation.get_high_water_mark('AR', 'SOHO', 'MDI') is None)
+
+        sync.SHAPE_FUNCTIONS['AR'] = len
+        result = synchronisation.sync('AR', 'SOHO', 'MDI', '2010-01-01T00:00:00', '2010-01-01T12:00:00')
+        check("first run: rows stored once", result == 3 and len(synchronisation.catalog.read(
+            '2010-01-01T00:00:00', '2010-01-01T12:00:00', 'AR', 'SOHO', 'MDI')) == 3)
+        check("first run: mark is the latest row", synchronisation.get_high_water_mark('AR', 'SOHO', 'MDI') == latest)
+    finally:
+        sync.SHAPE_FUNCTIONS['AR'] = shape_function
+
+
+# Next run asks only for rows after the mark, rows already stored are not new
+def test_next_run(synchronisation):
+    mark = synchronisation.get_high_water_mark('AR', 'SOHO', 'MDI')
+    new_rows, latest = synchronisation.fetch_new_rows('AR', 'SOHO', 'MDI', end_date='2010-01-02T00:00:00')
+
+    check("next run: starts at the mark", 'STARTTIME=' + mark in VOTableHandler.requests[-1])
+    check("next run: nothing new", len(new_rows) == 0 and latest is None)
+    check("next run: mark kept", synchronisation.get_high_water_mark('AR', 'SOHO', 'MDI') == mark)
+
+
+# Stored rows of tracks which got new rows are reconstructed again,
+# rows of other tracks are not
+def test_affected_rows(synchronisation):
+    catalog = synchronisation.catalog
+    new_rows = catalog.read('2010-01-01T00:00:00', '2010-01-01T12:00:00', 'AR', 'SOHO', 'MDI')
+    old_rows = new_rows.copy()
+    old_rows['DATE_OBS'] = [d.replace('2010-01-01', '2009-12-28') for d in new_rows['DATE_OBS']]
+    old_rows['ID_AR'] = new_rows['ID_AR'] + 1000000
+    old_rows['NOAA_NUMBER'][1:] = 1
+    catalog.ingest(old_rows, 'AR', 'SOHO', 'MDI')
+
+    rows = synchronisation.get_affected_rows(new_rows[:1], 'AR', 'SOHO', 'MDI')
+    ids = set(rows['ID_AR'].tolist())
+
+    check("affected rows: new row", new_rows['ID_AR'][0] in ids)
+    check("affected rows: older row of the same track", old_rows['ID_AR'][0] in ids)
+    check("affected rows: other tracks skipped", old_rows['ID_AR'][1] not in ids)
+
+
+# IncrementalSync testing against local HTTP stand-in
+if __name__ == '__main__':
+    server = start_server('output.xml')
+    synchronisation = IncrementalSync(FeatureCatalog(tempfile.mkdtemp()))
+    try:
+        test_first_run(synchronisation)
+        test_next_run(synchronisation)
+        test_affected_rows(synchronisation)
+    finally:
+        synchronisation.catalog.clear()
+        server.shutdown()
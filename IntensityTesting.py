@@ -0,0 +1,96 @@
+import time
+import numpy as np
+import cv2
+import sunpy.map
+import ChainCode as cc
+import ActiveRegion as ar
+import RegionStatistics as stats
+
+
+# Old way of calculating intensity: contour is drawn on an image of the
+# size of the whole picture and every pixel inside is added in a loop.
+# Unlike the old calculate_ar_intensity, all pixels are added
+# (the old one added only len(coord) == 3 pixels)
+def full_image_intensity(contour, data):
+    cv_image = np.zeros(data.shape, dtype=np.uint8)
+    cv2.fillPoly(cv_image, pts=[np.array(contour, dtype=np.int32)], color=255)
+    coord = np.where(cv_image == 255)
+    intensity = 0.0
+    for x in range(0, len(coord[0])):
+        intensity = intensity + float(data[coord[0][x]][coord[1][x]])
+
+    return intensity
+
+
+# Creates closed contour of a random blob with centre (x, y)
+def random_contour(rng, x, y, radius):
+    angles = np.linspace(0, 2 * np.pi, 200, endpoint=False)
+    radii = radius * (1 + 0.3 * np.sin(rng.integers(2, 6) * angles + rng.uniform(0, np.pi)))
+    return np.column_stack([x + radii * np.cos(angles), y + radii * np.sin(angles)]).astype(np.int32)
+
+
+# Tests bounding box intensity against the whole image method
+# on the FITS images stored in the repository
+def test_intensity(files, contours_per_file=20):
+    rng = np.random.default_rng(0)
+    fail = 0
+    success = 0
+    old_time = 0.0
+    new_time = 0.0
+
+    for f in files:
+        data = sunpy.map.Map(f).data
+        contours = [random_contour(rng, rng.integers(0, data.shape[1]), rng.integers(0, data.shape[0]),
+                                   rng.integers(5, 80)) for _ in range(contours_per_file)]
+        # contour reconstructed from chain code, the same way as HFC objects are
+        contours.append(cc.decode_chain("4" * 40 + "6" * 30 + "0" * 40 + "2" * 30, 400, 400))
+
+        for contour in contours:
+            start = time.perf_counter()
+            old = full_image_intensity(contour, data)
+            old_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            new = ar.sum_contour_intensity(contour, data)
+            new_time += time.perf_counter() - start
+
+            if np.isclose(old, new):
+                success += 1
+            else:
+                print("FAIL", f, old, new)
+                fail += 1
+
+    print("successes = ", success)
+    print("fail = ", fail)
+    print("whole image: {0:.3f} s, bounding box: {1:.3f} s".format(old_time, new_time))
+
+
+# Tests statistics of many regions of one image against intensity of each
+# region: regions close to each other and overlapping regions
+# (pixels are counted for every region)
+def test_region_statistics(file):
+    rng = np.random.default_rng(1)
+    data = sunpy.map.Map(file).data
+    fail = 0
+    success = 0
+
+    grid = [random_contour(rng, 20 + 40 * (k % 10), 20 + 40 * (k // 10), 12) for k in range(50)]
+    overlapping = [random_contour(rng, rng.integers(100, 200), rng.integers(100, 200), 40) for _ in range(50)]
+    for name, contours in [('grid', grid), ('overlapping', overlapping)]:
+        statistics = stats.calculate_region_statistics(contours, data)
+        expected = [ar.sum_contour_intensity(c, data) for c in contours]
+
+        if np.allclose(statistics['sum'], expected):
+            success += 1
+        else:
+            print("FAIL", name)
+            fail += 1
+
+    print("region statistics successes = ", success)
+    print("region statistics fail = ", fail)
+
+
+# Active region intensity testing
+if __name__ == '__main__':
+    test_intensity(['eit1.fits', 'eit2.fits', 'eit3.fits', 'eit4.fits'])
+    test_region_statistics('eit1.fits')
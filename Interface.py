@@ -1,10 +1,11 @@
 import tkinter as tk
 from tkinter import ttk, StringVar
 from tkinter import messagebox
-from DataAccess import DataAccess
 import ObjectPreparation as prep
 import ActiveRegion as ar
 import Sunspot as sp
+import Database as db
+import Pipeline as pipe
 
 
 # Class represents the interface of the software
@@ -72,7 +73,11 @@ class MainFrame(tk.Frame):
                     messagebox.showerror("Error", "Some of the values are empty!")
                 else:
                     try:
-                        create_map(start, end, ar_obs, ar_instr, sp_obs, sp_instr)
+                        # map which was already made is shown at once, otherwise map is made
+                        # from the database if it has all objects of the window
+                        if not (show_stored_map(start, end, ar_obs, ar_instr, sp_obs, sp_instr) or
+                                create_map_from_database(start, end, ar_obs, ar_instr, sp_obs, sp_instr)):
+                            create_map(start, end, ar_obs, ar_instr, sp_obs, sp_instr)
                     except Exception as error:
                         print(error)
                         if str(error) == "File not found or invalid input" or str(error) == "list index out of range":
@@ -85,25 +90,75 @@ class MainFrame(tk.Frame):
 
 
 
-def create_map(start, end, ar_obs, ar_instr, sp_obs, sp_instr):
-    # setting active regions
-    data = DataAccess(start, end, 'AR', ar_obs, ar_instr)
-    chain_encoded = prep.decode_and_split(data.get_chain_code())
-    ar_carr_synthesis, ar_pix_synthesis = ar.get_shapes(chain_encoded, data.get_pixel_start_x(),
-                                                        data.get_pixel_start_y(), data.get_filename(),
-                                               data.get_noaa_number(), data.get_ar_id(), data.get_date())
+# Objects go through the stages of Pipeline.make_map_pipeline part by part:
+# tiles are downloaded while the previous parts are converted to Carrington,
+# only synthesis and rendering need objects of the whole window.
+# policy - how active regions of a track are chosen (ActiveRegion.SYNTHESIS_POLICIES)
+def create_map(start, end, ar_obs, ar_instr, sp_obs, sp_instr, policy=ar.DEFAULT_POLICY):
+    with db.write_behind():
+        pipeline = pipe.make_map_pipeline(start, end, [('AR', ar_obs, ar_instr), ('SP', sp_obs, sp_instr)])
+        objects = pipeline.run(pipe.collect_map_objects)
+    ar_objects = objects.get('AR', pipe.MapObjects())
+    sp_objects = objects.get('SP', pipe.MapObjects())
 
-    # setting sunspots
-    sp_data = DataAccess(start, end, 'SP', sp_obs, sp_instr)
+    # all objects of the window are stored now,
+    # next map of the window can be made from the database
+    db.set_source('AR', ar_objects.ids, ar_obs, ar_instr)
+    db.set_source('SP', sp_objects.ids, sp_obs, sp_instr)
+    covered = add_coverage(start, end, [('AR', ar_obs, ar_instr, [ar_objects.latest_date]),
+                                        ('SP', sp_obs, sp_instr, [sp_objects.latest_date])])
 
-    sp_chain_encoded = prep.decode_and_split(sp_data.get_chain_code())
+    ar_carr_synthesis = ar_objects.make_ar_synthesis(policy)
+    sp_synthesis = sp.make_sp_synthesis(ar_contour=ar_carr_synthesis, sp_carr=sp_objects.carrington)
+    if covered:
+        db.add_synthesis(start, end, ar_obs, ar_instr, sp_obs, sp_instr, policy, ar_carr_synthesis, sp_synthesis)
+
+    prep.display_object(ar_carr_synthesis, sp_synthesis)
 
-    sp_carr, sp_pix = sp.get_shapes(sp_chain_encoded, sp_data.get_pixel_start_x(), sp_data.get_pixel_start_y(),
-                                sp_data.get_filename(), sp_data.get_sp_id(), sp_data.get_date())
 
-    sp_synthesis = sp.make_sp_synthesis(ar_contour=ar_carr_synthesis, sp_carr=sp_carr)
+# Creates map only from objects stored in the database, without network.
+# Returns False (and does nothing) if the database does not have
+# all objects of the window
+def create_map_from_database(start, end, ar_obs, ar_instr, sp_obs, sp_instr, policy=ar.DEFAULT_POLICY):
+    if not (db.is_covered('AR', ar_obs, ar_instr, start, end) and db.is_covered('SP', sp_obs, sp_instr, start, end)):
+        return False
 
+    ar_carr_synthesis, ar_pix_synthesis = ar.make_ar_synthesis_from_database(start, end, ar_obs, ar_instr, policy)
+    sp_synthesis = sp.make_sp_synthesis_from_database(ar_carr_synthesis, start, end, sp_obs, sp_instr)
+    db.add_synthesis(start, end, ar_obs, ar_instr, sp_obs, sp_instr, policy, ar_carr_synthesis, sp_synthesis)
+
+    prep.display_object(ar_carr_synthesis, sp_synthesis)
+    return True
+
+
+# Records windows of the sources as stored in the database.
+# HFC can still add objects to a window which reaches the present, so such
+# window is recorded only until its latest object (objects observed later
+# are downloaded again by the next map).
+# sources - list of (feature, observatory, instrument, dates of downloaded objects)
+# Returns True if the whole window is recorded for all sources
+def add_coverage(start, end, sources):
+    finished = str(end)[:19] <= db.get_current_date()
+    for feature, observatory, instrument, dates in sources:
+        dates = [str(d)[:19] for d in dates if d is not None]
+        covered_end = end if finished else max(dates, default=None)
+        if covered_end is not None:
+            db.add_coverage(feature, observatory, instrument, start, covered_end)
+
+    return finished
+
+
+# Shows synthesis stored by the last map of the window (no download and no synthesis).
+# Returns False (and does nothing) if there is no stored synthesis
+# or objects of the window changed since it was made
+def show_stored_map(start, end, ar_obs, ar_instr, sp_obs, sp_instr, policy=ar.DEFAULT_POLICY):
+    synthesis = db.load_synthesis(start, end, ar_obs, ar_instr, sp_obs, sp_instr, policy)
+    if synthesis is None:
+        return False
+
+    ar_carr_synthesis, sp_synthesis = synthesis
     prep.display_object(ar_carr_synthesis, sp_synthesis)
+    return True
 
 
 if __name__ == '__main__':
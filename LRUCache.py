@@ -0,0 +1,110 @@
+from collections import OrderedDict
+import threading
+
+
+# Bounded least-recently-used cache.
+# Keeps at most 'size' values, the least recently used value is dropped
+# when a new one does not fit. Counts hits and misses so the effect of
+# the cache can be checked after a run.
+# Every invalidation starts new generation (one counter for all keys),
+# value loaded before an invalidation of its key can be put with the old
+# generation and is not stored. Only the latest invalidations (at most
+# 'size' keys) are remembered, values loaded before older ones are not stored.
+class LRUCache:
+    def __init__(self, size=16):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._values = OrderedDict()
+        self._generation = 0    # number of invalidations
+        self._invalidated = OrderedDict()   # key -> generation of its latest invalidation
+        self._forgotten = 0     # latest generation of keys removed from _invalidated
+        self._lock = threading.Lock()
+
+    # Returns value stored under key or None if there is no such value
+    def get(self, key):
+        with self._lock:
+            if key in self._values:
+                self._values.move_to_end(key)
+                self.hits += 1
+                return self._values[key]
+
+            self.misses += 1
+            return None
+
+    # Stores value under key, drops the oldest values if cache is full.
+    # generation - generation of the key when the value was loaded
+    # (get_generation), value is not stored if the key was invalidated since
+    # Returns True if the value was stored
+    def put(self, key, value, generation=None):
+        with self._lock:
+            if generation is not None and self._invalidated.get(key, self._forgotten) > generation:
+                return False
+            self._values[key] = value
+            self._values.move_to_end(key)
+            self._evict()
+            return True
+
+    # Returns generation to read before the value of key is loaded
+    def get_generation(self, key):
+        with self._lock:
+            return self._generation
+
+    # Returns value stored under key, if it is not in the cache
+    # it is created by calling load(key) and stored
+    def get_or_load(self, key, load):
+        value = self.get(key)
+        if value is None:
+            value = load(key)
+            self.put(key, value)
+
+        return value
+
+    # Removes value stored under key (if there is one)
+    # and starts new generation
+    def invalidate(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+            self._generation += 1
+            self._invalidated[key] = self._generation
+            self._invalidated.move_to_end(key)
+            self._evict()
+
+    # Changes maximum number of stored values
+    def resize(self, size):
+        with self._lock:
+            self.size = size
+            self._evict()
+
+    # Removes all values and resets counters
+    # (values loaded before are not stored)
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self._generation += 1
+            self._invalidated.clear()
+            self._forgotten = self._generation
+            self.hits = 0
+            self.misses = 0
+
+    # Returns dictionary with cache statistics
+    def get_stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            hit_rate = self.hits / requests if requests > 0 else 0.0
+            return {'size': len(self._values), 'max_size': self.size,
+                    'hits': self.hits, 'misses': self.misses, 'hit_rate': hit_rate}
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._values
+
+    def __len__(self):
+        with self._lock:
+            return len(self._values)
+
+    def _evict(self):
+        while len(self._values) > max(self.size, 0):
+            self._values.popitem(last=False)
+        while len(self._invalidated) > max(self.size, 0):
+            self._forgotten = self._invalidated.popitem(last=False)[1]
@@ -4,20 +4,24 @@ import sunpy.map
 import matplotlib.pyplot as plt
 from sunpy.coordinates import frames
 import astropy.units as u
-import math
+from LRUCache import LRUCache
+import ChainCode as cc
+
+
+# Maximum number of FITS maps kept in memory.
+# Every contour pixel of an object comes from the same image,
+# so even a small cache removes almost all map loads
+MAP_CACHE_SIZE = 8
+map_cache = LRUCache(MAP_CACHE_SIZE)
 
 
 # Function takes array with chain codes, encode the chain code,
-# then splits into array
+# then splits into arrays of direction digits
 def decode_and_split(chain_codes):
     codes = []
 
     for chains in chain_codes:
-        if type(chains) is bytes:
-            chains = chains.decode("utf-8")
-
-        splitted_chain = list(map(int,str(chains)))
-        codes.append(splitted_chain)
+        codes.append(cc.chain_to_digits(chains))
 
     return codes
 
@@ -49,52 +53,35 @@ def decode_date(dates):
     return decoded_dates
 
 
-# Takes chain code and position of the first pixel,
-# reconstructs object in pixel coordinate, then
+# Takes chain code (raw CC value or array of digits) and position of the
+# first pixel, reconstructs object in pixel coordinate, then
 # it converts a object from pixel to Carrington system
 def get_shape(chain, xpos, ypos, file):
-    lon = []
-    lat = []
-    obj = []
-    print(xpos)
-    for d in chain:
-        if d == 0:
-            xpos -= 1
-        elif d == 1:
-            xpos -= 1
-            ypos -= 1
-        elif d == 2:
-            ypos -= 1
-        elif d == 3:
-            ypos -= 1
-            xpos += 1
-        elif d == 4:
-            xpos += 1
-        elif d == 5:
-            ypos += 1
-            xpos += 1
-        elif d == 6:
-            ypos += 1
-        elif d == 7:
-            ypos += 1
-            xpos -= 1
-
-        obj.append([xpos, ypos])
-        carr = convert_to_carrington(xpos, ypos, file)
-        # Checks if result of convertion is NaN
-        if not (math.isnan(carr.lon.deg) or math.isnan(carr.lat.deg)):
-            lon.append(carr.lon.deg)  # Add calculated position to array
-            lat.append(carr.lat.deg)
-        else:
-            print("Problem with converting pixel. It will be ignored.")
-
-    return obj, lon, lat
+    obj = cc.decode_chain(chain, xpos, ypos)
+    lon, lat = convert_contour_to_carrington(obj[:, 0], obj[:, 1], file)
+
+    return obj, lon.tolist(), lat.tolist()
+
+
+# Returns sunpy map of FITS image from images directory.
+# Maps are kept in LRU cache, so the file is read and parsed only once
+def load_map(filename):
+    return map_cache.get_or_load("images//" + filename, sunpy.map.Map)
+
+
+# Changes the number of maps kept in the cache
+def set_map_cache_size(size):
+    map_cache.resize(size)
+
+
+# Returns hits, misses and size of the map cache
+def get_map_cache_stats():
+    return map_cache.get_stats()
 
 
 # Function converts from pixel coordinates to Carrington
 def convert_to_carrington(x, y, filename):
-    filename = "images//" + filename
-    map = sunpy.map.Map(filename)
+    map = load_map(filename)
     # convert from pixel to image coordinate system
     cords = map.pixel_to_world(x * u.pix, y * u.pix)
     # convert from picture coordinate frame to carrington
@@ -103,6 +90,38 @@ def convert_to_carrington(x, y, filename):
     return carr
 
 
+# Converts the whole contour of an object from pixel coordinates to Carrington
+# with one transformation instead of one transformation per pixel.
+# x, y - arrays with pixel coordinates of the contour
+# Returns arrays with longitude and latitude in degrees, pixels which
+# are outside of the solar disk (NaN after conversion) are dropped
+def convert_contour_to_carrington(x, y, filename):
+    map = load_map(filename)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    cords = map.pixel_to_world(x * u.pix, y * u.pix)
+    carr = cords.transform_to(frames.HeliographicCarrington)
+
+    lon = np.atleast_1d(carr.lon.deg)
+    lat = np.atleast_1d(carr.lat.deg)
+    on_disk = ~(np.isnan(lon) | np.isnan(lat))
+
+    return lon[on_disk], lat[on_disk]
+
+
+# Converts contours of objects at given positions of the batch (ContourBatch)
+# to Carrington. Returns dictionary where key is position in the batch
+# and value is (list of longitudes, list of latitudes)
+def convert_batch_to_carrington(batch, rows):
+    converted = {}
+    for i in rows:
+        contour = batch.contour(i)
+        lon, lat = convert_contour_to_carrington(contour[:, 0], contour[:, 1], batch.get_filename(i))
+        converted[int(i)] = (lon.tolist(), lat.tolist())
+
+    return converted
+
+
 # Visualise synthesis of features
 def display_object(ar_coordinates, sp_coordinates):
     fig, ax = plt.subplots(1, figsize=(10, 5))
@@ -0,0 +1,331 @@
+import os
+import time
+import queue
+import threading
+import numpy as np
+import DataAccess as da
+import ObjectPreparation as prep
+from ContourBatch import ContourBatch
+import ActiveRegion as ar
+import Sunspot as sp
+
+
+# Default maximum number of items waiting for a stage
+QUEUE_SIZE = 4
+
+# Stopped pipeline is checked this often (s) by threads waiting for a queue
+POLL_INTERVAL = 0.1
+
+# Marks the end of items in a queue
+END = object()
+
+
+# Step of Pipeline.
+# function - takes one item and returns the next item (None drops the item),
+#   or returns a generator which yields any number of items, so existing
+#   functions can be used as stages
+# workers - number of threads running the function: I/O-bound stages can have
+#   many, stages which keep state between items must have one
+# queue_size - maximum number of items waiting for the stage
+class Stage:
+    def __init__(self, name, function, workers=1, queue_size=QUEUE_SIZE):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.queue_size = queue_size
+        self.items = 0      # number of processed items
+        self.busy = 0.0     # time spent in the function by all workers (s)
+        self._lock = threading.Lock()
+
+    # Yields outputs of the function for one item
+    # (time of waiting for the next stage is not counted as busy)
+    def process(self, item):
+        start = time.perf_counter()
+        result = self.function(item)
+        busy = time.perf_counter() - start
+        if hasattr(result, '__next__'):
+            while True:
+                start = time.perf_counter()
+                output = next(result, END)
+                busy += time.perf_counter() - start
+                if output is END:
+                    break
+                yield output
+        elif result is not None:
+            yield result
+
+        with self._lock:
+            self.items += 1
+            self.busy += busy
+
+
+# Runs stages in threads connected by bounded queues: items of the source go
+# through all stages, outputs of the last stage are returned by iteration
+# in the caller thread. When a stage is slower than the previous one, its queue
+# fills up and the previous stage waits, so I/O-bound and CPU-bound stages
+# work at the same time and only a few items are held in memory.
+# Only stages with one worker keep the order of items.
+# Error of a stage (or of the source) stops the pipeline and is raised
+# in the caller thread, leaving the loop early stops the pipeline too.
+#   for result in Pipeline(source, [Stage('fetch', fetch, 4), Stage('decode', decode)]):
+#       ...
+class Pipeline:
+    def __init__(self, source, stages):
+        self.source = source
+        self.stages = stages
+        self.error = None
+        self._stopped = threading.Event()
+
+    def __iter__(self):
+        self.error = None
+        self._stopped.clear()
+        queues = [queue.Queue(stage.queue_size) for stage in self.stages] + [queue.Queue(QUEUE_SIZE)]
+        consumers = [stage.workers for stage in self.stages] + [1]
+
+        threads = [threading.Thread(target=self._feed, args=(queues[0], consumers[0]), daemon=True)]
+        for k, stage in enumerate(self.stages):
+            remaining = [stage.workers]     # workers of the stage which did not finish yet
+            for _ in range(stage.workers):
+                threads.append(threading.Thread(target=self._work, daemon=True, name='pipeline-' + stage.name,
+                                                args=(stage, queues[k], queues[k + 1], consumers[k + 1],
+                                                      remaining, threading.Lock())))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = self._get(queues[-1])
+                if item is END:
+                    break
+                yield item
+        finally:
+            self._stopped.set()
+            for thread in threads:
+                thread.join()
+
+        if self.error is not None:
+            raise self.error
+
+    # Runs the pipeline, all outputs of the last stage are passed to sink
+    # (in the caller thread). Returns result of sink.
+    def run(self, sink=list):
+        return sink(iter(self))
+
+    # Returns dictionary: stage name -> number of workers, processed items and busy time
+    def get_stats(self):
+        return {stage.name: {'workers': stage.workers, 'items': stage.items, 'busy': stage.busy}
+                for stage in self.stages}
+
+    # Puts items of the source in the first queue
+    def _feed(self, output, consumers):
+        try:
+            for item in self.source:
+                if not self._put(output, item):
+                    return
+        except Exception as error:
+            self._fail(error)
+            return
+        self._finish(output, consumers)
+
+    # Worker of a stage, the last worker of the stage to finish
+    # tells the next stage that there are no more items
+    def _work(self, stage, input, output, consumers, remaining, lock):
+        while True:
+            item = self._get(input)
+            if item is END:
+                break
+            try:
+                for result in stage.process(item):
+                    if not self._put(output, result):
+                        return
+            except Exception as error:
+                self._fail(error)
+                return
+
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            self._finish(output, consumers)
+
+    # Puts END for every consumer of the queue
+    def _finish(self, output, consumers):
+        for _ in range(consumers):
+            if not self._put(output, END):
+                return
+
+    # Stops the pipeline, only the first error is kept
+    def _fail(self, error):
+        if self.error is None:
+            self.error = error
+        self._stopped.set()
+
+    # Puts item in the queue, returns False if the pipeline was stopped
+    def _put(self, output, item):
+        while not self._stopped.is_set():
+            try:
+                output.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    # Returns next item of the queue, END if the pipeline was stopped
+    def _get(self, input):
+        while not self._stopped.is_set():
+            try:
+                return input.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                pass
+        return END
+
+
+# Stages of the map construction:
+#   tiles of the window -> fetch -> decode -> Carrington -> intensity -> store
+# then synthesis and rendering in the caller (Interface.create_map).
+# Item of the stages is MapPart, every stage fills some of its attributes.
+
+# Number of rows of one item
+BATCH_SIZE = 200
+
+# Workers of the stages: downloads wait for the network, conversion to
+# Carrington and intensities use the processor
+FETCH_WORKERS = da.TILE_WORKERS
+CARRINGTON_WORKERS = os.cpu_count() or 1
+INTENSITY_WORKERS = 2
+
+# Functions of each type of feature: find_stored_objects, get_objects_from_batch
+MAP_FEATURES = {'AR': ar, 'SP': sp}
+
+
+# Part of one feature of the map: at most BATCH_SIZE rows of one tile of the window
+class MapPart:
+    def __init__(self, feature, observatory, instrument, start_date, end_date):
+        self.feature = feature
+        self.observatory = observatory
+        self.instrument = instrument
+        self.start_date = start_date    # tile of the window
+        self.end_date = end_date
+        self.data = None            # DataAccess with rows of the part
+        self.batch = None           # ContourBatch
+        self.stored = None          # result of find_stored_objects
+        self.converted = None       # Carrington coordinates of new objects
+        self.intensities = None     # intensities of new active regions
+        self.objects = None         # result of get_objects_from_batch
+
+
+# Returns parts of the window for each (feature, observatory, instrument)
+# of sources, one part for each tile
+def get_map_tiles(start_date, end_date, sources):
+    for feature, observatory, instrument in sources:
+        for tile_start, tile_end in da.split_into_tiles(start_date, end_date, da.TILE_SIZE):
+            yield MapPart(feature, observatory, instrument, tile_start, tile_end)
+
+
+# Returns fetch stage: downloads the tile (or takes it from the response cache),
+# yields parts with at most batch_size rows observed inside of the window
+def make_fetch(start_date, end_date, batch_size=BATCH_SIZE):
+    def fetch(part):
+        data = da.DataAccess(part.start_date, part.end_date, part.feature, part.observatory, part.instrument,
+                             tile_size=None)
+        array = da.filter_window(data.array, start_date, end_date)
+        for start in range(0, len(array), batch_size):
+            batch_part = MapPart(part.feature, part.observatory, part.instrument, part.start_date, part.end_date)
+            batch_part.data = da.DataAccess.from_array(array[start:start + batch_size])
+            yield batch_part
+
+    return fetch
+
+
+# Returns decode stage: chain codes are decoded to ContourBatch, objects
+# returned by more than one tile are dropped (keeps state, needs one worker)
+def make_decode():
+    seen = set()    # (feature, id) of decoded objects
+
+    def decode(part):
+        ids = np.asarray(part.data.array[da.ID_COLUMNS[part.feature]]).tolist()
+        new = np.array([(part.feature, i) not in seen for i in ids], dtype=bool)
+        seen.update((part.feature, i) for i in ids)
+        if not new.any():
+            return None
+
+        part.batch = ContourBatch.from_data_access(da.DataAccess.from_array(part.data.array[new]), part.feature)
+        part.data = None
+        return part
+
+    return decode
+
+
+# Carrington stage: finds stored objects and converts the other ones to Carrington
+def convert_part(part):
+    part.stored = MAP_FEATURES[part.feature].find_stored_objects(part.batch)
+    part.converted = prep.convert_batch_to_carrington(part.batch, part.stored[1])
+    return part
+
+
+# Intensity stage: calculates intensities of new active regions
+def calculate_part_intensities(part):
+    if part.feature == 'AR':
+        part.intensities = ar.calculate_batch_intensities(part.batch, part.stored[1])
+    return part
+
+
+# Store stage: new objects are stored, objects which can be shown on the map are kept
+def store_part(part):
+    if part.feature == 'AR':
+        part.objects = ar.get_objects_from_batch(part.batch, part.observatory, part.instrument, part.stored,
+                                                 part.converted, part.intensities)
+    else:
+        part.objects = sp.get_objects_from_batch(part.batch, part.observatory, part.instrument, part.stored,
+                                                 part.converted)
+    part.stored = part.converted = part.intensities = None
+    return part
+
+
+# Returns pipeline which yields stored MapParts of the window
+# sources - list of (feature, observatory, instrument), feature is 'AR' or 'SP'
+def make_map_pipeline(start_date, end_date, sources, batch_size=BATCH_SIZE):
+    return Pipeline(get_map_tiles(start_date, end_date, sources),
+                    [Stage('fetch', make_fetch(start_date, end_date, batch_size), FETCH_WORKERS),
+                     Stage('decode', make_decode()),
+                     Stage('carrington', convert_part, CARRINGTON_WORKERS),
+                     Stage('intensity', calculate_part_intensities, INTENSITY_WORKERS),
+                     Stage('store', store_part)])
+
+
+# Collects objects of all parts, returns dictionary feature -> MapObjects
+def collect_map_objects(parts):
+    objects = {}
+    for part in parts:
+        collected = objects.setdefault(part.feature, MapObjects())
+        collected.add(part)
+
+    return objects
+
+
+# Objects of one feature of the map collected from all parts
+class MapObjects:
+    def __init__(self):
+        self.ids = []           # ids of all objects of the parts
+        self.carrington = []    # Carrington coordinates of objects which can be shown
+        self.track_ids = []
+        self.intensities = []
+        self.latest_date = None  # date of observation of the latest object
+
+    def add(self, part):
+        self.ids += part.batch.feature_id.tolist()
+        if len(part.batch.date) > 0:
+            latest = max(str(d)[:19] for d in part.batch.date)
+            self.latest_date = latest if self.latest_date is None else max(self.latest_date, latest)
+        self.carrington += part.objects[0]
+        if part.feature == 'AR':
+            self.track_ids += part.objects[2]
+            self.intensities += part.objects[3]
+
+    # Returns synthesis of active regions (Carrington coordinates)
+    def make_ar_synthesis(self, policy=ar.DEFAULT_POLICY):
+        if len(self.carrington) == 0:
+            return []
+        mer = ar.merge_id_with_object(self.carrington, [None] * len(self.carrington), self.track_ids,
+                                      self.intensities)
+        return ar.make_ar_synthesis(mer, policy)[0]
@@ -0,0 +1,144 @@
+import time
+import threading
+import DataAccess as da
+import Database as db
+import ActiveRegion as ar
+import Pipeline as pipe
+from Pipeline import Pipeline, Stage
+from ContourBatch import ContourBatch
+from DataAccessTesting import start_server, check
+from DatabaseTesting import create_database, count_ars
+
+
+# Stage which yields item twice
+def duplicate(item):
+    yield item
+    yield item
+
+
+# Stage which drops odd items
+def drop_odd(item):
+    return item if item % 2 == 0 else None
+
+
+# Stages with one worker keep the order, generator stages can split
+# items and stages returning None drop them
+def test_order():
+    pipeline = Pipeline(range(10), [Stage('square', lambda x: x * x), Stage('duplicate', duplicate),
+                                    Stage('drop', drop_odd)])
+    result = pipeline.run()
+
+    check("order: kept", result == [x * x for x in range(10) for _ in range(2) if x % 2 == 0])
+    check("order: statistics", pipeline.get_stats()['duplicate']['items'] == 10)
+
+
+# Workers of a slow stage work at the same time
+def test_workers():
+    start = time.perf_counter()
+    result = Pipeline(range(8), [Stage('sleep', lambda x: time.sleep(0.1) or x, workers=4)]).run()
+    elapsed = time.perf_counter() - start
+
+    check("workers: all items", sorted(result) == list(range(8)))
+    check("workers: parallel", elapsed < 0.5)
+
+
+# Source is read only as fast as the slowest stage takes items
+def test_bounded():
+    produced = [0]
+
+    def source():
+        for i in range(100):
+            produced[0] += 1
+            yield i
+
+    stages = [Stage('fast', lambda x: x, queue_size=2), Stage('fast2', lambda x: x, workers=2, queue_size=2)]
+    ahead = 0
+    for consumed, item in enumerate(Pipeline(source(), stages), 1):
+        time.sleep(0.001)
+        ahead = max(ahead, produced[0] - consumed)
+
+    # items in the queues, items held by the workers and the item of the source
+    check("bounded: source waits", ahead <= 2 + 2 + pipe.QUEUE_SIZE + 3 + 1)
+
+
+# Stage which fails on the third item
+def fail_on_three(item):
+    if item == 3:
+        raise ValueError("item 3")
+    return item
+
+
+# Source which fails after two items
+def failing_source():
+    yield 1
+    yield 2
+    raise IOError("source")
+
+
+# Errors of stages and of the source are raised in the caller,
+# all threads of the pipeline are stopped
+def test_errors():
+    threads = threading.active_count()
+    try:
+        Pipeline(range(100), [Stage('fail', fail_on_three, workers=2), Stage('copy', lambda x: x)]).run()
+        check("errors: stage error raised", False)
+    except ValueError:
+        check("errors: stage error raised", True)
+
+    try:
+        Pipeline(failing_source(), [Stage('copy', lambda x: x)]).run()
+        check("errors: source error raised", False)
+    except IOError:
+        check("errors: source error raised", True)
+
+    for item in Pipeline(range(100), [Stage('copy', lambda x: x, workers=3)]):
+        break
+    check("errors: threads stopped", threading.active_count() == threads)
+
+
+# Map pipeline gives the same objects as reconstruction of the whole window,
+# objects returned by two tiles are used once, store stage does not wait
+# for inserts of the background writer to be written
+def test_map_pipeline():
+    path = create_database()
+    data = da.DataAccess('2010-01-01T00:00:00', '2010-01-01T23:59:59', 'AR', 'SOHO', 'MDI')
+    batch = ContourBatch.from_data_access(data, 'AR')
+    # objects are stored, so no FITS file is needed for the reconstruction
+    for i, content_hash in enumerate(batch.get_content_hashes()):
+        db.add_ar_to_database(batch.feature_id[i], batch.date[i], batch.track_id[i], float(i),
+                              [[10.0 * i, 10.0 * i + 1], [0.0, 1.0]], batch.contour(i), content_hash=content_hash)
+
+    stored = count_ars(path)
+
+    db.connections.flush_interval = 60
+    with db.write_behind():
+        # insert which waits in the background writer until the end of the block
+        db.add_ar_to_database(-1, '2009-01-01T00:00:00', 1, 1.0, [[1.0], [2.0]], [[1, 2]])
+        pipeline = pipe.make_map_pipeline('2010-01-01T00:00:00', '2010-01-02T12:00:00', [('AR', 'SOHO', 'MDI')],
+                                          batch_size=2)
+        objects = pipeline.run(pipe.collect_map_objects)['AR']
+        written = count_ars(path)
+    db.connections.flush_interval = db.FLUSH_INTERVAL
+
+    check("map pipeline: store does not wait for commits", written == stored)
+    check("map pipeline: written at the end", count_ars(path) == stored + 1)
+    check("map pipeline: objects used once", sorted(objects.ids) == sorted(batch.feature_id.tolist()))
+    check("map pipeline: latest date", objects.latest_date == max(str(d)[:19] for d in batch.date))
+    check("map pipeline: all stages", all(s['items'] > 0 for s in pipeline.get_stats().values()))
+    expected = ar.get_shapes_from_batch(batch)[0]
+    check("map pipeline: same synthesis", sorted(c[0][0] for c in objects.make_ar_synthesis()) ==
+          sorted(c[0][0] for c in expected))
+
+
+# Pipeline testing, map pipeline downloads from local HTTP stand-in
+if __name__ == '__main__':
+    test_order()
+    test_workers()
+    test_bounded()
+    test_errors()
+
+    server = start_server('output.xml')
+    try:
+        test_map_pipeline()
+    finally:
+        server.shutdown()
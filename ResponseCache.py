@@ -0,0 +1,126 @@
+import os
+import time
+import json
+import pickle
+import hashlib
+import tempfile
+
+
+# Default place and limits of the cache of HFC query results
+CACHE_DIRECTORY = 'hfc_cache'
+CACHE_TTL = 7 * 24 * 60 * 60   # seconds
+CACHE_MAX_SIZE_MB = 500
+CACHE_FORMAT_VERSION = 1
+
+
+# On-disk cache of parsed HFC query results.
+# Each result is stored in its own file named by the hash of the query
+# (feature, observatory, instrument, start, end), the parsed table is
+# pickled, so a repeated query skips both the network and XML parsing.
+# File modification time is the time when result was stored (used for TTL),
+# file access time is updated on each hit (used for LRU eviction).
+# Files are written to a temporary file first and then renamed,
+# so several processes can use the same cache directory.
+class ResponseCache:
+    def __init__(self, directory=CACHE_DIRECTORY, ttl=CACHE_TTL, max_size_mb=CACHE_MAX_SIZE_MB):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+
+    # Returns file path of cached query
+    def get_path(self, key):
+        key = json.dumps([CACHE_FORMAT_VERSION] + [str(k) for k in key])
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.pkl')
+
+    # Returns stored table or None if query is not in the cache or it is too old.
+    # Files which can not be read (damaged or pickled by other version of
+    # numpy or astropy) are removed, so the query is downloaded again.
+    def get(self, key):
+        path = self.get_path(key)
+        try:
+            modified = os.path.getmtime(path)
+        except OSError:
+            self.misses += 1
+            return None
+
+        value = None
+        if time.time() - modified <= self.ttl:
+            try:
+                with open(path, 'rb') as f:
+                    value = pickle.load(f)
+                # mark file as recently used, keep its modification time
+                os.utime(path, (time.time(), modified))
+            except Exception:
+                value = None
+
+        if value is None:
+            try:
+                os.remove(path)
+            except OSError:
+                pass  # removed by another process
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return value
+
+    # Stores table in the cache and removes the least recently used
+    # results if cache is bigger than its maximum size
+    def put(self, key, value):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.get_path(key)
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(descriptor, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary, path)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+
+        self.evict()
+
+    # Removes expired results and the least recently used results
+    # until the cache fits in its maximum size
+    def evict(self):
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.pkl'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                info = os.stat(path)
+                if now - info.st_mtime > self.ttl:
+                    os.remove(path)
+                else:
+                    entries.append((info.st_atime, info.st_size, path))
+            except OSError:
+                pass  # removed by another process
+
+        size = sum(e[1] for e in entries)
+        for accessed, file_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= file_size
+
+    # Removes all stored results
+    def clear(self):
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith('.pkl'):
+                os.remove(os.path.join(self.directory, name))
+
+    # Returns dictionary with cache statistics
+    def get_stats(self):
+        requests = self.hits + self.misses
+        hit_rate = self.hits / requests if requests > 0 else 0.0
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': hit_rate}
@@ -0,0 +1,273 @@
+import threading
+from datetime import datetime
+import numpy as np
+import CoordinateCodec as codec
+
+
+# Version of the database schema, stored in the database file
+# as PRAGMA user_version (0 means database made before versioning)
+SCHEMA_VERSION = 7
+
+# Steps which bring database from previous version to the given one,
+# step is a list of SQL statements or functions which take the connection.
+# Every step runs in one transaction, so a database is never left
+# between versions. Steps work on databases made before versioning
+# (tables may already exist and may contain repeated objects).
+MIGRATIONS = [
+    # 1: tables of objects
+    (1, ['''CREATE TABLE IF NOT EXISTS ar_test2(
+            ar_id TEXT NOT NULL,
+            date TEXT,
+            track_id TEXT,
+            ar_intensity REAL,
+            coordinates TEXT,
+            pixel_coordinates TEXT)''',
+         '''CREATE TABLE IF NOT EXISTS sunspots(
+            sp_id TEXT NOT NULL,
+            date TEXT,
+            carrington_coordinates TEXT,
+            pixel_coordinates TEXT)''',
+         '''CREATE TABLE IF NOT EXISTS filaments(
+            fl_id TEXT NOT NULL,
+            date TEXT,
+            track_id TEXT,
+            carrington_coordinates TEXT,
+            pixel_coordinates TEXT)''']),
+
+    # 2: objects are unique by id, indexes for lookups by id, track_id and date.
+    # Databases with repeated objects are not changed, they have to be
+    # compacted first (CompactDatabase.py keeps the latest copy of objects).
+    (2, [lambda connection: add_unique_index(connection, 'ar_test2', 'ar_id', 'ar_id_index'),
+         'CREATE INDEX IF NOT EXISTS ar_track_index ON ar_test2(track_id)',
+         'CREATE INDEX IF NOT EXISTS ar_date_index ON ar_test2(date)',
+         lambda connection: add_unique_index(connection, 'sunspots', 'sp_id', 'sp_id_index'),
+         'CREATE INDEX IF NOT EXISTS sp_date_index ON sunspots(date)',
+         lambda connection: add_unique_index(connection, 'filaments', 'fl_id', 'fl_id_index'),
+         'CREATE INDEX IF NOT EXISTS fl_track_index ON filaments(track_id)',
+         'CREATE INDEX IF NOT EXISTS fl_date_index ON filaments(date)']),
+
+    # 3: coordinates are stored in binary format (CoordinateCodec) instead of JSON
+    (3, [lambda connection: convert_coordinates(connection, 'ar_test2', 'coordinates', 'pixel_coordinates'),
+         lambda connection: convert_coordinates(connection, 'sunspots', 'carrington_coordinates', 'pixel_coordinates'),
+         lambda connection: convert_coordinates(connection, 'filaments', 'carrington_coordinates',
+                                                'pixel_coordinates')]),
+
+    # 4: spatial-temporal index (R*Tree) of Carrington bounding boxes and observation times
+    (4, ['CREATE VIRTUAL TABLE IF NOT EXISTS ar_rtree USING rtree(id, min_lon, max_lon, min_lat, max_lat, '
+         'min_time, max_time)',
+         'CREATE VIRTUAL TABLE IF NOT EXISTS sp_rtree USING rtree(id, min_lon, max_lon, min_lat, max_lat, '
+         'min_time, max_time)',
+         'CREATE VIRTUAL TABLE IF NOT EXISTS fl_rtree USING rtree(id, min_lon, max_lon, min_lat, max_lat, '
+         'min_time, max_time)',
+         lambda connection: fill_index(connection, 'ar_test2', 'ar_id', 'coordinates', 'ar_rtree'),
+         lambda connection: fill_index(connection, 'sunspots', 'sp_id', 'carrington_coordinates', 'sp_rtree'),
+         lambda connection: fill_index(connection, 'filaments', 'fl_id', 'carrington_coordinates', 'fl_rtree')]),
+
+    # 5: observatory and instrument of objects, time windows which are fully stored
+    (5, [lambda connection: add_column(connection, 'ar_test2', 'observatory', 'TEXT'),
+         lambda connection: add_column(connection, 'ar_test2', 'instrument', 'TEXT'),
+         lambda connection: add_column(connection, 'sunspots', 'observatory', 'TEXT'),
+         lambda connection: add_column(connection, 'sunspots', 'instrument', 'TEXT'),
+         lambda connection: add_column(connection, 'filaments', 'observatory', 'TEXT'),
+         lambda connection: add_column(connection, 'filaments', 'instrument', 'TEXT'),
+         'CREATE INDEX IF NOT EXISTS ar_instrument_index ON ar_test2(observatory, instrument, date)',
+         'CREATE INDEX IF NOT EXISTS sp_instrument_index ON sunspots(observatory, instrument, date)',
+         'CREATE INDEX IF NOT EXISTS fl_instrument_index ON filaments(observatory, instrument, date)',
+         '''CREATE TABLE IF NOT EXISTS coverage(
+            feature TEXT NOT NULL,
+            observatory TEXT NOT NULL,
+            instrument TEXT NOT NULL,
+            start_date TEXT NOT NULL,
+            end_date TEXT NOT NULL)''',
+         'CREATE INDEX IF NOT EXISTS coverage_index ON coverage(feature, observatory, instrument, start_date)']),
+
+    # 6: hash of the data an object was made from (chain code, start pixel and FITS file)
+    (6, [lambda connection: add_column(connection, 'ar_test2', 'content_hash', 'TEXT'),
+         lambda connection: add_column(connection, 'sunspots', 'content_hash', 'TEXT'),
+         lambda connection: add_column(connection, 'filaments', 'content_hash', 'TEXT')]),
+
+    # 7: finished synthesis of windows, synthesis is removed when an active region
+    # or a sunspot of its source observed in its window is added, changed or removed
+    (7, ['''CREATE TABLE IF NOT EXISTS synthesis(
+            start_date TEXT NOT NULL,
+            end_date TEXT NOT NULL,
+            ar_observatory TEXT NOT NULL,
+            ar_instrument TEXT NOT NULL,
+            sp_observatory TEXT NOT NULL,
+            sp_instrument TEXT NOT NULL,
+            policy TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            ar_synthesis BLOB,
+            sp_synthesis BLOB,
+            PRIMARY KEY(start_date, end_date, ar_observatory, ar_instrument, sp_observatory, sp_instrument,
+                        policy, version))''',
+         'CREATE INDEX IF NOT EXISTS synthesis_date_index ON synthesis(start_date, end_date)',
+         lambda connection: add_synthesis_triggers(connection, 'ar_test2', 'ar', AR_SYNTHESIS_COLUMNS),
+         lambda connection: add_synthesis_triggers(connection, 'sunspots', 'sp', SP_SYNTHESIS_COLUMNS)]),
+]
+
+# Columns of objects used by the stored synthesis, change of any of them
+# removes synthesis of the windows with the object
+AR_SYNTHESIS_COLUMNS = ['date', 'track_id', 'ar_intensity', 'coordinates', 'pixel_coordinates', 'observatory',
+                        'instrument', 'content_hash']
+SP_SYNTHESIS_COLUMNS = ['date', 'carrington_coordinates', 'pixel_coordinates', 'observatory', 'instrument',
+                        'content_hash']
+
+# Start of the time axis of the spatial index
+INDEX_EPOCH = datetime(1970, 1, 1)
+
+# Number of rows converted at once by convert_coordinates
+CONVERT_CHUNK = 1000
+
+# Database files already migrated by this process
+migrated = set()
+migration_lock = threading.Lock()
+
+
+# Returns schema version of the database
+def get_version(connection):
+    return connection.execute('PRAGMA user_version').fetchone()[0]
+
+
+# Brings database to SCHEMA_VERSION, does nothing if it is already there.
+# Database is locked for writing during migration, so several processes
+# can start at the same time. Returns version of the database.
+def migrate(connection):
+    if get_version(connection) >= SCHEMA_VERSION:
+        return get_version(connection)
+
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        # other process could migrate database while this one was waiting for the lock
+        version = get_version(connection)
+        for step, statements in MIGRATIONS:
+            if step > version:
+                for statement in statements:
+                    if callable(statement):
+                        statement(connection)
+                    else:
+                        connection.execute(statement)
+                connection.execute('PRAGMA user_version = {0}'.format(step))
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+
+    return get_version(connection)
+
+
+# Converts coordinates stored as JSON text to binary format.
+# Rows which can not be converted are left as JSON
+# (CoordinateCodec decodes both formats).
+def convert_coordinates(connection, table, carrington_column, pixel_column):
+    rowids = [row[0] for row in connection.execute(
+        'SELECT rowid FROM {0} WHERE typeof({1}) = \'text\' OR typeof({2}) = \'text\''
+        .format(table, carrington_column, pixel_column))]
+    select = 'SELECT rowid, {1}, {2} FROM {0} WHERE rowid IN ({{0}})'.format(table, carrington_column, pixel_column)
+    update = 'UPDATE {0} SET {1} = ?, {2} = ? WHERE rowid = ?'.format(table, carrington_column, pixel_column)
+
+    for start in range(0, len(rowids), CONVERT_CHUNK):
+        chunk = rowids[start:start + CONVERT_CHUNK]
+        converted = []
+        for rowid, carrington, pixels in connection.execute(select.format(','.join('?' * len(chunk))), chunk):
+            try:
+                converted.append((codec.encode_carrington(codec.decode_carrington(carrington)),
+                                  codec.encode_pixels(codec.decode_pixels(pixels)), rowid))
+            except (ValueError, TypeError):
+                pass
+        connection.executemany(update, converted)
+
+
+# Creates unique index of object ids, raises ValueError if the table
+# has repeated objects (the migration is rolled back)
+def add_unique_index(connection, table, id_column, index):
+    repeated = count_repeated(connection, table, id_column)
+    if repeated > 0:
+        raise ValueError("table {0} has {1} repeated objects, run CompactDatabase.py to keep only the latest copy "
+                         "of each object".format(table, repeated))
+    connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS {0} ON {1}({2})'.format(index, table, id_column))
+
+
+# Returns number of rows which are not the latest copy of an object
+def count_repeated(connection, table, id_column):
+    return connection.execute('SELECT COUNT(*) - COUNT(DISTINCT {1}) FROM {0}'.format(table, id_column)).fetchone()[0]
+
+
+# Adds column to the table if it does not have it yet
+def add_column(connection, table, column, column_type):
+    columns = [row[1] for row in connection.execute('PRAGMA table_info({0})'.format(table))]
+    if column not in columns:
+        connection.execute('ALTER TABLE {0} ADD COLUMN {1} {2}'.format(table, column, column_type))
+
+
+# Returns row of the spatial index of an object:
+# (id, min lon, max lon, min lat, max lat, time, time), time is in days
+# from INDEX_EPOCH. Returns None if the object can not be indexed
+# (id is not a number, date can not be read or there are no coordinates).
+# R*Tree stores 32-bit floats (rounded outwards), so queries return
+# candidates which have to be checked against exact values.
+def get_index_row(feature_id, date, carr_coords):
+    try:
+        feature_id = int(feature_id)
+        time = to_index_time(date)
+        carr = np.asarray(carr_coords, dtype=float).reshape(2, -1)
+    except (ValueError, TypeError):
+        return None
+
+    carr = carr[:, ~np.isnan(carr).any(axis=0)]
+    if carr.shape[1] == 0:
+        return None
+
+    return (feature_id, float(carr[0].min()), float(carr[0].max()), float(carr[1].min()), float(carr[1].max()),
+            time, time)
+
+
+# Returns date as time of the spatial index (days from INDEX_EPOCH)
+def to_index_time(date):
+    return (datetime.fromisoformat(str(date)) - INDEX_EPOCH).total_seconds() / 86400
+
+
+# Adds all stored objects of the table to its spatial index
+def fill_index(connection, table, id_column, carrington_column, index):
+    rows = connection.execute('SELECT {1}, date, {2} FROM {0}'.format(table, id_column, carrington_column)).fetchall()
+    index_rows = []
+    for feature_id, date, carrington in rows:
+        try:
+            carrington = codec.decode_carrington(carrington)
+        except (ValueError, TypeError):
+            continue
+        index_row = get_index_row(feature_id, date, carrington)
+        if index_row is not None:
+            index_rows.append(index_row)
+
+    connection.executemany('INSERT OR REPLACE INTO {0} VALUES(?,?,?,?,?,?,?)'.format(index), index_rows)
+
+
+# Adds triggers which remove stored synthesis of windows with the date and
+# the source of added, changed or removed object of the table. Object without
+# source removes synthesis of all sources.
+# prefix - prefix of the source columns of the synthesis table ('ar' or 'sp')
+# columns - columns used by the synthesis, update of other columns is ignored
+def add_synthesis_triggers(connection, table, prefix, columns):
+    remove = ('DELETE FROM synthesis WHERE start_date <= substr({0}.date, 1, 19) '
+              'AND end_date >= substr({0}.date, 1, 19) '
+              'AND ({0}.observatory IS NULL OR {1}_observatory = {0}.observatory) '
+              'AND ({0}.instrument IS NULL OR {1}_instrument = {0}.instrument);')
+    changed = ' OR '.join('OLD.{0} IS NOT NEW.{0}'.format(column) for column in columns)
+
+    for event, rows in [('INSERT', ['NEW']), ('UPDATE', ['OLD', 'NEW']), ('DELETE', ['OLD'])]:
+        name = '{0}_synthesis_{1}'.format(table, event.lower())
+        condition = 'AFTER ' + event
+        if event == 'UPDATE':
+            condition = 'AFTER UPDATE OF {0}'.format(', '.join(columns))
+        connection.execute('CREATE TRIGGER IF NOT EXISTS {0} {1} ON {2} {3}BEGIN {4} END'.format(
+            name, condition, table, 'FOR EACH ROW WHEN {0} '.format(changed) if event == 'UPDATE' else '',
+            ' '.join(remove.format(row, prefix) for row in rows)))
+
+
+# Migrates database file once per process
+def ensure_schema(connection, path):
+    with migration_lock:
+        if path not in migrated:
+            migrate(connection)
+            migrated.add(path)
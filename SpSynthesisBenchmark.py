@@ -0,0 +1,84 @@
+import sys
+import time
+import numpy as np
+from shapely.geometry import Point
+from shapely.geometry.polygon import Polygon
+import Sunspot as sp
+
+
+# Old implementation of Sunspot.make_sp_synthesis,
+# polygon is created for every (sunspot, active region) pair
+# and every point of sunspot is tested separately
+def make_sp_synthesis_old(ar_contour, sp_carr):
+    sunspots = []
+
+    for s in sp_carr:  # go through each sp
+        sp_zip = list(zip(s[0], s[1]))
+        for ar in ar_contour:  # go through each ar
+            ar_zip = list(zip(ar[0], ar[1]))
+            ar = Polygon(np.array(ar_zip))
+
+            result = []
+            for p in sp_zip:  # go through each point of sp
+                p = Point(p[0], p[1])
+                test = ar.contains(p)  # Return true if point is inside of the polygon
+                if test:
+                    result.append(test)
+
+            proportion = len(result)/len(sp_zip)
+            if proportion == 1.0:
+                sunspots.append(s)
+                break
+
+    return sunspots
+
+
+# Creates closed blob contour [lon, lat] with centre (lon, lat)
+def blob(rng, lon, lat, radius, points):
+    angles = np.linspace(0, 2 * np.pi, points, endpoint=False)
+    radii = radius * (1 + 0.2 * np.sin(3 * angles + rng.uniform(0, np.pi)))
+    return [(lon + radii * np.cos(angles)).tolist(), (lat + radii * np.sin(angles)).tolist()]
+
+
+# Creates active regions spread over the whole map and sunspots,
+# part of them inside active regions and part outside
+def create_features(ar_number, sp_number, rng):
+    ars = [blob(rng, rng.uniform(10, 350), rng.uniform(-40, 40), rng.uniform(2, 6), 150)
+           for _ in range(ar_number)]
+
+    sunspots = []
+    for k in range(sp_number):
+        if k % 2 == 0:
+            # sunspot close to the centre of some active region
+            ar = ars[rng.integers(0, ar_number)]
+            lon = np.mean(ar[0]) + rng.uniform(-1.5, 1.5)
+            lat = np.mean(ar[1]) + rng.uniform(-1.5, 1.5)
+        else:
+            lon = rng.uniform(0, 360)
+            lat = rng.uniform(-60, 60)
+        sunspots.append(blob(rng, lon, lat, rng.uniform(0.2, 0.8), 20))
+
+    return ars, sunspots
+
+
+# Sunspot synthesis benchmark
+# python SpSynthesisBenchmark.py [number of active regions] [number of sunspots]
+if __name__ == '__main__':
+    ar_number = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    sp_number = int(sys.argv[2]) if len(sys.argv) > 2 else 3000
+
+    ars, sunspots = create_features(ar_number, sp_number, np.random.default_rng(0))
+
+    start = time.perf_counter()
+    old = make_sp_synthesis_old(ars, sunspots)
+    old_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    new = sp.make_sp_synthesis(ars, sunspots)
+    new_time = time.perf_counter() - start
+
+    print("active regions:", ar_number, "sunspots:", sp_number, "synthesis:", len(new))
+    print("the same result:", old == new)
+    print("old: {0:.3f} s".format(old_time))
+    print("indexed: {0:.3f} s".format(new_time))
+    print("speedup: {0:.1f}x".format(old_time / new_time))
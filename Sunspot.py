@@ -1,8 +1,8 @@
 import numpy as np
-from matplotlib.patches import Polygon
 import Database as db
 import ObjectPreparation as prep
-from shapely.geometry import Point
+from ContourBatch import ContourBatch
+from shapely import STRtree, box, contains_xy
 from shapely.geometry.polygon import Polygon
 
 
@@ -13,70 +13,139 @@ from shapely.geometry.polygon import Polygon
 # starty - y coordinate of chain code start position in pixels
 # return - array with coordinates of the contour of the object
 def get_shapes(chains, startx, starty, filename, sp_id, date):
-    filename = prep.decode_filename(filename)
-    date = prep.decode_date(date)
+    batch = ContourBatch.from_chains(chains, startx, starty, filename, np.full(len(sp_id), -1), sp_id, date)
+    all_coords_carr, all_contours_pix = get_shapes_from_batch(batch)
+
+    return all_coords_carr, all_contours_pix.to_lists()
+
+
+# Does the same as get_shapes, but takes contours of all sunspots as ContourBatch
+# and returns pixel coordinates as ContourBatch (in the same order as carrington coordinates)
+# observatory, instrument - source of the objects, stored with new objects
+def get_shapes_from_batch(batch, observatory=None, instrument=None):
+    all_coords_carr, all_rows = get_objects_from_batch(batch, observatory, instrument)
+
+    return all_coords_carr, batch.take(all_rows)
+
+
+# Returns Carrington coordinates of sunspots of the batch which can be shown
+# on the map and their positions in the batch. Stored objects are loaded,
+# new objects are reconstructed and stored.
+# stored - result of find_stored_objects (found if None)
+# converted - result of prep.convert_batch_to_carrington for new objects (converted if None)
+def get_objects_from_batch(batch, observatory=None, instrument=None, stored=None, converted=None):
     all_coords_carr = []
-    all_contours_pix = []
-    counter = 0
-    # Loop goes through array of chain code
-    # and calculates coordinate of each of the pixel of the contour
-    for c in chains:
-        xpos = startx[counter]  # Starting position of contour
-        ypos = starty[counter]
-        s_id = sp_id[counter]
-        file = filename[counter]
-        sp_date = date[counter]
-        # Check if exists in database
-        result = db.load_sp_from_database(s_id)
-        if not result == ([], []):
-            # check if object go through the end of map and finish at the beginning
-            broken = (max(result[0][0][0]) - min(result[0][0][0])) > 358
-            if not broken:
-                all_coords_carr += result[0]
-                all_contours_pix += (result[1])
-        else:
-            # Calculate ar contour in pixel, carrington longitude and latitude
-            sp_pix, lon, lat = prep.get_shape(coords=c, xpos=xpos, ypos=ypos, file=file)
-            all_contours_pix.append(sp_pix)
-            db.add_sunspot_to_database(sp_id=s_id, date=sp_date, carr_coords=[lon, lat], pix_coords=sp_pix)
-
-            broken = max(lon) - min(lon) > 358  # check if object go through the end of map and finish at the beginning
-            if not broken:
-                all_coords_carr.append([lon, lat])
-
-        counter += 1
-
-    return all_coords_carr, all_contours_pix
+    all_rows = []   # position of each object in the batch
+    if stored is None:
+        stored = find_stored_objects(batch)
+    results, missing, content_hashes = stored
+    if converted is None:
+        converted = prep.convert_batch_to_carrington(batch, missing)
+
+    # Loop goes through contours of all objects,
+    # new objects are written to the database by a background thread
+    with db.write_behind():
+        for i in range(len(batch)):
+            s_id = batch.feature_id[i]
+            sp_date = batch.date[i]
+            result = results.get(str(s_id))
+            if result is not None:
+                # check if object go through the end of map and finish at the beginning
+                broken = (max(result[0][0][0]) - min(result[0][0][0])) > 358
+                if not broken:
+                    all_coords_carr += result[0]
+                    all_rows += [i] * len(result[0])
+            else:
+                # sp carrington longitude and latitude
+                lon, lat = converted[i]
+                db.add_sunspot_to_database(sp_id=s_id, date=sp_date, carr_coords=[lon, lat],
+                                            pix_coords=batch.contour(i), observatory=observatory,
+                                            instrument=instrument, content_hash=content_hashes[i])
+
+                broken = max(lon) - min(lon) > 358  # check if object go through the end of map and finish at the beginning
+                if not broken:
+                    all_coords_carr.append([lon, lat])
+                    all_rows.append(i)
+
+    return all_coords_carr, all_rows
+
+
+# Checks which sunspots of the batch exist in database (one query for all objects),
+# objects stored from other data are reconstructed again.
+# Returns dictionary str(sp_id) -> stored object, positions of missing
+# objects in the batch and content hashes of all objects
+def find_stored_objects(batch):
+    content_hashes = batch.get_content_hashes()
+    results, missing_ids = db.load_sps_from_database(batch.feature_id, content_hashes)
+    missing_ids = set(missing_ids)
+    missing = [i for i, s_id in enumerate(batch.feature_id) if s_id in missing_ids]
+
+    return results, missing, content_hashes
+
+
+# Returns Carrington coordinates of stored sunspots observed between
+# start_date and end_date which are inside of bounding box of some
+# active region. Only these sunspots can be in the synthesis,
+# the other ones are not loaded from the database.
+# observatory, instrument - only sunspots from this source, None means all
+def get_sunspot_candidates(ar_contour, start_date, end_date, observatory=None, instrument=None):
+    ids = {}
+    for ar in ar_contour:
+        lon = np.asarray(ar[0], dtype=float)
+        lat = np.asarray(ar[1], dtype=float)
+        if len(lon) == 0:
+            continue
+        for s_id in db.find_in_box('SP', np.nanmin(lon), np.nanmax(lon), np.nanmin(lat), np.nanmax(lat),
+                                   start_date, end_date, True, observatory, instrument):
+            ids[s_id] = None  # keeps order of sunspots
+
+    results = db.load_sps_from_database(list(ids))[0]
+
+    return [results[s_id][0][0] for s_id in ids if s_id in results]
+
+
+# Returns synthesis of sunspots stored in the database
+# observed between start_date and end_date
+def make_sp_synthesis_from_database(ar_contour, start_date, end_date, observatory=None, instrument=None):
+    return make_sp_synthesis(ar_contour, get_sunspot_candidates(ar_contour, start_date, end_date, observatory,
+                                                                instrument))
 
 
 # Returns synthesis of sunspots
 def make_sp_synthesis(ar_contour, sp_carr):
-    # For each active region (after synthesis), every point of
-    # each sunspot is tested.
-    # If proportion of success tests and the length of
-    # array containing sunspots points is > 50%, then
-    # sunspot will be drawn on map.
+    # For each sunspot, every point of the sunspot is tested
+    # against active regions (after synthesis).
+    # If all points of the sunspot are inside of one
+    # active region, then sunspot will be drawn on map.
+    # Active regions are indexed once by their bounding boxes,
+    # so each sunspot is tested only against active regions
+    # which can contain it.
     sunspots = []
+    if len(ar_contour) == 0:
+        return sunspots
 
-    for sp in sp_carr:  # go through each sp
-        sp_zip = list(zip(sp[0], sp[1]))
-        for ar in ar_contour:  # go through each ar
-            # To create polygon object longitude and latitude
-            # must be stored this way:[(lon,lat),(lon,lat)...]
-            ar_zip = list(zip(ar[0], ar[1]))
-            ar = Polygon(np.array(ar_zip))
-
-            result = []
-            for p in sp_zip:  # go through each point of sp
-                p = Point(p[0], p[1])
-                test = ar.contains(p)  # Return true if point is inside of the polygon
-                if test:
-                    result.append(test)
+    # To create polygon object longitude and latitude
+    # must be stored this way:[(lon,lat),(lon,lat)...]
+    ar_polygons = [Polygon(np.column_stack([ar[0], ar[1]])) for ar in ar_contour]
+    ar_bounds = np.array([polygon.bounds for polygon in ar_polygons])  # min lon, min lat, max lon, max lat
+    tree = STRtree(ar_polygons)
 
+    for sp in sp_carr:  # go through each sp
+        lon = np.asarray(sp[0], dtype=float)
+        lat = np.asarray(sp[1], dtype=float)
+        if len(lon) == 0:
+            continue
+
+        # active regions which bounding box contains the whole sunspot
+        candidates = np.sort(tree.query(box(lon.min(), lat.min(), lon.max(), lat.max())))
+        bounds = ar_bounds[candidates]
+        inside_box = (bounds[:, 0] <= lon.min()) & (bounds[:, 1] <= lat.min()) & \
+                     (bounds[:, 2] >= lon.max()) & (bounds[:, 3] >= lat.max())
+
+        for candidate in candidates[inside_box]:
             # if all the points of a sunspot are inside of
             # active region then sunspot is added to array
-            proportion = len(result)/len(sp_zip)
-            if proportion == 1.0:
+            if contains_xy(ar_polygons[candidate], lon, lat).all():
                 sunspots.append(sp)
                 break
 
@@ -90,21 +159,11 @@ if __name__ == '__main__':
 
     # setting active regions
     data = DataAccess('2003-10-21T00:00:00', '2003-10-24T00:00:00', 'AR', 'SOHO', 'MDI')
-    chain_encoded = prep.decode_and_split(data.get_chain_code())
-    ar_carr_synthesis, ar_pix_synthesis = ar.get_shapes(chain_encoded, data.get_pixel_start_x(),
-                                                        data.get_pixel_start_y(),
-                                               data.get_filename(),
-                                               data.get_noaa_number(), data.get_ar_id(), data.get_date())
+    ar_carr_synthesis, ar_pix_synthesis = ar.get_shapes_from_batch(ContourBatch.from_data_access(data, 'AR'))
 
     # setting sunspots
     sp_data = DataAccess('2003-10-21T00:00:00', '2003-10-24T00:00:00', 'SP', 'SOHO', 'MDI')
-
-    sp_chain_encoded = prep.decode_and_split(sp_data.get_chain_code())
-
-    sp_carr, sp_pix = get_shapes(sp_chain_encoded, sp_data.get_pixel_start_x(),
-                                 sp_data.get_pixel_start_y(),
-                                sp_data.get_filename(), sp_data.get_sp_id(), sp_data.get_date())
-
+    sp_carr, sp_pix = get_shapes_from_batch(ContourBatch.from_data_access(sp_data, 'SP'))
 
     sp_synthesis = make_sp_synthesis(ar_contour=ar_carr_synthesis, sp_carr=sp_carr)
 
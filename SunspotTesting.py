@@ -49,6 +49,7 @@ def test_sunspots(sp_id, grav_long, grav_lat):
     print("successes = ", success)
     print("fail = ", fail)
     print("ignored = ", ignored)
+    print("database cache:", db.get_cache_stats())
 
 
 # Sunspots position testing
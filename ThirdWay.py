@@ -13,6 +13,7 @@ from descartes import PolygonPatch
 from PIL import Image
 import cv2
 import json
+import ChainCode as cc
 
 
 # Function takes array with chain codes, encode the chain code,
@@ -58,35 +59,11 @@ def get_shapes(chains, startx, starty, filename):
     # Loop goes through array of chain code
     # and calculates coordinate of each of the pixel of the contour
     for c in chains:
-        xpos = startx[counter]  # Starting position of contour
-        ypos = starty[counter]
         lon = []
         lat = []
-        ar = []
-        for d in c:
-            if d == 0:
-                xpos -= 1
-            elif d == 1:
-                xpos -= 1
-                ypos -= 1
-            elif d == 2:
-                ypos -= 1
-            elif d == 3:
-                ypos -= 1
-                xpos += 1
-            elif d == 4:
-                xpos += 1
-            elif d == 5:
-                ypos += 1
-                xpos += 1
-            elif d == 6:
-                ypos += 1
-            elif d == 7:
-                ypos += 1
-                xpos -= 1
-
-            ar.append([xpos, ypos])
-
+        # Starting position of contour
+        ar = cc.decode_chain(c, startx[counter], starty[counter])
+        for xpos, ypos in ar:
             carr = convert_to_carrington(xpos, ypos, filename)
             if not (math.isnan(carr.lon.deg) or math.isnan(carr.lat.deg)):
                 lon.append(carr.lon.deg)  # Add calculated position to array
@@ -121,33 +98,8 @@ def get_shapes2(chains, startx, starty):
     # Loop goes through array of chain code
     # and calculates coordinate of each of the pixel of the contour
     for c in chains:
-        xpos = startx[counter]  # Starting position of contour
-        ypos = starty[counter]
-        ar = []
-        for d in c:
-            if d == 0:
-                xpos -= 1
-            elif d == 1:
-                xpos -= 1
-                ypos -= 1
-            elif d == 2:
-                ypos -= 1
-            elif d == 3:
-                ypos -= 1
-                xpos += 1
-            elif d == 4:
-                xpos += 1
-            elif d == 5:
-                ypos += 1
-                xpos += 1
-            elif d == 6:
-                ypos += 1
-            elif d == 7:
-                ypos += 1
-                xpos -= 1
-
-            ar.append([xpos, ypos])
-
+        # Starting position of contour
+        ar = cc.decode_chain(c, startx[counter], starty[counter])
         all_contours_pix.append(ar)
 
         counter += 1